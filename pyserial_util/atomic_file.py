@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+These are the functions that the files the scripts keep between runs, such as
+the port cache, the step journal and the latency table, are read and written
+with.
+
+Each file is written to a temporary file of its own next to it first, which
+is flushed to the disk and then renamed over it, so that a crash part way 
+through cannot leave half a file, anything reading the file, such as the 
+textfile collector of the Prometheus node exporter, never sees half a file,
+and threads or processes writing the same file at once do not get in each
+other's way, with the last rename winning.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger()
+
+
+def write_atomically(path, text):
+    """
+    Write text to the file at path, as described above, making the directory
+    for it if need be. Errors are raised as IOError or OSError.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, temp_file = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", 
+                                         dir=directory or ".")
+    try:
+        with os.fdopen(handle, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        #mkstemp() makes the file readable only by its owner
+        os.chmod(temp_file, 0o644)
+        os.rename(temp_file, path)
+    except Exception:
+        os.remove(temp_file)
+        raise
+
+def load_json(path, description):
+    """
+    The data in the JSON file at path, or None if it could not be read, as
+    when it is not there yet, which is logged with the description of the
+    file, such as "port cache".
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.debug("Starting with an empty " + description + ", as " + path + " could not be read - %s" % e)
+        return None
+
+def save_json(path, data, description):
+    """
+    Write data to the JSON file at path, as described above. The result is
+    whether it was written, and if it was not, the error is logged with the
+    description of the file.
+    """
+    try:
+        write_atomically(path, json.dumps(data, indent=2, sort_keys=True))
+        return True
+    except (IOError, OSError) as e:
+        logger.error("Could not write the " + description + " to " + path + " - %s" % e)
+        return False
@@ -0,0 +1,323 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a benchmark of the bundle_install.py and config_load.py flows, run
+against devices simulated with ios_simulator.py, to show where the time goes
+and to catch the flows getting slower between releases.
+
+The time spent in each phase of the flow is measured for each device:
+
+ - discovery, finding the device and its type on its console.
+ - enable, getting to enable mode.
+ - copy, copying the bundle and images to flash.
+ - install, installing the bundle and the GOS image, and removing the old one.
+ - boot-image, setting the boot image.
+ - config, sending the configuration, and reading the running configuration
+   first when that is incremental.
+ - reload, reloading the device.
+
+The results are the wall time of the whole run, the time of each phase and the
+total for each device, and the count, total, mean, 50th, 90th and 99th
+percentiles and maximum of each phase over all of the devices. They are logged,
+and written as JSON to results_file.
+
+With transport = "pty" the simulated devices are on pseudo-terminals, and the
+flows find them as they would real devices. With transport = "in-process" the
+flows are given the devices directly, without discovery, which needs nothing
+but Python.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import json
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from pyserial_util import cli_utils, bundle_install, config_load, ios_simulator
+from pyserial_util.cli_utils import logger, DeviceSerialPort, iter_console_ports
+from pyserial_util.ios_simulator import SimulatedDevice, SimulatedSerialPort, IOSSimulator
+from pyserial_util.console_reader import ConsoleReader
+
+#The flow to run, "bundle_install" or "config_load", against how many devices,
+#and how the devices are connected, "pty" or "in-process".
+flow = "bundle_install"
+device_count = 8
+transport = "in-process"
+
+#How slow the simulated devices are, as for ios_simulator.py, with latencies
+#being any to use rather than its default_latencies.
+latencies = None
+latency_scale = 0.01
+console_bits_per_second = None
+#Set simulate_console_speed to True to have the simulated consoles go at their
+#console speeds, and console_speed_upgrade to True to raise those speeds, as
+#for cli_utils.py.
+simulate_console_speed = False
+console_speed_upgrade = False
+#Set background_readers to True to read the consoles in the background, as for
+#cli_utils.py.
+background_readers = False
+
+#How the images are copied, as for bundle_install.py, and how big the images
+#made up for the benchmark are, in bytes.
+transfer_backend = "http"
+image_size = 4 * 1024 * 1024
+
+results_file = "benchmark_results.json"
+
+#The functions timed for each phase, by module and name. The functions are
+#looked up by name when they are called, so they are timed by replacing them
+#in those modules for the length of the run.
+PHASES = [
+    (cli_utils, "probe_console_port", "discovery"),
+    (bundle_install, "enable", "enable"),
+    (bundle_install, "copy_image", "copy"),
+    (bundle_install, "remove_gos_image", "install"),
+    (bundle_install, "install_bundle", "install"),
+    (bundle_install, "install_gos_image", "install"),
+    (bundle_install, "set_boot_image", "boot-image"),
+    (bundle_install, "reload_device", "reload"),
+    (config_load, "enable", "enable"),
+    (config_load, "get_incremental_config", "config"),
+    (config_load, "send_config_bulk", "config"),
+    (config_load, "send_config_by_line", "config"),
+]
+PHASE_NAMES = ["discovery", "enable", "copy", "install", "boot-image", "config", "reload"]
+PERCENTILES = [50, 90, 99]
+
+
+class PhaseTimer:
+    """
+    Adds up the time spent in each phase for each device, by the name of the
+    thread working on the device, which is named after its port.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._originals = []
+
+    def record(self, device, phase, seconds):
+        with self._lock:
+            phases = self.timings.setdefault(device, {})
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+    def patch(self, module, name, phase):
+        function = getattr(module, name)
+
+        def timed(*args, **kwargs):
+            #Discovery runs before the thread is named after the port
+            if (phase == "discovery"):
+                device = os.path.basename(args[0])
+            else:
+                device = threading.current_thread().name
+            start_time = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(device, phase, time.time() - start_time)
+
+        self._originals.append((module, name, function))
+        setattr(module, name, timed)
+
+    def restore(self):
+        for module, name, function in reversed(self._originals):
+            setattr(module, name, function)
+        self._originals = []
+
+def percentile(values, percent):
+    """
+    The nearest-rank percentile of the values.
+    """
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def summarise(values):
+    summary = {"count": len(values), "total": sum(values), "mean": sum(values) / len(values),
+               "max": max(values)}
+    for percent in PERCENTILES:
+        summary["p" + str(percent)] = percentile(values, percent)
+    return summary
+
+def free_port():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+def make_devices():
+    devices = []
+    for index in range(device_count):
+        device_type = ios_simulator.simulated_device_types[index % len(ios_simulator.simulated_device_types)]
+        startup_config = ["hostname IR-SN10." + str(42 + index) + ".1.0EN",
+                          "enable password " + bundle_install.enable_password]
+        devices.append(SimulatedDevice(device_type, ios_simulator.simulated_serial_number(index),
+                                       latencies=latencies, startup_config=startup_config))
+    return devices
+
+def make_images(image_dir):
+    for filename in (bundle_install.bundle_name, bundle_install.gos_vm_name):
+        if filename:
+            with open(os.path.join(image_dir, filename), "wb") as image:
+                image.write(os.urandom(image_size))
+
+def set_globals(settings):
+    """
+    Set each of the settings, which are tuples of a module, the name of a
+    global in it and its value. The result is the values they had before, in
+    the same form, for restore_globals().
+    """
+    originals = [(module, name, getattr(module, name)) for module, name, value in settings]
+    for module, name, value in settings:
+        setattr(module, name, value)
+    return originals
+
+def restore_globals(originals):
+    for module, name, value in reversed(originals):
+        setattr(module, name, value)
+
+def run_benchmark():
+    """
+    Run the flow once against device_count simulated devices, returning the
+    results. The settings of the other modules are put back as they were
+    afterwards, and nothing is kept between runs, such as the port cache or
+    the image hashes.
+    """
+    work_dir = tempfile.mkdtemp(prefix="benchmark")
+    image_dir = os.path.join(work_dir, "images")
+    os.makedirs(image_dir)
+    make_images(image_dir)
+
+    tftp_port = free_port()
+    originals = set_globals([(ios_simulator, "latency_scale", latency_scale),
+                             (ios_simulator, "console_bits_per_second", console_bits_per_second),
+                             (ios_simulator, "simulate_console_speed", simulate_console_speed),
+                             (ios_simulator, "tftp_port", tftp_port),
+                             (bundle_install, "image_dir", image_dir),
+                             (bundle_install, "transfer_backend", transfer_backend),
+                             (bundle_install, "embedded_tftp_server", True),
+                             (bundle_install, "file_server_address", "127.0.0.1"),
+                             (bundle_install, "http_server_port", free_port()),
+                             (bundle_install, "tftp_server_port", tftp_port),
+                             (bundle_install, "journal_file", None),
+                             (cli_utils, "port_cache_file", None),
+                             (cli_utils, "latency_file", None),
+                             (cli_utils, "image_hash_file", os.path.join(work_dir, "image_hashes.json")),
+                             (cli_utils, "console_speed_upgrade", console_speed_upgrade),
+                             (cli_utils, "background_readers", background_readers),
+                             (cli_utils, "console_dev_dir", os.path.join(work_dir, "dev"))])
+
+    devices = make_devices()
+    simulator = None
+    serial_ports = []
+    timer = PhaseTimer()
+    for module, name, phase in PHASES:
+        timer.patch(module, name, phase)
+
+    try:
+        if (transport == "pty"):
+            simulator = IOSSimulator(devices, cli_utils.console_dev_dir, bundle_install.usb_port_base)
+            simulator.start()
+            device_serial_ports = iter_console_ports(bundle_install.usb_port_base)
+        else:
+            serial_ports = [SimulatedSerialPort(device, "sim" + str(index)) for index, device in enumerate(devices)]
+            if background_readers:
+                serial_ports = [ConsoleReader(serial_port) for serial_port in serial_ports]
+            device_serial_ports = [DeviceSerialPort(serial_port, device.device_type, device.serial_number)
+                                   for serial_port, device in zip(serial_ports, devices)]
+
+        start_time = time.time()
+        if (flow == "config_load"):
+            summary = config_load.configure_devices(device_serial_ports)
+        else:
+            summary = bundle_install.install_devices(device_serial_ports)
+        wall_seconds = time.time() - start_time
+    finally:
+        timer.restore()
+        if simulator:
+            simulator.stop()
+        restore_globals(originals)
+        for serial_port in serial_ports:
+            serial_port.close()
+        for device in devices:
+            device.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        "flow": flow,
+        "transport": transport,
+        "device_count": device_count,
+        "completed": len(summary),
+        "latency_scale": latency_scale,
+        "latencies": dict(ios_simulator.default_latencies, **(latencies or {})),
+        "console_bits_per_second": console_bits_per_second,
+        "simulate_console_speed": simulate_console_speed,
+        "console_speed_upgrade": console_speed_upgrade,
+        "background_readers": background_readers,
+        "transfer_backend": transfer_backend,
+        "image_size": image_size,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start_time)),
+        "python": platform.python_version(),
+        "wall_seconds": wall_seconds,
+        "phases": {},
+        "devices": {},
+    }
+    for device, phases in sorted(timer.timings.items()):
+        results["devices"][device] = {"phases": phases, "total": sum(phases.values())}
+    for phase in PHASE_NAMES:
+        values = [phases[phase] for phases in timer.timings.values() if phase in phases]
+        if values:
+            results["phases"][phase] = summarise(values)
+    totals = [device["total"] for device in results["devices"].values()]
+    if totals:
+        results["device_totals"] = summarise(totals)
+
+    return results
+
+def log_results(results):
+    logger.info("Ran " + results["flow"] + " against " + str(results["device_count"]) + " devices, of which "
+                + str(results["completed"]) + " completed, in " + "%.3f" % results["wall_seconds"] + " secs.")
+    logger.info("%-12s %6s %10s %10s %10s %10s %10s" % ("phase", "count", "mean", "p50", "p90", "p99", "max"))
+    rows = [(phase, results["phases"][phase]) for phase in PHASE_NAMES if phase in results["phases"]]
+    if "device_totals" in results:
+        rows.append(("device", results["device_totals"]))
+    for name, summary in rows:
+        logger.info("%-12s %6d %10.3f %10.3f %10.3f %10.3f %10.3f"
+                    % (name, summary["count"], summary["mean"], summary["p50"], summary["p90"], summary["p99"],
+                       summary["max"]))
+
+def main(argv=None):
+
+    results = run_benchmark()
+    log_results(results)
+
+    with open(results_file, "w") as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    logger.info("The results are in " + results_file + ".")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -46,7 +46,14 @@ from __future__ import print_function
 import serial
 import time
 import sys
+import re
+import os
+import threading
 from pyserial_util.cli_utils import *
+from pyserial_util.tftp_server import TFTPServer
+from pyserial_util.http_server import ImageHTTPServer
+from pyserial_util.metrics import step
+from pyserial_util.step_journal import StepJournal
 
 usb_port_base = "cu.SLAB_USBtoUART"
 bundle_name = "ir800-universalk9_npe-bundle.SPA.156-2.T.bin"
@@ -55,231 +62,348 @@ image_name = "ir800-universalk9_npe-mz.SPA.156-2.T"
 #gos_vm_name = "ir800-ioxvm-1.0.0.4-T.bin"
 gos_vm_name = "ir800-ioxvm.20160404.bin"
 enable_password = "cisco123"
+#The directory with the local copies of the bundle and images, i.e. the TFTP 
+#server root. If it is set, files already in flash that are the same as the 
+#local copies are not copied again.
+image_dir = ""
+#How the devices copy the bundle and images, "tftp" for "copy tftp flash", or 
+#"http" for "copy http://... flash:" from the HTTP server in http_server.py, 
+#which serves the files in image_dir on http_server_port.
+transfer_backend = "tftp"
+http_server_port = 8080
+#Set embedded_tftp_server to True to serve the files in image_dir with the TFTP
+#server in tftp_server.py, rather than a separate one. The devices reach the
+#embedded TFTP or HTTP server at file_server_address or, if that is not set, 
+#the address from the host name.
+embedded_tftp_server = False
+tftp_server_port = 69
+file_server_address = ""
+#How many devices to work on at once, None being all of them, and where to put a
+#log file per device, None being no per device log files.
+max_workers = None
+device_log_dir = None
+#Where to keep the journal of the steps done on each device, so that a run that
+#fails part of the way through carries on from where it stopped next time, as
+#in step_journal.py. Set journal_file to None to always do every step.
+journal_file = os.path.join(os.path.expanduser("~"), ".pyserial_util", "install_journal.json")
 
+_journal = None
+_journal_lock = threading.Lock()
+
+@step
 def get_network_from_host_name(dev_ser_port):
    
     network = ""
     
-    logger.info("\nInstalling " + bundle_name + " from flash.")
+    logger.info("\nGetting the network from the host name.")
     
-    dev_ser_port.write("\r")
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
-    logger.debug(response)
-
-    if (strip_cr_nl(response).endswith("#")):
-        dev_ser_port.write("show running-config | begin hostname\r")
-        time.sleep(1)
-        response = dev_ser_port.read(dev_ser_port.inWaiting())
+    if exec_mode(dev_ser_port):
+        response = get_fact(dev_ser_port, "hostname")
+        if response is None:
+            response = read_show_output(dev_ser_port, "show running-config | include ^hostname")
         logger.debug(response)
-        index_start = response.find("SN")
-        index_end = response.find("EN")
-        network = response[index_start+2:index_end]
+        match = re.search(r"SN(.*?)EN", response)
+        if match:
+            network = match.group(1)
         
     return network
             
+@step
 def install_bundle(dev_ser_port):
     
     logger.info("\nInstalling " + bundle_name + " from flash.")
     
-    dev_ser_port.write("\r")
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
-    logger.debug(response)
+    if not exec_mode(dev_ser_port):
+        logger.error("The response did not end in \"#\" in install_bundle, returning.")
+        return 1
 
-    if (strip_cr_nl(response).endswith("#")):
-        dev_ser_port.write("bundle install flash:/" + bundle_name + "\r")
-        
-    while True:
-        time.sleep(10)
-        dev_ser_port.write("\r")
-        response = dev_ser_port.read(dev_ser_port.inWaiting())
-        logger.info("The response is " + response + " whilst installing the bundle " + bundle_name + ".")
-        if (strip_cr_nl(response).endswith("#")):
-            logger.info("Back to # prompt, carrying on.")
-            break
+    index, match, response = send_expect(dev_ser_port, "bundle install flash:/" + bundle_name, 
+                                         [ENABLE_PROMPT, CONFIRM_PROMPT], 
+                                         device_setting(dev_ser_port, "install_timeout", install_timeout))
+    while (index == 1):
+        index, match, response = send_expect(dev_ser_port, "", [ENABLE_PROMPT, CONFIRM_PROMPT], 
+                                             device_setting(dev_ser_port, "install_timeout", install_timeout), 
+                                             record=False)
+    logger.info("The response is " + response + " whilst installing the bundle " + bundle_name + ".")
+    if (index != 0):
+        logger.error("Timed out installing the bundle " + bundle_name + ", returning.")
+        return 1
+    logger.info("Back to # prompt, carrying on.")
         
-    dev_ser_port.write("\r")
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
+    index, match, response = send_expect(dev_ser_port, "write memory", ENABLE_PROMPT)
     logger.debug(response)
-
-    if (strip_cr_nl(response).endswith("#")):
-        dev_ser_port.write("write memory\r")
-        time.sleep(1)
         
     return 0
 
+@step
 def set_boot_image(dev_ser_port):
 
     logger.info("\nSetting boot image to " + image_name + " from flash.")
     
-    dev_ser_port.write("\r")
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
-    logger.debug(response)
-    if (strip_cr_nl(response).endswith("#")):
-        dev_ser_port.write("configure terminal\r")
-            
-    dev_ser_port.write("\r")
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
-    logger.debug(response)
-    if (strip_cr_nl(response).endswith("(config)#")):   
-        dev_ser_port.write("boot system flash:/" + image_name + "\r")
-        time.sleep(1)
-        response = dev_ser_port.read(dev_ser_port.inWaiting())
-        if ("Invalid" in response):
-            logger.error("The response contains \"Invalid\" in set_boot_image, returning.")
-            return 1
+    mode = get_mode(dev_ser_port)
+    if (mode == MODE_ENABLE):
+        index, match, response = send_expect(dev_ser_port, "configure terminal", CONFIG_PROMPT)
+        logger.debug(response)
+        mode = get_mode_from_response(response)
+    if (mode != MODE_CONFIG):
+        logger.error("The response did not end in \"(config)#\" in set_boot_image, returning.")
+        return 1
     
-    dev_ser_port.write("\r")
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
+    index, match, response = send_expect(dev_ser_port, "boot system flash:/" + image_name, CONFIG_PROMPT)
     logger.debug(response)
-    if (strip_cr_nl(response).endswith("(config)#")):
-        dev_ser_port.write("end\r")
+    if ("Invalid" in response):
+        logger.error("The response contains \"Invalid\" in set_boot_image, returning.")
+        return 1
     
-    dev_ser_port.write("\r")
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
+    index, match, response = send_expect(dev_ser_port, "end", ENABLE_PROMPT)
     logger.debug(response)
-    if (strip_cr_nl(response).endswith("#")):
-        dev_ser_port.write("write memory\r")
-        time.sleep(1)
+    if (index == 0):
+        index, match, response = send_expect(dev_ser_port, "write memory", ENABLE_PROMPT)
+        logger.debug(response)
         
     return 0
 
+@step
 def remove_gos_image(dev_ser_port):
 
     logger.info("\Stopping and uninstalling existing GOS image.")
     
-    dev_ser_port.write("\r")
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
-    logger.debug(response)
-    if (strip_cr_nl(response).endswith("#")):
-        dev_ser_port.write("guest-os 1 stop\r")
+    index = -1
+    if exec_mode(dev_ser_port):
+        index, match, response = send_expect(dev_ser_port, "guest-os 1 stop", ENABLE_PROMPT)
+        logger.debug(response)
     
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
-    logger.debug(response)
-    if (strip_cr_nl(response).endswith("#")):
-        dev_ser_port.write("guest-os 1 image uninstall\r")
+    if (index == 0):
+        index, match, response = send_expect(dev_ser_port, "guest-os 1 image uninstall", ENABLE_PROMPT)
+        logger.debug(response)
 
     return 0
 
+@step
 def install_gos_image(dev_ser_port):
 
     logger.info("\nInstalling " + gos_vm_name + " from flash.")
         
-    dev_ser_port.write("\r")
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
-    logger.debug(response)
-    if (strip_cr_nl(response).endswith("#")):    
-        dev_ser_port.write("guest-os 1 image install flash:/" + gos_vm_name + " verify\r")
-        time.sleep(1)
-        response = dev_ser_port.read(dev_ser_port.inWaiting())
-        if ("Inappropriate image type" in response):
-            logger.error("The response contains \"Inappropriate image type\" in install_gos_image, returning.")
-            return 1
+    if not exec_mode(dev_ser_port):
+        logger.error("The response did not end in \"#\" in install_gos_image, returning.")
+        return 1
         
-    while True:
-        time.sleep(10)
-        response = dev_ser_port.read(dev_ser_port.inWaiting())
-        logger.info("The response is " + response + " whilst installing the GOS image " + gos_vm_name + ".")
-        if (strip_cr_nl(response).endswith("#")):
-            logger.info("Back to # prompt, carrying on.")
-            break
+    #The install has quiet spells while it verifies, so the progress is only
+    #followed, and the install is not stopped when there is none.
+    progress = TransferProgress(log_progress)
+    send_line(dev_ser_port, "guest-os 1 image install flash:/" + gos_vm_name + " verify")
+    index, match, response = expect_with_progress(dev_ser_port, [re.compile(r"Inappropriate image type"), ENABLE_PROMPT],
+                                                  progress, 
+                                                  device_setting(dev_ser_port, "install_timeout", install_timeout))
+    logger.info("The response is " + response + " whilst installing the GOS image " + gos_vm_name + ".")
+    if (index == 0):
+        logger.error("The response contains \"Inappropriate image type\" in install_gos_image, returning.")
+        return 1
+    if (index != 1):
+        logger.error("Timed out installing the GOS image " + gos_vm_name + ", returning.")
+        return 1
+    logger.info("Back to # prompt, carrying on.")
                 
-    dev_ser_port.write("\r")
-    time.sleep(1)
-    response = dev_ser_port.read(dev_ser_port.inWaiting())
+    index, match, response = send_expect(dev_ser_port, "write memory", ENABLE_PROMPT)
     logger.debug(response)
-
-    if (strip_cr_nl(response).endswith("#")):
-        dev_ser_port.write("write memory\r")
-        time.sleep(1)
         
     return 0
     
-def main(argv=None):
+def local_image_path(filename):
+    """
+    The path of the local copy of filename, or None if image_dir is not set.
+    """
+    if image_dir:
+        return os.path.join(image_dir, filename)
+    return None
     
-    device_serial_ports = get_console_ports(usb_port_base)
-        
-    logger.info("About to start on these serial ports - " + str(device_serial_ports))
+@step
+def copy_image(session, filename, file_server):
+    """
+    Copy filename to flash from file_server with the transfer_backend.
+    """
+    if (transfer_backend == "http"):
+        return copy_http_flash(session, filename, file_server + ":" + str(http_server_port), 
+                               local_image_path(filename))
+    return copy_tftp_flash(session, filename, file_server, local_image_path(filename))
     
-    summary = []
-       
-    for dev_ser_port in device_serial_ports:
-        
-        retcode = enable(dev_ser_port.serial_port, enable_password)
+def get_journal():
+    """
+    The StepJournal for journal_file, or None if there is none.
+    """
+    global _journal
+    if not journal_file:
+        return None
+    with _journal_lock:
+        if _journal is None or _journal.journal_file != journal_file:
+            _journal = StepJournal(journal_file)
+    return _journal
+
+def artifact_version(*filenames):
+    """
+    The version of the files, for the journal, which is their names, with the 
+    MD5 hashes of the local copies in image_dir where there are any.
+    """
+    versions = []
+    for filename in filenames:
+        local_path = os.path.join(image_dir, filename) if image_dir else ""
+        if (local_path and os.path.isfile(local_path)):
+            versions.append(filename + "@" + get_local_md5(local_path))
+        else:
+            versions.append(filename)
+    return ",".join(versions)
+
+def journaled_step(dev_ser_port, step_name, version, function, *args):
+    """
+    Call function with args, unless the journal has the step as done on the
+    device with the same version already, and record the step as done if the
+    result is 0. The result is that of function, or 0 if it was skipped.
+    """
+    journal = get_journal()
+    if (journal and dev_ser_port.serial_number 
+        and journal.done(dev_ser_port.serial_number, step_name, version)):
+        logger.info("The journal has " + step_name + " as done already on " + dev_ser_port.serial_number 
+                    + " with " + version + ", so skipping it.")
+        return 0
+    
+    retcode = function(*args)
+    if (retcode == 0 and journal and dev_ser_port.serial_number):
+        journal.record(dev_ser_port.serial_number, step_name, version)
+    return retcode
+
+@step
+def install_device(dev_ser_port):
+    """
+    Carry out all of the steps to install the bundle and images on one device,
+    returning a line for the summary, or None if a step failed.
+    """
+    logger.info("About to start on a " + dev_ser_port.device_type + " at " + dev_ser_port.serial_port.port + ".")
+    
+    session = CLISession(dev_ser_port)
+    
+    retcode = enable(session, enable_password)
+    if (retcode > 0):
+        logger.error("enable for " + dev_ser_port.serial_port.port + " returned non-zero result " 
+                     + str(retcode) + ".")
+        return None
+    
+    if (upgrade_console_speed(session, dev_ser_port.device_type) > 0):
+        logger.error("The console speed of " + dev_ser_port.serial_port.port + " could not be raised, carrying on at " 
+                     + str(get_console_speed(session)) + ".")
+    
+    #The host name and the files in flash, amongst others, in one round trip
+    if gather_facts(session) is None:
+        logger.info("Could not gather the facts from " + dev_ser_port.serial_port.port + ", asking for each instead.")
+    
+    #The journal goes by the serial number, so it has to be that of the device
+    #on the port now, rather than one from the port cache
+    confirm_serial_number(dev_ser_port, session)
+    
+    network = get_network_from_host_name(session)
+    file_server = network.replace(".0", ".2")
+    if ((embedded_tftp_server or transfer_backend == "http") and file_server_address):
+        file_server = file_server_address
+    
+    retcode = set_logging_console(session, False)
+    if (retcode > 0):
+        logger.error("set_logging_console False for " + dev_ser_port.serial_port.port 
+                     + " returned non-zero result " + str(retcode) + ".")
+        return None
+
+    if bundle_name:
+        retcode = journaled_step(dev_ser_port, "copy-bundle", artifact_version(bundle_name), 
+                                 copy_image, session, bundle_name, file_server)
         if (retcode > 0):
-            logger.error("enable for " + dev_ser_port.serial_port.port + " returned non-zero result " 
-                         + str(retcode) + ".")
-            continue
-        
-        network = get_network_from_host_name(dev_ser_port.serial_port)
-        tftp_server = network.replace(".0", ".2")
-        
-        retcode = set_logging_console(dev_ser_port.serial_port, False)
+            logger.error("copy_image for " + dev_ser_port.serial_port.port + " and " + bundle_name 
+                         + " returned non-zero result " + str(retcode) + ".")
+            return None
+    
+    if gos_vm_name: 
+        retcode = journaled_step(dev_ser_port, "copy-gos", artifact_version(gos_vm_name), 
+                                 copy_image, session, gos_vm_name, file_server)
         if (retcode > 0):
-            logger.error("set_logging_console False for " + dev_ser_port.serial_port.port 
+            logger.error("copy_image for " + dev_ser_port.serial_port.port + " and " + gos_vm_name 
                          + " returned non-zero result " + str(retcode) + ".")
-            continue
-
-        if bundle_name:
-            retcode = copy_tftp_flash(dev_ser_port.serial_port, bundle_name, tftp_server)
-            if (retcode > 0):
-                logger.error("copy_tftp_flash for " + dev_ser_port.serial_port.port + " and " + bundle_name 
-                             + " returned non-zero result " + str(retcode) + ".")
-                continue
-        
-        if gos_vm_name: 
-            retcode = copy_tftp_flash(dev_ser_port.serial_port, gos_vm_name, tftp_server)
-            if (retcode > 0):
-                logger.error("copy_tftp_flash for " + dev_ser_port.serial_port.port + " and " + gos_vm_name 
-                             + " returned non-zero result " + str(retcode) + ".")
-                continue
-        
-        retcode = remove_gos_image(dev_ser_port.serial_port)
+            return None
+    
+    retcode = journaled_step(dev_ser_port, "remove-gos", artifact_version(gos_vm_name), 
+                             remove_gos_image, session)
+    if (retcode > 0):
+        logger.error("remove_gos_image for " + dev_ser_port.serial_port.port + " returned non-zero result " 
+                     + str(retcode) + ".")
+        return None
+             
+    if bundle_name:   
+        retcode = journaled_step(dev_ser_port, "install-bundle", artifact_version(bundle_name), 
+                                 install_bundle, session)
         if (retcode > 0):
-            logger.error("remove_gos_image for " + dev_ser_port.serial_port.port + " returned non-zero result " 
+            logger.error("install_bundle for " + dev_ser_port.serial_port.port + " returned non-zero result " 
                          + str(retcode) + ".")
-            continue
-                 
-        if bundle_name:   
-            retcode = install_bundle(dev_ser_port.serial_port)
-            if (retcode > 0):
-                logger.error("install_bundle for " + dev_ser_port.serial_port.port + " returned non-zero result " 
-                             + str(retcode) + ".")
-                continue
-        
-        if image_name:
-            retcode = set_boot_image(dev_ser_port.serial_port)
-            if (retcode > 0):   
-                logger.error("set_boot_image for " + dev_ser_port.serial_port.port + " returned non-zero result " 
-                             + str(retcode) + ".")
-                continue
-         
-        if gos_vm_name: 
-            retcode = install_gos_image(dev_ser_port.serial_port)
-            if (retcode > 0):
-                logger.error("install_gos_image for " + dev_ser_port.serial_port.port + " returned non-zero result " 
-                             + str(retcode) + ".")
-                continue
-        
-        retcode = set_logging_console(dev_ser_port.serial_port, True)
+            return None
+    
+    if image_name:
+        retcode = journaled_step(dev_ser_port, "set-boot", image_name, set_boot_image, session)
+        if (retcode > 0):   
+            logger.error("set_boot_image for " + dev_ser_port.serial_port.port + " returned non-zero result " 
+                         + str(retcode) + ".")
+            return None
+     
+    if gos_vm_name: 
+        retcode = journaled_step(dev_ser_port, "install-gos", artifact_version(gos_vm_name), 
+                                 install_gos_image, session)
         if (retcode > 0):
-            logger.error("set_logging_console True for " + dev_ser_port.serial_port.port + " returned non-zero result " 
+            logger.error("install_gos_image for " + dev_ser_port.serial_port.port + " returned non-zero result " 
                          + str(retcode) + ".")
-            continue
+            return None
+    
+    retcode = set_logging_console(session, True)
+    if (retcode > 0):
+        logger.error("set_logging_console True for " + dev_ser_port.serial_port.port + " returned non-zero result " 
+                     + str(retcode) + ".")
+        return None
 
-        reload_device(dev_ser_port.serial_port)
-        
-        summary.append("Installed bundles and images for a " + dev_ser_port.device_type + " at " 
-                       + dev_ser_port.serial_port.port + ".\n")
+    reload_device(session)
+    
+    #Everything is done, so the next run starts again, with the copies still
+    #skipped if the files in flash are the same as those in image_dir
+    journal = get_journal()
+    if (journal and dev_ser_port.serial_number):
+        journal.forget(dev_ser_port.serial_number)
+    
+    return ("Installed bundles and images for a " + dev_ser_port.device_type + " at " 
+            + dev_ser_port.serial_port.port + ".\n")
+    
+def install_devices(device_serial_ports):
+    """
+    Start the embedded file server, if there is one, and install the bundle 
+    and images on each of the DeviceSerialPort instances, which can also be
+    a generator, returning the summary lines. The file server only serves
+    image_dir, so none is started, and nothing is installed, unless image_dir
+    is a directory.
+    """
+    file_servers = []
+    if (transfer_backend == "http" or embedded_tftp_server) and not os.path.isdir(image_dir):
+        logger.error("The image directory \"" + image_dir + "\" is not a directory, so not serving it, returning.")
+        return []
+    if (transfer_backend == "http"):
+        file_servers.append(ImageHTTPServer(image_dir, port=http_server_port))
+    elif embedded_tftp_server:
+        file_servers.append(TFTPServer(image_dir, port=tftp_server_port))
+    for file_server in file_servers:
+        file_server.start()
+    
+    try:
+        results = run_on_devices(device_serial_ports, install_device, max_workers, device_log_dir)
+    finally:
+        for file_server in file_servers:
+            file_server.stop()
+            
+    return [result for result in results if result]
+    
+def main(argv=None):
+    
+    #Work starts on each device as soon as it is found
+    summary = install_devices(iter_console_ports(usb_port_base))
              
     logger.info("The summary is:\n")
     for result in summary:
@@ -42,6 +42,7 @@ from __future__ import print_function
 import serial
 import time
 import sys
+import re
 import logging
 from logging.config import fileConfig
 import os
@@ -49,10 +50,97 @@ from pyserial_util.cli_utils import *
 
 usb_port_base = "cu.SLAB_USBtoUART"
 enable_password = "cisco123"
+#How many devices to work on at once, None being all of them, and where to put a
+#log file per device, None being no per device log files.
+max_workers = None
+device_log_dir = None
     
-def main(argv=None):
+boot_image = "ir800-universalk9_npe-mz.SPA.156-2.T"
+
+#The questions that reload asks, and the answers to them, up to the last one.
+RELOAD_ANSWERS = [
+    (re.compile(r"reload the internal AP \? \[yes/no\]:?\s*$"), "yes"),
+    (re.compile(r"save the configuration of the AP\? \[yes/no\]:?\s*$"), "no"),
+    (re.compile(r"Save\? \[yes/no\]:?\s*$"), "no"),
+    (CONFIRM_PROMPT, ""),
+]
+
+def clear_and_reload(dev_ser_port):
+    """
+    Clear the startup configuration of one device and reload it, returning a
+    line for the summary, or None if that could not be done.
+    """
+    serial_port = dev_ser_port.serial_port
+    logger.info("Working with a " + dev_ser_port.device_type + " at " + serial_port.port 
+                + " to clear startup configuration and reload.")
+                
+    if (enable(serial_port, enable_password) > 0):
+        logger.error("enable for " + serial_port.port + " failed, returning.")
+        return None
+
+    restore_console_speed(serial_port)
+
+    index, match, response = send_expect(serial_port, "clear start", [CONFIRM_PROMPT, ENABLE_PROMPT])
+    logger.debug(strip_cr_nl(response))
+    if (index == 0):
+        index, match, response = send_expect(serial_port, "", ENABLE_PROMPT, record=False)
+        logger.debug(strip_cr_nl(response))
+    if (index == -1):
+        logger.error("The response did not end in \"#\" after \"clear start\", which is not OK, returning.")
+        return None
     
-    boot_image = "ir800-universalk9_npe-mz.SPA.156-2.T"
+    patterns = [pattern for pattern, answer in RELOAD_ANSWERS]
+    index, match, response = send_expect(serial_port, "reload", patterns)
+    logger.debug(strip_cr_nl(response))
+    while (index != -1 and patterns[index] is not CONFIRM_PROMPT):
+        index, match, response = send_expect(serial_port, RELOAD_ANSWERS[index][1], patterns, record=False)
+        logger.debug(strip_cr_nl(response))
+    if (index == -1):
+        logger.error("The response did not end in \"[confirm]\" after \"reload\", which is not OK, returning.")
+        return None
+    send_line(serial_port, "")
+            
+    return ("Cleared and reloaded a " + dev_ser_port.device_type + " at " 
+            + serial_port.port + ".\n")
+
+def boot_from_rommon(dev_ser_port):
+    """
+    Wait for one device to get to the rommon-2 prompt after a reload, as soon
+    as it does boot it from boot_image, and wait for it to get to an IOS 
+    prompt, returning a line for the summary, or None if it did not.
+    """
+    #A CLISession, so that the prompts and timeouts are those for the type of device
+    serial_port = CLISession(dev_ser_port)
+    logger.info("Working with a " + dev_ser_port.device_type + " at " + serial_port.port 
+                + " to boot from rommon-2.")
+    
+    mode = wait_for_boot(serial_port, device_setting(serial_port, "reload_timeout", reload_timeout))
+    if (mode == MODE_ROMMON):
+        send_line(serial_port, "boot flash:/" + boot_image)
+        mode = wait_for_boot(serial_port, device_setting(serial_port, "boot_timeout", boot_timeout))
+        if (mode == MODE_ROMMON):
+            logger.error("The device at " + serial_port.port + " did not boot flash:/" + boot_image + ".")
+            return None
+    elif (mode != MODE_UNKNOWN):
+        logger.info("The device at " + serial_port.port + " booted to IOS without stopping at rommon-2.")
+    if (mode == MODE_UNKNOWN):
+        return None
+            
+    return ("Booted from rommon-2 a " + dev_ser_port.device_type + " at " 
+            + serial_port.port + ".\n")
+
+def clear_reload_and_boot(dev_ser_port):
+    """
+    Clear and reload one device, and then boot it from rommon-2, so that each
+    device is booted as soon as it is ready, however long the others take.
+    """
+    cleared = clear_and_reload(dev_ser_port)
+    if not cleared:
+        return None
+    booted = boot_from_rommon(dev_ser_port)
+    return cleared + (booted or "")
+    
+def main(argv=None):
       
     device_serial_ports = get_console_ports(usb_port_base)
     
@@ -61,78 +149,8 @@ def main(argv=None):
         logger.info("Port = " + str(dev_ser_port.serial_port) + " device type = " + 
                     str(dev_ser_port.device_type) + "\n")
     
-    summary = []
-    
-    for dev_ser_port in device_serial_ports:        
-        logger.info("Working with a " + dev_ser_port.device_type + " at " + dev_ser_port.serial_port.port 
-                    + " to clear startup configuration and reload.")
-                    
-        if enable(dev_ser_port.serial_port, enable_password) == 0:
-
-            dev_ser_port.serial_port.write("clear start\r")            
-            time.sleep(1)
-            response = strip_cr_nl(dev_ser_port.serial_port.read(dev_ser_port.serial_port.inWaiting()))
-            logger.debug(response)
-            if "[confirm]" in response:
-                dev_ser_port.serial_port.write("\r")            
-                time.sleep(1)
-                dev_ser_port.serial_port.write("\r")            
-                response = strip_cr_nl(dev_ser_port.serial_port.read(dev_ser_port.serial_port.inWaiting()))
-                logger.debug(response)
-            
-            if response.endswith("#"):
-                dev_ser_port.serial_port.write("reload\r")            
-                time.sleep(1)
-                response = strip_cr_nl(dev_ser_port.serial_port.read(dev_ser_port.serial_port.inWaiting()))
-                logger.debug(response)
-           
-            if "Do you want to reload the internal AP ? [yes/no]:" in response:
-                dev_ser_port.serial_port.write("yes\r")            
-                time.sleep(1)
-                response = strip_cr_nl(dev_ser_port.serial_port.read(dev_ser_port.serial_port.inWaiting()))
-                logger.debug(response)
-                
-            if "Do you want to save the configuration of the AP? [yes/no]" in response:
-                dev_ser_port.serial_port.write("no\r")            
-                time.sleep(1)
-                response = strip_cr_nl(dev_ser_port.serial_port.read(dev_ser_port.serial_port.inWaiting()))
-                logger.debug(response)
-                
-            if "System configuration has been modified. Save? [yes/no]" in response:
-                dev_ser_port.serial_port.write("no\r")            
-                time.sleep(1)
-                response = strip_cr_nl(dev_ser_port.serial_port.read(dev_ser_port.serial_port.inWaiting()))
-                logger.debug(response)
-            
-            if "Proceed with reload? [confirm]" in response:
-                dev_ser_port.serial_port.write("\r")            
-                time.sleep(1)
-                response = strip_cr_nl(dev_ser_port.serial_port.read(dev_ser_port.serial_port.inWaiting()))
-                logger.debug(response)
-                
-        summary.append("Cleared and reloaded a " + dev_ser_port.device_type + " at " 
-                       + dev_ser_port.serial_port.port + ".\n")
-              
-    time.sleep(60)
-    
-    for dev_ser_port in device_serial_ports:        
-        logger.info("Working with a " + dev_ser_port.device_type + " at " + dev_ser_port.serial_port.port 
-                    + " to boot from rommon-2.")
-        
-        while True:
-            dev_ser_port.serial_port.write("\r")            
-            time.sleep(1)
-            response = strip_cr_nl(dev_ser_port.serial_port.read(dev_ser_port.serial_port.inWaiting()))
-            logger.debug(response)
-            if "rommon-2>" in response:
-                dev_ser_port.serial_port.write("boot flash:/" + boot_image + "\r")            
-                time.sleep(1)
-                response = strip_cr_nl(dev_ser_port.serial_port.read(dev_ser_port.serial_port.inWaiting()))
-                logger.debug(response)
-                break
-                
-        summary.append("Booted from rommon-2 a " + dev_ser_port.device_type + " at " 
-                       + dev_ser_port.serial_port.port + ".\n")
+    summary = run_on_devices(device_serial_ports, clear_reload_and_boot, max_workers, device_log_dir)
+    summary = [result for result in summary if result]
              
     logger.info("The summary is:\n")
     for result in summary:
@@ -29,24 +29,260 @@ import serial
 import time
 import logging
 import os
+import re
+import threading
+import atexit
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from logging.config import fileConfig
+from pyserial_util.port_cache import PortCache, get_port_identity
+from pyserial_util.image_hash import ImageHashCache
+from pyserial_util.transfer_progress import TransferProgress
+from pyserial_util.metrics import step, record_read, record_written, current_span
+from pyserial_util.transcript import TranscriptRecorder, TranscriptReplay, transcript_path, to_bytes, to_text
+from pyserial_util.console_reader import ConsoleReader, ConsoleLineLog
+from pyserial_util.console_broker import BrokerSerialPort, broker_console_ports
+from pyserial_util.device_profiles import get_profile, identify_device_type, max_console_speeds, UNKNOWN_DEVICE_TYPE
+from pyserial_util.latency_table import LatencyTable, command_class
 fileConfig('logging_config.ini')
 logger = logging.getLogger()    
 
+#Compiled patterns for the prompts and dialogs seen on the console. The prompt
+#patterns are anchored to the end of the output, as that is where a prompt is
+#when the device is waiting for input.
+ROMMON_PROMPT = re.compile(r"rommon-?\d*\s*>\s*$")
+CONFIG_PROMPT = re.compile(r"\(config[^)]*\)#\s*$")
+ENABLE_PROMPT = re.compile(r"#\s*$")
+USER_PROMPT = re.compile(r">\s*$")
+ANY_PROMPT = re.compile(r"[>#]\s*$")
+PASSWORD_PROMPT = re.compile(r"Password:\s*$")
+MORE_PROMPT = re.compile(r"--More--\s*$")
+CONFIRM_PROMPT = re.compile(r"\[confirm\]\s*$")
+YES_NO_PROMPT = re.compile(r"\[yes/no\]:?\s*$")
+INITIAL_DIALOG_PROMPT = re.compile(r"initial configuration dialog\?|Please answer")
+PRESS_RETURN = re.compile(r"Press RETURN to get started")
+PROMPT_LINE = re.compile(r"([^\r\n]*[>#])\s*$")
+MODE_PROMPT = re.compile(r"(?:^|[\r\n])[\w.:/\-]+(\(config[^)]*\))?([>#])\s*$")
+CONFIG_ERROR = re.compile(r"%\s*(?:Invalid|Incomplete|Ambiguous)[^\r\n]*")
+BOARD_ID = re.compile(r"Processor board ID (\S+)")
+#The serial number is the SN column of the first row of the Device table, as
+#"Processor board ID" comes before the table, so is not in the output from it
+DEVICE_TABLE_SN = re.compile(r"Device\s+PID\s+VID\s+SN[ \t]*[\r\n]+[ \t]*\S+[ \t]+\S+[ \t]+\S+[ \t]+(\S+)")
+DESTINATION_FILENAME = re.compile(r"Destination filename")
+MD5_HASH = re.compile(r"=\s*([0-9a-fA-F]{32})")
+
+#The start of the "!" comment lines that are sent after each block of 
+#configuration lines and each command of a batch, to find where the output for
+#them ends, which IOS echoes and otherwise ignores, so they cannot fail.
+MARKER = "!pyserial-util-mark-"
+
+#The CLI modes that a device can be in, as far as these utilities are concerned.
+MODE_UNKNOWN = "unknown"
+MODE_ROMMON = "rommon"
+MODE_USER = "user"
+MODE_ENABLE = "enable"
+MODE_CONFIG = "config"
+
+#How long, in seconds, to wait for the device to respond. Most responses take
+#milliseconds, so these are deadlines rather than delays. These are for any 
+#device, and the profile of a type of device in device_profiles.py can have 
+#its own.
+prompt_timeout = 10
+dialog_timeout = 120
+copy_timeout = 1800
+install_timeout = 1800
+verify_timeout = 600
+reload_timeout = 600
+boot_timeout = 900
+poll_interval = 0.05
+
+#How long, in seconds, a device that is reloading or booting can be quiet before
+#return is pressed, in case the prompt it is waiting at has been missed.
+boot_poke_interval = 10
+
+#How long, in seconds, a copy can make no progress before it is given up on.
+#Set stall_timeout to None to wait for copy_timeout whatever happens.
+stall_timeout = 120
+
+#The IOS escape sequence, Ctrl-Shift-6, which stops a copy that is running.
+ESCAPE_SEQUENCE = "\x1e"
+
+#The speed, in bits per second, of the consoles when the devices are found. Set
+#console_speed_upgrade to True to raise the speed of each console, once the
+#device is in enable mode, to the highest that its type supports, from its
+#profile in device_profiles.py, and console_speed_restore to True to put it 
+#back to default_console_speed before the configuration is saved for the last
+#time or the device is reloaded, so that it can be found again at that speed.
+default_console_speed = 9600
+console_speed_upgrade = False
+console_speed_restore = True
+#How long, in seconds, to give a device to change the speed of its console.
+speed_change_timeout = 2
+
+#Where to look for the console ports, which is somewhere else when they are 
+#simulated, as with ios_simulator.py.
+console_dev_dir = "/dev/"
+
+#A file listing more consoles to use, alongside those under console_dev_dir, one
+#to a line, as paths or as pySerial URLs, such as socket://host:port for a raw
+#TCP line on a terminal server, or rfc2217://host:port for an RFC 2217 one. 
+#Lines starting with "#" are comments. None is no such file.
+console_inventory_file = None
+
+#The socket of a console_broker.py that has the consoles open already, to use
+#the devices through it rather than finding them here, or None to not.
+console_broker_socket = None
+
+#The ports, or serial numbers, of the devices of the broker to use, or None to
+#use all of those that are not in use already.
+console_broker_devices = None
+
+#How many devices to work on at once when that cannot be known in advance.
+default_max_workers = 32
+
+#Where to remember which device is on which port between runs, and for how long,
+#in seconds, to trust that. Set port_cache_file to None to always identify the
+#devices with "show hardware".
+port_cache_file = os.path.join(os.path.expanduser("~"), ".pyserial_util", "port_cache.json")
+port_cache_ttl = 24 * 60 * 60
+
+#Where to record a transcript of everything written to and read from each 
+#console, or None to not record them. See transcript.py.
+transcript_dir = None
+
+#Set background_readers to True to read each console all of the time in the 
+#background, as in console_reader.py, so that nothing the device sends between
+#commands is lost, and console_line_log_dir to somewhere to write a log of every
+#line from each console, with the time it arrived.
+background_readers = False
+console_line_log_dir = None
+
+#The facts that gather_facts() gets from each device in one batch, by name.
+fact_commands = [("hostname", "show running-config | include ^hostname"),
+                 ("flash", "dir flash:"),
+                 ("version", "show version"),
+                 ("iox", "show iox")]
+
+#Where to keep the MD5 hashes of the local copies of images between runs.
+image_hash_file = os.path.join(os.path.expanduser("~"), ".pyserial_util", "image_hashes.json")
+
+#Where to keep how long each type of device takes to answer each class of 
+#command between runs, as described in latency_table.py, or None to not. The
+#waits that are usually for nothing, such as for a prompt at the wrong console
+#speed, are cut to the 99th percentile of those times latency_safety_factor, 
+#but to no less than latency_min_deadline, once there are latency_min_samples 
+#of them.
+latency_file = os.path.join(os.path.expanduser("~"), ".pyserial_util", "latencies.json")
+latency_safety_factor = 3
+latency_min_samples = 20
+latency_min_deadline = 0.5
+
+_image_hash_cache = None
+_image_hash_cache_lock = threading.Lock()
+_latency_table = None
+_latency_table_lock = threading.Lock()
+_marker_counts = {}
+_marker_counts_lock = threading.Lock()
+
+
+class TextSerialPort:
+    """
+    A TextSerialPort wraps a serial port opened with pySerial, and can be used
+    in place of it, writing and reading str, with each byte as the character
+    of the same code. This is what the scripts write and read, and what 
+    pySerial takes and gives on Python 2, but on Python 3 it only takes and
+    gives bytes.
+    """
+    serial_port = None
+    port = ""
+    
+    def __init__(self, serial_port):
+        self.serial_port = serial_port
+        self.port = serial_port.port
+        
+    def write(self, data):
+        return self.serial_port.write(to_bytes(data))
+    
+    def read(self, size=1):
+        return to_text(self.serial_port.read(size))
+    
+    def inWaiting(self):
+        return self.serial_port.inWaiting()
+    
+    def isOpen(self):
+        return self.serial_port.isOpen()
+    
+    def close(self):
+        self.serial_port.close()
+        
+    def __getattr__(self, name):
+        #Anything else, such as the baud rate, is that of the serial port
+        return getattr(self.serial_port, name)
 
 class DeviceSerialPort:
     serial_port = ""
     device_type = ""
+    serial_number = ""
     
-    def __init__(self, serial_port, device_type):
+    def __init__(self, serial_port, device_type, serial_number=""):
         self.serial_port = serial_port
         self.device_type = device_type
+        self.serial_number = serial_number
+
+class CLISession:
+    """
+    A CLISession wraps a DeviceSerialPort and can be used in place of the
+    serial port with all of the functions here. It keeps track of the CLI mode
+    the device is in from the prompt at the end of everything read, so that
+    the functions only have to press return to find the mode when it is not
+    already known. Anything written makes the mode unknown until the next 
+    prompt is read.
+    
+    The facts from gather_facts() are kept in facts, by name, until they are
+    out of date.
+    """
+    dev_ser_port = None
+    serial_port = None
+    port = ""
+    device_type = ""
+    mode = MODE_UNKNOWN
+    facts = None
+    markers = 0
+    
+    def __init__(self, dev_ser_port):
+        self.dev_ser_port = dev_ser_port
+        self.serial_port = dev_ser_port.serial_port
+        self.port = dev_ser_port.serial_port.port
+        self.device_type = dev_ser_port.device_type
+        self.mode = MODE_UNKNOWN
+        self.facts = {}
+        self.markers = 0
+        self._tail = ""
+        
+    def write(self, data):
+        self.mode = MODE_UNKNOWN
+        self._tail = ""
+        return self.serial_port.write(data)
+    
+    def read(self, size=1):
+        data = self.serial_port.read(size)
+        if data:
+            #Only the end of the output matters for finding the prompt
+            self._tail = (self._tail + data)[-256:]
+            self.mode = get_mode_from_response(self._tail)
+        return data
+    
+    def inWaiting(self):
+        return self.serial_port.inWaiting()
+    
+    def close(self):
+        self.mode = MODE_UNKNOWN
+        self.serial_port.close()
 
 def get_console_ports(usb_port_base):
     """
     The console ports are assumed to be available under /dev/ on Linux and OS X
-    type systems. The format of the name is defined by the usb_port_base variable
+    type systems, or under console_dev_dir if that is set to somewhere else. The format of the name is defined by the usb_port_base variable
     plus a number, up to however many there are connected.
 
     In practice, not all console ports that appear when looking under /dev/
@@ -54,257 +290,1142 @@ def get_console_ports(usb_port_base):
     clear how to tell, apart from poking to see what happens.
     
     The result is a list of DeviceSerialPort instances that do seem to
-    have a device connected.
+    have a device connected. See iter_console_ports() to start work on each
+    device as soon as it is found.
     """
+    return list(iter_console_ports(usb_port_base))
+
+def iter_console_ports(usb_port_base, max_workers=None):
+    """
+    Probe all of the possible console ports at the same time, as described for
+    get_console_ports(), yielding a DeviceSerialPort for each port that has a
+    device connected as soon as its probe finishes. The default is to probe
+    all of the ports at once. If console_broker_socket is set, the devices of
+    the broker in console_broker_devices that are not in use are yielded
+    instead, with no probing.
+    """
+    if console_broker_socket:
+        for dev_ser_port in broker_console_ports(console_broker_socket, console_broker_devices):
+            yield dev_ser_port
+        return
+
     possible_usb_ports_names = []
-    for filename in os.listdir("/dev/"):
+    for filename in os.listdir(console_dev_dir):
         logger.debug(filename)
         if (usb_port_base in filename):
             possible_usb_ports_names.append(filename)
             
     logger.info("Possible USB port names are: " + str(possible_usb_ports_names))
     
-    possible_usb_ser_ports = []
-    for port_name in possible_usb_ports_names:
+    port_paths = [os.path.join(console_dev_dir, port_name) for port_name in possible_usb_ports_names]
+    if console_inventory_file:
+        inventory = read_console_inventory(console_inventory_file)
+        logger.info("The consoles in " + console_inventory_file + " are: " + str(inventory))
+        port_paths += inventory
+    
+    if not port_paths:
+        return
+    
+    if not max_workers:
+        max_workers = len(port_paths)
+        
+    port_cache = None
+    if port_cache_file:
+        port_cache = PortCache(port_cache_file, port_cache_ttl)
+        
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(probe_console_port, port_path, port_cache) for port_path in port_paths]
+        for future in as_completed(futures):
+            dev_ser_port = future.result()
+            if dev_ser_port:
+                yield dev_ser_port
+
+def read_console_inventory(inventory_file):
+    """
+    The paths and URLs of the consoles listed in inventory_file, as described 
+    for console_inventory_file.
+    """
+    try:
+        with open(inventory_file) as f:
+            lines = [line.strip() for line in f]
+    except (IOError, OSError) as e:
+        logger.error("Could not read the console inventory " + inventory_file + " - %s" % e)
+        return []
+    return [line for line in lines if line and not line.startswith("#")]
+
+def replay_console_ports(transcript_paths, speed=1.0, max_workers=None):
+    """
+    The same as iter_console_ports(), but with the consoles replayed from the
+    transcripts at transcript_paths, at the given speed, as in transcript.py.
+    """
+    if not transcript_paths:
+        return
+    
+    replays = [TranscriptReplay(path, speed) for path in transcript_paths]
+    with ThreadPoolExecutor(max_workers=max_workers or len(replays)) as executor:
+        futures = [executor.submit(probe_console_port, replay.port, None, replay) for replay in replays]
+        for future in as_completed(futures):
+            dev_ser_port = future.result()
+            if dev_ser_port:
+                yield dev_ser_port
+
+def note_device(serial_port, device_type, serial_number):
+    """
+    Add the device type and serial number to the transcript of the console,
+    if it is being recorded.
+    """
+    if isinstance(serial_port, ConsoleReader):
+        serial_port = serial_port.serial_port
+    if isinstance(serial_port, TranscriptRecorder):
+        serial_port.note({"device_type": device_type, "serial_number": serial_number})
+
+@step
+def probe_console_port(port_path, port_cache=None, serial_port=None):
+    """
+    Open the serial port at port_path, which can also be a pySerial URL for a
+    console on a terminal server, and poke it to see if there is a device
+    connected, getting the device past the initial configuration dialog if
+    need be, and then find out what type of device it is. If serial_port is
+    given, it is used rather than opening the port, as when replaying a 
+    transcript.
+    
+    If there is a port_cache, and it has an entry for the port that matches
+    the prompt the device shows, the device type and serial number are taken
+    from the cache rather than asking the device.
+    
+    The result is a DeviceSerialPort, or None if there is no usable device, in 
+    which case the serial port is closed again.
+    """
+    threading.current_thread().name = os.path.basename(port_path)
+    
+    if serial_port is None:
         try:
-            possible_usb_ser_ports.append(serial.Serial("/dev/" + port_name,
-                                baudrate = 9600,
-                                bytesize = serial.EIGHTBITS,
-                                parity = serial.PARITY_NONE,
-                                stopbits = serial.STOPBITS_ONE))
+            #serial_for_url() opens local ports as serial.Serial() does, and other
+            #transports can be added with pySerial's protocol_handler_packages
+            serial_port = TextSerialPort(serial.serial_for_url(port_path,
+                                                               baudrate = default_console_speed,
+                                                               bytesize = serial.EIGHTBITS,
+                                                               parity = serial.PARITY_NONE,
+                                                               stopbits = serial.STOPBITS_ONE))
+        except (serial.SerialException, ValueError) as e:
+            logger.error("Port " + port_path + " not available - %s" % e)
+            return None
         
-        except serial.SerialException as e:
-            logger.error("Port " + port_name + " not available - %s" % e)
-            continue
+        if transcript_dir:
+            serial_port = TranscriptRecorder(serial_port, transcript_path(transcript_dir, port_path))
         
-    device_serial_ports = []
-    for serial_port in possible_usb_ser_ports:
-        if serial_port.isOpen():
-            serial_port.write("\r")
-            time.sleep(3)
-            response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-            logger.info(response)
-            if (not response):
-                logger.debug("The response was empty so " + serial_port.port +" seems not to be connected to a device.")
-                continue
-            elif ("rommon-2>" in response):
-                logger.error("The response contained \"rommon-2>\", so the device at " + serial_port.port +" needs to be booted to IOS with the command: \"boot flash:/<Image Name>\".")
-                continue
-                #TODO code for rommon-2 boot
-            elif ("initial configuration dialog?" in response):
-                logger.debug("We have the initial configuration dialog prompt, so it looks like " + serial_port.port + " is connected to a device.")
-                serial_port.write("no\r")
-                while True:                        
-                    serial_port.write("\r")
-                    time.sleep(5
-                               )
-                    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-                    logger.debug("The response is " + response + " after initial configuration dialog.")
-                    if response.endswith(">") or response.endswith("#"):
-                        logger.info("Back to > or # prompt, carrying on.")
-                        break
-            elif ("Please answer" in response):
-                logger.debug("We have the initial configuration dialog prompt, so it looks like " + serial_port.port + " is connected to a device.")
-                serial_port.write("no\r")
-                while True:                        
-                    serial_port.write("\r")
-                    time.sleep(5
-                               )
-                    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-                    logger.debug("The response is " + response + " after initial configuration dialog.")
-                    if response.endswith(">") or response.endswith("#"):
-                        logger.info("Back to > or # prompt, carrying on.")
-                        break
-            elif (response.endswith(">") or response.endswith("#")):
-                logger.debug("We have a prompt, so it looks like " + serial_port.port + " is connected to a device.")
-                if "config" in response:
-                    serial_port.write("end\r")
-                    time.sleep(1)
+        #pySerial only says whether there is anything waiting on a network console,
+        #rather than how much, so those are always read in the background
+        if background_readers or "://" in port_path:
+            serial_port = ConsoleReader(serial_port)
+            if console_line_log_dir:
+                serial_port.subscribe(ConsoleLineLog(os.path.join(console_line_log_dir, 
+                                                                  os.path.basename(port_path) + ".log")))
+    
+    try:
+        if not serial_port.isOpen():
+            return None
         
-            serial_port.write("show hardware | begin Device\r")
-            time.sleep(3)
-            response = serial_port.read(serial_port.inWaiting())
-            logger.debug("The response is " + response + " when checking device type.")
-            #TODO This regexsy type thing here will need attention
-            device_type = "unknown"
-            if ("IR829GW-LTE-GA-EK9" in response):
-                device_type = "IR829GW-LTE-GA-EK9"
-            elif  ("IR809G-LTE-GA-K9" in response):
-                device_type = "IR809G-LTE-GA-K9"
-            else:
-                logger.error("We have an unknown device type.")
-                
-            device_serial_ports.append(DeviceSerialPort(serial_port, device_type))
-            while True:
-                serial_port.write("\r")
-                time.sleep(1)
-                response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-                logger.debug("The response is " + response + " after checking device type.")
-                if response.endswith(">") or response.endswith("#"):
+        index, match, response = send_expect(serial_port, "", 
+                                             [ROMMON_PROMPT, INITIAL_DIALOG_PROMPT, ANY_PROMPT], 
+                                             learned_timeout(serial_port, "", 3))
+        logger.info(strip_cr_nl(response))
+        if (index == -1 and response and console_speed_upgrade):
+            #The console may have been left at a higher speed, as when a run stopped part way
+            index, match, response = find_console_speed(serial_port, response)
+        if (not response):
+            logger.debug("The response was empty so " + serial_port.port +" seems not to be connected to a device.")
+            serial_port.close()
+            return None
+        elif (index == 0):
+            logger.error("The response contained \"rommon-2>\", so the device at " + serial_port.port +" needs to be booted to IOS with the command: \"boot flash:/<Image Name>\".")
+            serial_port.close()
+            return None
+            #TODO code for rommon-2 boot
+        elif (index == 1):
+            logger.debug("We have the initial configuration dialog prompt, so it looks like " + serial_port.port + " is connected to a device.")
+            send_raw(serial_port, "no\r")
+            deadline = time.time() + dialog_timeout
+            while time.time() < deadline:
+                #Not recorded, as the device may still be leaving the dialog
+                index, match, response = send_expect(serial_port, "", ANY_PROMPT, 
+                                                     learned_timeout(serial_port, "", 5), record=False)
+                logger.debug("The response is " + strip_cr_nl(response) + " after initial configuration dialog.")
+                if (index == 0):
                     logger.info("Back to > or # prompt, carrying on.")
                     break
-                
-    return device_serial_ports
+        elif (index == 2):
+            logger.debug("We have a prompt, so it looks like " + serial_port.port + " is connected to a device.")
+            if CONFIG_PROMPT.search(response):
+                index, match, response = send_expect(serial_port, "end", ANY_PROMPT)
+            if port_cache:
+                entry = port_cache.lookup(get_port_identity(port_path), get_prompt(response))
+                if entry:
+                    logger.info("Using the cached device type " + entry["device_type"] + " for " + port_path + ".")
+                    note_device(serial_port, entry["device_type"], entry["serial_number"])
+                    return DeviceSerialPort(serial_port, entry["device_type"], entry["serial_number"])
+        else:
+            logger.debug("The response " + strip_cr_nl(response) + " from " + serial_port.port 
+                         + " did not contain a prompt, trying anyway.")
+    
+        response = read_show_output(serial_port, "show hardware | begin Device")
+        logger.debug("The response is " + response + " when checking device type.")
+        device_type = identify_device_type(response)
+        if (device_type == UNKNOWN_DEVICE_TYPE):
+            logger.error("We have an unknown device type.")
+            
+        serial_number = ""
+        match = DEVICE_TABLE_SN.search(response) or BOARD_ID.search(response)
+        if match:
+            serial_number = match.group(1)
+            
+        if port_cache and device_type != UNKNOWN_DEVICE_TYPE:
+            port_cache.put(get_port_identity(port_path), device_type, serial_number, get_prompt(response))
+            
+        note_device(serial_port, device_type, serial_number)
+        return DeviceSerialPort(serial_port, device_type, serial_number)
+    
+    except (serial.SerialException, OSError) as e:
+        logger.error("Probing " + port_path + " failed - %s" % e)
+        serial_port.close()
+        return None
+
+def find_console_speed(serial_port, response):
+    """
+    Look for a prompt at each of the highest speeds of the device types in turn,
+    leaving the serial port at the first speed there is one at, or at 
+    default_console_speed if there is none. The result is the same as from
+    expect(), with response as the response if there is no prompt.
+    """
+    for speed in sorted(set(max_console_speeds().values())):
+        get_serial(serial_port).baudrate = speed
+        index, match, speed_response = send_expect(serial_port, "", 
+                                                   [ROMMON_PROMPT, INITIAL_DIALOG_PROMPT, ANY_PROMPT], 
+                                                   learned_timeout(serial_port, "", 3))
+        if (index != -1):
+            logger.info("Found a prompt on " + serial_port.port + " at " + str(speed) + " rather than " 
+                        + str(default_console_speed) + ".")
+            return index, match, speed_response
+    
+    get_serial(serial_port).baudrate = default_console_speed
+    return -1, None, response
+
+def run_on_devices(device_serial_ports, device_function, max_workers=None, log_dir=None):
+    """
+    Run device_function against each of the DeviceSerialPort instances, with
+    up to max_workers devices being worked on at the same time. Each device is
+    on its own console, so there is nothing shared between them. The default
+    is to work on all of the devices at once, and max_workers = 1 gives the
+    original one device after the other behaviour.
+    
+    Each device is worked on in a thread named after its port, which appears in 
+    the log lines. If log_dir is given, the log lines for each device are also 
+    written to a file of their own there.
+    
+    The device_serial_ports can also be a generator, such as iter_console_ports(),
+    in which case work starts on each device as soon as it is found. 
+    
+    The result is a list of whatever device_function returned for each device,
+    in the same order as device_serial_ports, with None for a device where
+    device_function raised an exception.
+    """
+    if not max_workers:
+        try:
+            max_workers = len(device_serial_ports)
+        except TypeError:
+            max_workers = default_max_workers
+        if not max_workers:
+            return []
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_run_on_device, dev_ser_port, device_function, log_dir) 
+                   for dev_ser_port in device_serial_ports]
+        
+    return [future.result() for future in futures]
+
+class _ThreadNameFilter(logging.Filter):
+    
+    def __init__(self, thread_name):
+        logging.Filter.__init__(self)
+        self.thread_name = thread_name
+        
+    def filter(self, record):
+        return record.threadName == self.thread_name
+
+def _run_on_device(dev_ser_port, device_function, log_dir):
+    thread_name = os.path.basename(dev_ser_port.serial_port.port)
+    threading.current_thread().name = thread_name
+    
+    handler = None
+    if log_dir:
+        handler = logging.FileHandler(os.path.join(log_dir, thread_name + ".log"))
+        handler.addFilter(_ThreadNameFilter(thread_name))
+        if logger.handlers:
+            handler.setFormatter(logger.handlers[0].formatter)
+        logger.addHandler(handler)
+        
+    try:
+        return device_function(dev_ser_port)
+    except Exception as e:
+        logger.error("Working with " + dev_ser_port.serial_port.port + " failed - %s" % e)
+        return None
+    finally:
+        if handler:
+            logger.removeHandler(handler)
+            handler.close()
+
+def expect(serial_port, patterns, timeout=None, response=""):
+    """
+    Read from the serial port until one of the patterns matches the output
+    read so far, or until timeout seconds have passed.
+    
+    The patterns are either a single compiled regular expression or a list of
+    them, which are tried in order. The result is a tuple of the index of the
+    pattern that matched, the match object and the output that was read. On a 
+    timeout the index is -1 and the match is None.
+    
+    The timeout defaults to prompt_timeout, or that of the profile for the type
+    of the device if the serial port is a CLISession or DeviceSerialPort. The
+    response is any output read already, as when carrying on after a timeout,
+    which the patterns are tried against along with what is read.
+    """
+    if timeout is None:
+        timeout = device_setting(serial_port, "prompt_timeout", prompt_timeout)
+    if not isinstance(patterns, (list, tuple)):
+        patterns = [patterns]
+    
+    deadline = time.time() + timeout
+    while True:
+        waiting = serial_port.inWaiting()
+        if waiting:
+            response += serial_port.read(waiting)
+            record_read(waiting)
+            for index, pattern in enumerate(patterns):
+                match = pattern.search(response)
+                if match:
+                    return index, match, response
+        if time.time() >= deadline:
+            logger.debug("Timed out after " + str(timeout) + " seconds waiting on " + serial_port.port 
+                         + ", the response was " + strip_cr_nl(response) + ".")
+            return -1, None, response
+        if not waiting:
+            wait_for_output(serial_port, poll_interval)
+
+def wait_for_output(serial_port, timeout):
+    """
+    Wait for up to timeout seconds for more output, which is only until it
+    arrives if the serial port is being read in the background.
+    """
+    if isinstance(serial_port, CLISession):
+        serial_port = serial_port.serial_port
+    if isinstance(serial_port, (ConsoleReader, BrokerSerialPort)):
+        serial_port.wait(timeout)
+    else:
+        time.sleep(timeout)
+
+def send_line(serial_port, line):
+    """
+    Discard anything already waiting on the serial port, so that old output
+    cannot satisfy the next expect(), then send the line with a carriage return.
+    """
+    waiting = serial_port.inWaiting()
+    if waiting:
+        logger.debug("Discarding " + strip_cr_nl(serial_port.read(waiting)) + " before sending " + line + ".")
+        record_read(waiting)
+    send_raw(serial_port, line + "\r")
+
+def send_raw(serial_port, data):
+    """
+    Send data as it is, without a carriage return.
+    """
+    serial_port.write(data)
+    record_written(len(data))
+
+@step
+def send_expect(serial_port, line, patterns, timeout=None, record=True):
+    """
+    Send a line and then expect() one of the patterns in the response. An
+    empty line is the equivalent of pressing return to see the prompt.
+    
+    The timeout defaults to the deadline for the line from learned_timeout(),
+    and the time the answer took is kept in the latency table. If the learned
+    deadline passes, the device may just be slower than it has been, so the
+    wait carries on for as long as prompt_timeout before giving up, and the
+    time is kept either way, so that the deadline grows for a device that has
+    become slow. Lines that are not commands, such as a filename given at a
+    copy prompt, or a return to confirm, are sent with record = False, so that
+    none of this is done for them.
+    """
+    default_timeout = None
+    if (record and timeout is None):
+        default_timeout = device_setting(serial_port, "prompt_timeout", prompt_timeout)
+        timeout = learned_timeout(serial_port, line, default_timeout)
+    send_line(serial_port, line)
+    sent = time.time()
+    index, match, response = expect(serial_port, patterns, timeout)
+    slow = (index == -1 and default_timeout is not None and timeout < default_timeout)
+    if slow:
+        logger.debug("No answer to \"" + line + "\" within the learned " + str(timeout) + " secs, waiting for up to " 
+                     + str(default_timeout) + ".")
+        index, match, response = expect(serial_port, patterns, default_timeout - timeout, response)
+    if (record and (index != -1 or slow)):
+        latency_table = get_latency_table()
+        if latency_table:
+            latency_table.record(get_device_type(serial_port), command_class(line), time.time() - sent)
+    return index, match, response
+
+def get_device_type(serial_port):
+    """
+    The type of the device on serial_port, from the CLISession or 
+    DeviceSerialPort, or from the step it is being worked with in if it is 
+    the serial port itself.
+    """
+    device_type = getattr(serial_port, "device_type", None)
+    if not device_type:
+        span = current_span()
+        device_type = span.device_type if span else None
+    return device_type or UNKNOWN_DEVICE_TYPE
+
+def get_latency_table():
+    """
+    The LatencyTable for latency_file, which is saved when the scripts finish,
+    or None if latency_file is None.
+    """
+    global _latency_table
+    with _latency_table_lock:
+        if not latency_file:
+            return None
+        if _latency_table is None or _latency_table.latency_file != latency_file:
+            if _latency_table:
+                _latency_table.save()
+            _latency_table = LatencyTable(latency_file)
+        return _latency_table
+
+def save_latency_table():
+    with _latency_table_lock:
+        if _latency_table:
+            _latency_table.save()
+
+atexit.register(save_latency_table)
+
+def learned_timeout(serial_port, line, default):
+    """
+    How long to wait for the answer to line on the device on serial_port, from
+    the latency table, or default if there is no table, or not enough in it.
+    """
+    latency_table = get_latency_table()
+    if not latency_table:
+        return default
+    return latency_table.deadline(get_device_type(serial_port), command_class(line), default, 
+                                  latency_safety_factor, latency_min_samples, latency_min_deadline)
+
+@step
+def send_config_lines(serial_port, lines, block_size, timeout=None):
+    """
+    Send lines to the device in blocks of block_size lines. Each block ends with
+    a marker, and the device has to echo the marker and show a prompt again
+    before the next block is sent, so that the input buffer of the device does
+    not overflow, and so that none of the output for the block is left unread.
+    
+    The output for all of the lines is then checked for errors in one pass,
+    and each error is put down to the line echoed before it. The result is a
+    tuple of a return code, which is 1 if the device did not get back to a "#"
+    prompt after each block, a list of (line, error) tuples and the output.
+    """
+    output = ""
+    for start in range(0, len(lines), block_size):
+        block = lines[start:start + block_size]
+        marker = next_marker(serial_port)
+        send_line(serial_port, "\r".join(block + [marker]))
+        index, match, response = expect(serial_port, marker_echoed(marker), timeout)
+        output += response
+        if (index != 0 or not ENABLE_PROMPT.search(response)):
+            return 1, find_config_errors(lines, output), output
+        
+    return 0, find_config_errors(lines, output), output
+
+def next_marker(serial_port):
+    """
+    A new MARKER line for serial_port. The markers are numbered for each 
+    CLISession, or for each port otherwise, rather than being random, so that
+    a run sends the same markers each time, as a replay of its transcript 
+    needs.
+    """
+    if isinstance(serial_port, CLISession):
+        serial_port.markers += 1
+        count = serial_port.markers
+    else:
+        with _marker_counts_lock:
+            count = _marker_counts[serial_port.port] = _marker_counts.get(serial_port.port, 0) + 1
+    return MARKER + str(count)
+
+def marker_echoed(marker):
+    """
+    The pattern for the echo of marker followed by a prompt.
+    """
+    return re.compile(re.escape(marker) + r"\s*[\r\n][^\r\n]*[>#]\s*$")
+
+def find_config_errors(lines, output):
+    """
+    Find the errors, such as "% Invalid input detected", in the output from
+    sending the lines, and put each one down to the last line that was echoed
+    before it. The result is a list of (line, error) tuples.
+    """
+    echoes = []
+    position = 0
+    for line in lines:
+        found = output.find(line.strip(), position)
+        if (found != -1):
+            echoes.append((found, line))
+            position = found + len(line.strip())
+    
+    errors = []
+    for error in CONFIG_ERROR.finditer(output):
+        error_line = ""
+        for found, line in echoes:
+            if (found > error.start()):
+                break
+            error_line = line
+        errors.append((error_line, error.group(0).strip()))
+        
+    return errors
+
+@step
+def read_show_output(serial_port, command, timeout=None):
+    """
+    Send a show command and collect all of its output up to the next prompt,
+    paging through any "--More--" prompts along the way.
+    """
+    output = ""
+    index, match, response = send_expect(serial_port, command, [ANY_PROMPT, MORE_PROMPT], timeout)
+    output += response
+    while (index == 1):
+        send_raw(serial_port, " ")
+        index, match, response = expect(serial_port, [ANY_PROMPT, MORE_PROMPT], timeout)
+        output += response
+        
+    return output
+
+@step
+def run_batch(serial_port, commands, timeout=None):
+    """
+    Send all of the commands at once, each followed by a "!" comment line with
+    a marker of its own, and collect the output of all of them in one go, so
+    that they take one round trip rather than one each. The commands have to
+    be exec commands that do not ask anything, such as show commands, and
+    "terminal length 0" is sent first so that there is no --More-- prompt to
+    swallow the commands after it.
+    
+    The result is a list of the output of each command, from its echo to the
+    prompt after it, as from read_show_output(), split on the echoed markers, 
+    or None if the output of all of them was not read within timeout seconds,
+    which defaults to prompt_timeout for each command.
+    """
+    if not commands:
+        return []
+    marker = next_marker(serial_port)
+    markers = [marker + "-" + str(index) for index in range(len(commands))]
+    lines = ["terminal length 0"]
+    for command, marker in zip(commands, markers):
+        lines += [command, marker]
+    if timeout is None:
+        timeout = device_setting(serial_port, "prompt_timeout", prompt_timeout) * len(commands)
+        
+    send_line(serial_port, "\r".join(lines))
+    index, match, response = expect(serial_port, marker_echoed(markers[-1]), timeout)
+    if (index == -1):
+        logger.error("Not all of the output of the batch " + str(commands) + " arrived within " + str(timeout) 
+                     + " secs.")
+        return None
+    
+    outputs = []
+    position = response.find("terminal length 0")
+    for command, marker in zip(commands, markers):
+        #Followed by white space, as the marker for one command can be the start of that of another
+        end = re.compile(re.escape(marker) + r"\s").search(response, position).start()
+        start = response.find(command, position, end)
+        outputs.append(response[position if start == -1 else start:end])
+        position = end + len(marker)
+    return outputs
+
+def gather_facts(serial_port):
+    """
+    Get the output of each of the fact_commands from the device in one batch,
+    keeping it in the facts of the CLISession, and returning it, by the name
+    of the fact, or None if the batch failed.
+    """
+    if not exec_mode(serial_port):
+        logger.error("The response did not end in \"#\", so probably not in enable mode, returning.")
+        return None
+    outputs = run_batch(serial_port, [command for name, command in fact_commands])
+    if outputs is None:
+        return None
+    facts = dict((name, output) for (name, command), output in zip(fact_commands, outputs))
+    if isinstance(serial_port, CLISession):
+        serial_port.facts.update(facts)
+    return facts
+
+def get_fact(serial_port, name):
+    """
+    The fact called name from the last gather_facts() on the CLISession, or 
+    None if there is none.
+    """
+    return (getattr(serial_port, "facts", None) or {}).get(name)
+
+def forget_fact(serial_port, name):
+    """
+    Forget the fact called name, as when it is out of date.
+    """
+    facts = getattr(serial_port, "facts", None)
+    if facts:
+        facts.pop(name, None)
+
+def confirm_serial_number(dev_ser_port, serial_port):
+    """
+    The serial number that the device gives for itself, as the "Processor 
+    board ID" in "show version", from the version fact of serial_port, the
+    CLISession for dev_ser_port, if it has been gathered, or "" if there is
+    none. 
+    
+    The serial number of dev_ser_port can be from the port cache, which cannot
+    tell that the device on a port has been swapped for one with the same host
+    name, so if it is not the same, dev_ser_port is given the right one and
+    the cache entry for the port is removed.
+    """
+    response = get_fact(serial_port, "version")
+    if response is None:
+        response = read_show_output(serial_port, "show version")
+    match = BOARD_ID.search(response)
+    serial_number = match.group(1) if match else ""
+    if (serial_number != dev_ser_port.serial_number):
+        logger.info("The device at " + dev_ser_port.serial_port.port + " has the serial number \"" + serial_number 
+                    + "\", not \"" + dev_ser_port.serial_number + "\", so going by that.")
+        if (serial_number and port_cache_file):
+            PortCache(port_cache_file, port_cache_ttl).invalidate(get_port_identity(dev_ser_port.serial_port.port))
+        dev_ser_port.serial_number = serial_number
+    return serial_number
+            
+@step
+def get_mode(serial_port):
+    """
+    The CLI mode the device is in. If serial_port is a CLISession that knows
+    the mode already, that is the result, otherwise the result is from the 
+    prompt shown after pressing return.
+    """
+    mode = getattr(serial_port, "mode", MODE_UNKNOWN)
+    if mode != MODE_UNKNOWN:
+        return mode
+    
+    index, match, response = send_expect(serial_port, "", [ROMMON_PROMPT, ANY_PROMPT])
+    logger.debug(strip_cr_nl(response))
+    return get_mode_from_response(response)
+
+def get_mode_from_response(response):
+    """
+    The CLI mode given by the prompt at the end of the response, or 
+    MODE_UNKNOWN if the response does not end in a prompt.
+    """
+    if ROMMON_PROMPT.search(response):
+        return MODE_ROMMON
+    match = MODE_PROMPT.search(response)
+    if not match:
+        return MODE_UNKNOWN
+    if match.group(1):
+        return MODE_CONFIG
+    if match.group(2) == "#":
+        return MODE_ENABLE
+    return MODE_USER
+
+@step
+def exec_mode(serial_port):
+    """
+    Get the device to the privileged exec "#" prompt, leaving configuration
+    mode if need be. The result is True if the device is there.
+    """
+    mode = get_mode(serial_port)
+    if mode == MODE_CONFIG:
+        index, match, response = send_expect(serial_port, "end", ENABLE_PROMPT)
+        logger.debug(strip_cr_nl(response))
+        mode = get_mode_from_response(response)
+    return mode == MODE_ENABLE
             
+@step
 def enable(serial_port, enable_password):
     
     logger.info("\nEntering enable mode.")
 
-    serial_port.write("\r")
-    time.sleep(1)
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if (response.endswith(">")):
-        serial_port.write("enable\r")
-        time.sleep(1)
-    else:
-        if (response.endswith("#")):
-            logger.debug("We are in enable mode.")
-            return 0;
-        else:
-            logger.error("The response did not end in \">\" or \"#\", which is not OK, returning.")
-            return 1
+    mode = get_mode(serial_port)
+    if (mode == MODE_ENABLE or mode == MODE_CONFIG):
+        logger.debug("We are in enable mode.")
+        return 0;
+    elif (mode != MODE_USER):
+        logger.error("The response did not end in \">\" or \"#\", which is not OK, returning.")
+        return 1
         
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.info(response)
-    if (response.endswith("Password: ")):
-        serial_port.write(enable_password + "\r")
+    index, match, response = send_expect(serial_port, "enable", [PASSWORD_PROMPT, ENABLE_PROMPT, USER_PROMPT])
+    logger.info(strip_cr_nl(response))
+    if (index == 0):
+        #Not with send_expect(), so that the password is not kept in the latency table
+        send_line(serial_port, enable_password)
+        index, match, response = expect(serial_port, [ENABLE_PROMPT, PASSWORD_PROMPT])
+        if (index != 0):
+            logger.error("The enable password was not accepted, returning.")
+            return 1
     else:
         logger.debug("The response did not end in \"Password: \", but that is OK.")
         
     return 0
 
+@step
 def set_logging_console(serial_port, flag):
     
     logger.info("\nSetting console logging to " + str(flag) + ".")
 
-    serial_port.write("\r")
-    time.sleep(1)
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if (response.endswith("#")):
-        serial_port.write("configure terminal\r")
-        time.sleep(1)
-    else:
+    mode = get_mode(serial_port)
+    if (mode == MODE_ENABLE):
+        index, match, response = send_expect(serial_port, "configure terminal", CONFIG_PROMPT)
+        logger.debug(strip_cr_nl(response))
+        if (index != 0):
+            logger.error("The response did not end in \"(config)#\", which is not OK, returning.")
+            return 1
+    elif (mode != MODE_CONFIG):
         logger.error("The response did not end in \"#\", which is not OK, returning.")
         return 1
-        
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if (response.endswith("(config)#")):
-        if (flag):
-            serial_port.write("logging console\r")
-        else:
-            serial_port.write("no logging console\r")
+    
+    if (flag):
+        index, match, response = send_expect(serial_port, "logging console", CONFIG_PROMPT)
     else:
+        index, match, response = send_expect(serial_port, "no logging console", CONFIG_PROMPT)
+    logger.debug(strip_cr_nl(response))
+    if (index != 0):
         logger.error("The response did not end in \"(config)#\", which is not OK, returning.")
         return 1
     
-    time.sleep(1)    
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if (response.endswith("(config)#")):
-        serial_port.write("end\r")
-    else:
-        logger.error("The response did not end in \"(config)#\", which is not OK, returning.")
+    index, match, response = send_expect(serial_port, "end", ENABLE_PROMPT)
+    logger.debug(strip_cr_nl(response))
+    if (index != 0):
+        logger.error("The response did not end in \"#\" after \"end\", which is not OK, returning.")
         return 1
    
     return 0
 
-def copy_tftp_flash(serial_port, filename, tftp_server):
+def get_serial(serial_port):
+    """
+    The serial port itself, from inside any CLISession, ConsoleReader, 
+    TranscriptRecorder or TextSerialPort wrapping it, for settings such as the
+    baud rate.
+    """
+    while isinstance(serial_port, (CLISession, ConsoleReader, TranscriptRecorder, TextSerialPort)):
+        serial_port = serial_port.serial_port
+    return serial_port
+
+def device_setting(serial_port, name, default):
+    """
+    The prompt or timeout called name from the profile for the type of the 
+    device, if serial_port is a CLISession or DeviceSerialPort, which know the
+    type, or default if not, or if the profile has none of its own.
+    """
+    return get_profile(getattr(serial_port, "device_type", None)).setting(name, default)
+
+def get_console_speed(serial_port):
+    return getattr(get_serial(serial_port), "baudrate", default_console_speed)
+
+@step
+def set_console_speed(serial_port, speed):
+    """
+    Change the speed of the console of the device, with "speed" under
+    "line con 0", and then the baud rate of the serial port to match, checking
+    that the prompt can be read at the new speed. If it cannot, the serial port
+    is put back to the old speed, in case the device did not change.
+
+    The result is 0 if the console is at the new speed, or 1 if it is not, in
+    which case it is still at the old speed if the prompt can be read at that.
+    """
+    old_speed = get_console_speed(serial_port)
+    if (speed == old_speed):
+        return 0
+
+    logger.info("\nChanging the console speed from " + str(old_speed) + " to " + str(speed) + ".")
+
+    if not exec_mode(serial_port):
+        logger.error("The response did not end in \"#\", so probably not in enable mode, returning.")
+        return 1
+
+    index, match, response = send_expect(serial_port, "configure terminal", CONFIG_PROMPT)
+    logger.debug(strip_cr_nl(response))
+    if (index == 0):
+        index, match, response = send_expect(serial_port, "line con 0", CONFIG_PROMPT)
+        logger.debug(strip_cr_nl(response))
+    if (index != 0):
+        logger.error("The response did not end in \"(config-line)#\", which is not OK, returning.")
+        send_expect(serial_port, "end", ENABLE_PROMPT)
+        return 1
+
+    #The device changes speed as soon as it has the line, so the prompt after it
+    #can only be read at the old speed if the device did not change, as when it
+    #does not support the speed, and it comes as quickly as it did after "line con 0"
+    index, match, response = send_expect(serial_port, "speed " + str(speed), CONFIG_PROMPT,
+                                         learned_timeout(serial_port, "line con 0", speed_change_timeout))
+    logger.debug(strip_cr_nl(response))
+    if (index == 0):
+        logger.error("The device did not change the console speed to " + str(speed) + ", returning.")
+        send_expect(serial_port, "end", ENABLE_PROMPT)
+        return 1
+
+    get_serial(serial_port).baudrate = speed
+    index, match, response = send_expect(serial_port, "end", ENABLE_PROMPT)
+    logger.debug(strip_cr_nl(response))
+    if (index == 0):
+        logger.info("The console speed is now " + str(speed) + ".")
+        return 0
+
+    logger.error("There was no prompt at " + str(speed) + ", going back to " + str(old_speed) + ".")
+    get_serial(serial_port).baudrate = old_speed
+    index, match, response = send_expect(serial_port, "end", ENABLE_PROMPT)
+    logger.debug(strip_cr_nl(response))
+    if (index != 0):
+        logger.error("There was no prompt at " + str(old_speed) + " either.")
+    return 1
+
+def upgrade_console_speed(serial_port, device_type):
+    """
+    If console_speed_upgrade is set, raise the console speed to the highest
+    that device_type supports. The result is 0 if the console is at that
+    speed, or was not to be changed, and 1 if it could not be changed, in which
+    case the device can still be worked with at the old speed.
+    """
+    speed = get_profile(device_type).max_console_speed
+    if not console_speed_upgrade or not speed or speed <= get_console_speed(serial_port):
+        return 0
+    if serial_port.port.startswith("socket://"):
+        logger.info("The speed of the line behind " + serial_port.port + " cannot be changed from here, so not " 
+                    + "raising it.")
+        return 0
+    if isinstance(get_serial(serial_port), BrokerSerialPort):
+        logger.info("The console of " + serial_port.port + " is kept at its speed by the broker, so not raising it.")
+        return 0
+    return set_console_speed(serial_port, speed)
+
+def restore_console_speed(serial_port):
+    """
+    If console_speed_restore is set, put the console speed back to
+    default_console_speed, if it is not at that already.
+    """
+    if not console_speed_restore or get_console_speed(serial_port) == default_console_speed:
+        return 0
+    return set_console_speed(serial_port, default_console_speed)
+
+def get_local_md5(path):
+    """
+    The MD5 hash of the local file at path, which is only calculated once for
+    each version of the file, as it is kept in image_hash_file.
+    """
+    global _image_hash_cache
+    with _image_hash_cache_lock:
+        if _image_hash_cache is None or _image_hash_cache.cache_file != image_hash_file:
+            _image_hash_cache = ImageHashCache(image_hash_file)
+    return _image_hash_cache.get_md5(path)
+
+@step
+def flash_file_matches(serial_port, filename, local_path):
+    """
+    Whether flash:/filename on the device is the same as the local file at
+    local_path. The sizes are compared first, from "dir", or from the "flash"
+    fact if there is one, and only if they are the same is "verify /md5" run
+    on the device, to compare the MD5 hashes.
+    """
+    if not os.path.isfile(local_path):
+        logger.error("There is no local file " + local_path + " to compare with flash:/" + filename + ".")
+        return False
+    
+    if not exec_mode(serial_port):
+        logger.error("The response did not end in \"#\", so probably not in enable mode, returning.")
+        return False
+    
+    response = get_fact(serial_port, "flash")
+    if response is None:
+        response = read_show_output(serial_port, "dir flash:/" + filename)
+    logger.debug(strip_cr_nl(response))
+    match = re.search(r"-rw-\s+(\d+)\s.*\s" + re.escape(filename) + r"\s*$", response, re.MULTILINE)
+    if not match:
+        logger.debug("flash:/" + filename + " is not there.")
+        return False
+    
+    if (int(match.group(1)) != os.path.getsize(local_path)):
+        logger.debug("flash:/" + filename + " is " + match.group(1) + " bytes, which is not the same size as " 
+                     + local_path + ".")
+        return False
+    
+    local_md5 = get_local_md5(local_path)
+    index, match, response = send_expect(serial_port, "verify /md5 flash:/" + filename, ENABLE_PROMPT, 
+                                         device_setting(serial_port, "verify_timeout", verify_timeout))
+    logger.debug(strip_cr_nl(response))
+    match = MD5_HASH.search(response)
+    if not match:
+        logger.error("Could not get the MD5 hash of flash:/" + filename + ".")
+        return False
+    
+    if (match.group(1).lower() != local_md5):
+        logger.debug("The MD5 hash of flash:/" + filename + " is " + match.group(1) + ", not " + local_md5 + ".")
+        return False
+    
+    return True
+
+@step
+def copy_tftp_flash(serial_port, filename, tftp_server, local_path=None, on_progress=None):
+    """
+    Copy filename from the TFTP server to flash. If local_path is given, it is
+    the local copy of the file, and the copy is skipped if the file in flash
+    is the same already. If on_progress is given, it is called with each
+    ProgressEvent as the copy goes.
+    """
     
     logger.info("\nCopying " + filename + " from tftp to flash.")
     
-    serial_port.write("\r")
-    time.sleep(1)
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if (response.endswith("#")):
-        serial_port.write("copy tftp flash\r")
-        time.sleep(1)
-    else:
+    if not exec_mode(serial_port):
         logger.error("The response did not end in \"#\", so probably not in enable mode, returning.")
         return 1
+    
+    if local_path and flash_file_matches(serial_port, filename, local_path):
+        logger.info("flash:/" + filename + " is the same as " + local_path + " already, so not copying it.")
+        return 0
  
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if ("Address or name of remote host" in response):
-        serial_port.write(tftp_server + "\r")
-        time.sleep(1)
-    else:
+    index, match, response = send_expect(serial_port, "copy tftp flash", 
+                                         re.compile(r"Address or name of remote host"))
+    logger.debug(strip_cr_nl(response))
+    if (index != 0):
         logger.error("The response did not contain \"Address or name of remote host\", so probably not where we need to be, returning.")
         return 1
      
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if ("Source filename" in response):
-        serial_port.write(filename + "\r")
-        time.sleep(1)
-    else:
+    index, match, response = send_expect(serial_port, tftp_server, re.compile(r"Source filename"), record=False)
+    logger.debug(strip_cr_nl(response))
+    if (index != 0):
         logger.error("The response did not contain \"Source filename\", so probably not where we need to be, returning.")
         return 1
       
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if ("Destination filename" in response):
-        serial_port.write(filename + "\r")
-        time.sleep(1)
-    else:
+    index, match, response = send_expect(serial_port, filename, DESTINATION_FILENAME, record=False)
+    logger.debug(strip_cr_nl(response))
+    if (index != 0):
         logger.error("The response did not contain \"Destination filename\", so probably not where we need to be, returning.")
         return 1
-        
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if ("already existing" in response):
+    
+    return copy_to_destination(serial_port, filename, "tftp server " + tftp_server, on_progress, local_path)
+
+@step
+def copy_http_flash(serial_port, filename, http_server, local_path=None, on_progress=None):
+    """
+    Copy filename from the HTTP server, given as "host" or "host:port", to 
+    flash. If local_path is given, it is the local copy of the file, and the 
+    copy is skipped if the file in flash is the same already. If on_progress
+    is given, it is called with each ProgressEvent as the copy goes.
+    """
+    
+    logger.info("\nCopying " + filename + " from http to flash.")
+    
+    if not exec_mode(serial_port):
+        logger.error("The response did not end in \"#\", so probably not in enable mode, returning.")
+        return 1
+    
+    if local_path and flash_file_matches(serial_port, filename, local_path):
+        logger.info("flash:/" + filename + " is the same as " + local_path + " already, so not copying it.")
+        return 0
+    
+    url = "http://" + http_server + "/" + filename
+    index, match, response = send_expect(serial_port, "copy " + url + " flash:", DESTINATION_FILENAME)
+    logger.debug(strip_cr_nl(response))
+    if (index != 0):
+        logger.error("The response did not contain \"Destination filename\", so probably not where we need to be, returning.")
+        return 1
+    
+    return copy_to_destination(serial_port, filename, url, on_progress, local_path)
+
+@step
+def copy_to_destination(serial_port, filename, source, on_progress=None, local_path=None):
+    """
+    The rest of a copy to flash, from the "Destination filename" prompt, which
+    is the same whatever the file is being copied from, up to the "#" prompt
+    when the copy has finished.
+    
+    The progress of the copy is followed as it goes, and the copy is stopped
+    if it makes no progress for stall_timeout seconds. If local_path is given,
+    the copy has failed if the size the device gives for the file when it has
+    finished is not that of the local copy.
+    """
+    #The bytes each "!" stands for depend on the device and on the protocol, 
+    #which is the start of the source, as in "tftp server ..." or "http://..."
+    progress = TransferProgress(on_progress or log_progress, 
+                                (get_device_type(serial_port), re.split(r"[\s:]", source)[0]))
+    #The listing of flash is out of date from here on, whatever happens
+    forget_fact(serial_port, "flash")
+    index, match, response = send_expect(serial_port, filename, 
+                                         [re.compile(r"already existing"), re.compile(r"Accessing"), ENABLE_PROMPT],
+                                         record=False)
+    logger.debug(strip_cr_nl(response))
+    if (index == 0):
         logger.debug("The response did contain \"already existing\", which is OK, and it shall be overwritten.")
-        serial_port.write("\r")
-        time.sleep(1)
+        index, match, response = send_expect(serial_port, "", [re.compile(r"Accessing"), ENABLE_PROMPT], 
+                                             record=False)
+        logger.debug(strip_cr_nl(response))
         
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
+    if (index == -1):
+        logger.error("The copy of " + filename + " from " + source + " did not start, returning.")
+        return 1
+    
     if ("Accessing" in response):
-        logger.debug("Copy from tftp server " + tftp_server + " of file " + filename + " started.")
-
-    while True:
-        time.sleep(10)
-        response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-        logger.debug("The response is " + response + " whilst accessing the file " + filename + ".")
-        if (response.endswith("#")):
-            logger.info("Back to # prompt, carrying on.")
-            break
+        logger.debug("Copy from " + source + " of file " + filename + " started.")
+    progress.feed(response)
+        
+    if not ENABLE_PROMPT.search(response):
+        index, match, transfer = expect_with_progress(serial_port, ENABLE_PROMPT, progress, 
+                                                      device_setting(serial_port, "copy_timeout", copy_timeout),
+                                                      stall_timeout)
+        response += transfer
+        logger.debug("The response is " + strip_cr_nl(response) + " whilst accessing the file " + filename + ".")
+        if (index != 0):
+            if (stall_timeout is not None and progress.stalled(stall_timeout)):
+                logger.error("The copy of " + filename + " from " + source + " made no progress for " 
+                             + str(stall_timeout) + " secs, stopping it.")
+            else:
+                logger.error("Timed out copying the file " + filename + ", stopping it.")
+            abort_transfer(serial_port)
+            return 1
+    
+    logger.info("Back to # prompt, carrying on.")
+    if progress.complete:
+        logger.info("Copied " + filename + " from " + source + ", " + str(progress.events[-1]) + ".")
     
     if ("Error" in response):
         logger.error("The response contained the word \"Error\", which is not good, returning.")
         return 1
     
+    if (local_path and progress.ok_bytes is not None and progress.ok_bytes != os.path.getsize(local_path)):
+        logger.error("The copy of " + filename + " from " + source + " is " + str(progress.ok_bytes) 
+                     + " bytes, not " + str(os.path.getsize(local_path)) + " as " + local_path + " is, returning.")
+        return 1
+    
     return 0
         
+@step
+def expect_with_progress(serial_port, patterns, progress, timeout, stall_timeout=None):
+    """
+    Like expect, but feeding the output to the TransferProgress progress as it
+    arrives, and giving up early if there is no progress for stall_timeout 
+    seconds, unless stall_timeout is None.
+    """
+    if not isinstance(patterns, (list, tuple)):
+        patterns = [patterns]
+    
+    response = ""
+    deadline = time.time() + timeout
+    while True:
+        waiting = serial_port.inWaiting()
+        if waiting:
+            output = serial_port.read(waiting)
+            record_read(waiting)
+            response += output
+            progress.feed(output)
+            for index, pattern in enumerate(patterns):
+                match = pattern.search(response)
+                if match:
+                    return index, match, response
+        if (time.time() >= deadline or 
+            (stall_timeout is not None and progress.stalled(stall_timeout))):
+            return -1, None, response
+        if not waiting:
+            wait_for_output(serial_port, poll_interval)
+
+def log_progress(event):
+    """
+    The on_progress for copies when none is given, which logs each event.
+    """
+    logger.debug("Copy progress: " + str(event) + ".")
+
+@step
+def abort_transfer(serial_port):
+    """
+    Stop a copy that is running with the escape sequence, and wait for the 
+    prompt to come back.
+    """
+    send_raw(serial_port, ESCAPE_SEQUENCE)
+    index, match, response = expect(serial_port, ENABLE_PROMPT)
+    logger.debug(strip_cr_nl(response))
+    if (index != 0):
+        logger.error("The prompt did not come back after stopping the copy.")
+    return index == 0
+        
+@step
 def reload_device(serial_port):
     
     logger.info("\nReloading.")
     
-    serial_port.write("\r")
-    time.sleep(1)
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if (response.endswith("#")):
-        serial_port.write("reload\r")
-        time.sleep(1)
-        
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if ("yes/no" in strip_cr_nl(response)):
-        serial_port.write("yes\r")
-        time.sleep(1)
+    if not exec_mode(serial_port):
+        logger.error("The response did not end in \"#\", so probably not in enable mode, returning.")
+        return 1
+    
+    if (restore_console_speed(serial_port) > 0):
+        logger.error("The console speed could not be put back to " + str(default_console_speed) 
+                     + ", so the device may not be found again after the reload.")
+    
+    index, match, response = send_expect(serial_port, "reload", [YES_NO_PROMPT, CONFIRM_PROMPT])
+    logger.debug(strip_cr_nl(response))
+    while (index == 0):
+        index, match, response = send_expect(serial_port, "yes", [YES_NO_PROMPT, CONFIRM_PROMPT], record=False)
+        logger.debug(strip_cr_nl(response))
         
-    response = strip_cr_nl(serial_port.read(serial_port.inWaiting()))
-    logger.debug(response)
-    if ("yes/no" in strip_cr_nl(response)):
-        serial_port.write("yes\r")
-        time.sleep(1)
+    if (index == 1):
+        send_raw(serial_port, "\r")
         
     return 0
         
+@step
+def wait_for_boot(serial_port, timeout):
+    """
+    Wait for a device that is reloading or booting to get to rommon or to an
+    IOS prompt, answering "no" to the initial configuration dialog and pressing
+    return to get started on the way. Each of these is done as soon as the 
+    output for it arrives, and return is only pressed otherwise if the device 
+    has been quiet for boot_poke_interval seconds. This is not learned from
+    the latency table, as a device that is booting is not answering return.
+    
+    The result is the mode the device got to, which is MODE_UNKNOWN if it did
+    not get to rommon or a prompt within timeout seconds.
+    """
+    patterns = [device_setting(serial_port, "rommon_prompt", ROMMON_PROMPT), INITIAL_DIALOG_PROMPT, PRESS_RETURN,
+                device_setting(serial_port, "prompt", ANY_PROMPT)]
+    deadline = time.time() + timeout
+    while (time.time() < deadline):
+        index, match, response = expect(serial_port, patterns,
+                                        min(boot_poke_interval, deadline - time.time()))
+        logger.debug(strip_cr_nl(response))
+        if (index == 0):
+            return MODE_ROMMON
+        elif (index == 1):
+            logger.debug("We have the initial configuration dialog prompt, answering \"no\".")
+            send_line(serial_port, "no")
+        elif (index == 2):
+            send_line(serial_port, "")
+        elif (index == 3):
+            #The "#" marks as an image loads are not a prompt
+            mode = get_mode_from_response(response)
+            if (mode == MODE_USER or mode == MODE_ENABLE):
+                return mode
+        elif not response:
+            send_raw(serial_port, "\r")
+            
+    logger.error("The device at " + serial_port.port + " did not get to rommon or a prompt within " 
+                 + str(timeout) + " secs.")
+    return MODE_UNKNOWN
+        
+def get_prompt(response):
+    """
+    The prompt at the end of a response, such as "Router#", or "" if there is
+    no prompt there.
+    """
+    match = PROMPT_LINE.search(response)
+    if match:
+        return match.group(1).strip()
+    return ""
+        
 def strip_cr_nl(orig_str):
     new_str = orig_str.replace('\r', '').replace('\n', '')
-    return new_str
+    return new_str
\ No newline at end of file
@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+These are functions for working out which lines of a rendered configuration
+are not already in the running configuration of a device, so that only those
+lines need to be sent to it.
+
+Configurations are compared as IOS section blocks, i.e. a top level line, such
+as "interface Vlan2", with the indented lines under it. A section that is not 
+in the running configuration is sent whole. For a section that is, only the 
+lines under it that are missing are sent, after the top level line so that 
+they go to the right place. Whitespace is ignored when comparing lines.
+
+Lines outside "configure terminal" and "end" in the rendered configuration are
+exec commands, such as installing images, rather than configuration, so they
+are always kept.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import re
+
+CONFIGURE = re.compile(r"^conf(igure)?( t(erminal)?)?$")
+END = "end"
+EXIT = "exit"
+NO_SHUTDOWN = re.compile(r"^no shut(d(o(w(n)?)?)?)?$")
+RUNNING_CONFIG_START = re.compile(r"^(Current configuration|Building configuration)")
+PROMPT = re.compile(r"^[\w.:/\-]+(\(config[^)]*\))?[>#]")
+
+
+def normalise(line):
+    return " ".join(line.split())
+
+def parse_sections(lines):
+    """
+    Parse configuration lines into a list of (top level line, [indented lines])
+    tuples, in order. Comments, "exit" lines and blank lines are dropped, and
+    the lines are normalised.
+    """
+    sections = []
+    for line in lines:
+        stripped = normalise(line)
+        if not stripped or stripped.startswith("!") or stripped == EXIT:
+            continue
+        if line[:1].isspace() and sections:
+            sections[-1][1].append(stripped)
+        else:
+            sections.append((stripped, []))
+            
+    return sections
+
+def in_section(sub_line, running_sub_lines):
+    """
+    Whether the normalised sub_line is in the running configuration lines for
+    a section. The running configuration does not show "no shutdown", as it is 
+    the default, so that is taken to be there if "shutdown" is not.
+    """
+    if NO_SHUTDOWN.match(sub_line):
+        return "shutdown" not in running_sub_lines
+    return sub_line in running_sub_lines
+
+def parse_running_config(output):
+    """
+    The configuration lines from the output of "show running-config", without
+    the command echo, the header, the "end" line and the prompt.
+    """
+    lines = []
+    started = False
+    for line in output.replace("\r", "").split("\n"):
+        if not started:
+            started = bool(RUNNING_CONFIG_START.match(line))
+            continue
+        if line.strip() == END or PROMPT.match(line):
+            break
+        lines.append(line)
+        
+    return lines
+
+def config_delta(config_lines, running_lines):
+    """
+    The configuration lines, without "configure terminal" and "end", that are
+    in config_lines but not in running_lines.
+    """
+    running = {}
+    for top_line, sub_lines in parse_sections(running_lines):
+        running.setdefault(top_line, set()).update(sub_lines)
+        
+    delta = []
+    for top_line, sub_lines in parse_sections(config_lines):
+        if top_line not in running:
+            missing = sub_lines
+        else:
+            missing = [sub_line for sub_line in sub_lines if not in_section(sub_line, running[top_line])]
+            if not missing:
+                continue
+        
+        delta.append(top_line)
+        for sub_line in missing:
+            delta.append(" " + sub_line)
+        if sub_lines:
+            delta.append(" " + EXIT)
+            
+    return delta
+
+def incremental_config(lines, running_config_output):
+    """
+    The rendered configuration lines reduced to what needs to be sent to a 
+    device with the given "show running-config" output. The exec lines before 
+    "configure terminal" and after "end" are kept as they are, and the 
+    configuration between them is reduced to config_delta(). If there is no 
+    delta, "configure terminal" and "end" are dropped too.
+    """
+    before = []
+    config = []
+    after = []
+    part = before
+    for line in lines:
+        if part is before and CONFIGURE.match(normalise(line)):
+            part = config
+            continue
+        if part is config and normalise(line) == END:
+            part = after
+            continue
+        part.append(line)
+        
+    delta = config_delta(config, parse_running_config(running_config_output))
+    if delta:
+        delta = ["configure terminal"] + delta + [END]
+        
+    return before + delta + after
@@ -42,96 +42,198 @@ import logging
 from logging.config import fileConfig
 import os
 from pyserial_util.cli_utils import *
+from pyserial_util.config_template import get_template
+from pyserial_util.config_diff import incremental_config
 
 usb_port_base = "cu.SLAB_USBtoUART"
 enable_password = "cisco123"
+#How many devices to work on at once, None being all of them, and where to put a
+#log file per device, None being no per device log files.
+max_workers = None
+device_log_dir = None
     
-def main(argv=None):
+first_net_tuple = "10"
+process_images = False
+#How to send the configuration, "bulk" to send it in blocks of config_block_size 
+#lines at a time, or "line" to send it one line at a time.
+delivery_mode = "bulk"
+config_block_size = 10
+#Set incremental to True to only send the lines that are not already in the
+#running configuration of each device.
+incremental = False
+running_config_timeout = 120
+
+def configure_device(dev_ser_port, second_net_tuple):
+    """
+    Generate the configuration for one device from the template for its type,
+    using second_net_tuple for its networks, and apply it to the device.
+    
+    The result is a line for the summary, or None if the device was skipped.
+    """
+    logger.info("Configuring a " + dev_ser_port.device_type + " at " + dev_ser_port.serial_port.port + ".")
+
+    lan_dhcp_upper = str(1+get_profile(dev_ser_port.device_type).lan_ports)
+    
+    variables = {"NT1" : first_net_tuple, "NT2" : str(second_net_tuple), "LDU" : lan_dhcp_upper}
+    
+    try:
+        template = get_template(dev_ser_port.device_type)
+        lines = template.render(variables, process_images)
+    except (IOError, OSError, ValueError) as e:
+        logger.error("%s" % e)
+        return None
+    
+    for line in lines:
+        logger.debug("Processed config line is " + line)
+                
+    session = CLISession(dev_ser_port)
+    enable(session, enable_password)
+    if (upgrade_console_speed(session, dev_ser_port.device_type) > 0):
+        logger.error("The console speed of " + dev_ser_port.serial_port.port + " could not be raised, carrying on at " 
+                     + str(get_console_speed(session)) + ".")
+    
+    if (incremental):
+        lines = get_incremental_config(session, lines)
+        if lines is None:
+            return None
+        if not lines:
+            return ("Found nothing to configure on a " + dev_ser_port.device_type + " at " 
+                    + dev_ser_port.serial_port.port + ".")
+            
+    if (delivery_mode == "bulk"):
+        retcode = send_config_bulk(session, lines)
+    else:
+        retcode = send_config_by_line(session, lines)
+    if (retcode > 0):
+        return None
       
-    device_serial_ports = get_console_ports(usb_port_base)
+    #Put the console speed back first, so that it is saved at that speed
+    restore_console_speed(session)
+    session.write("write memory\r")
+    expect(session, ENABLE_PROMPT)
+    return "Configured a " + dev_ser_port.device_type + " at " + dev_ser_port.serial_port.port + "."
+
+def get_incremental_config(session, lines):
+    """
+    Get the running configuration from the device, and reduce the lines to
+    those that are not in it already. The result is None if the running
+    configuration could not be read.
+    """
+    if not exec_mode(session):
+        logger.error("The response did not end in \"#\", so the running configuration cannot be read.")
+        return None
+    
+    send_expect(session, "terminal length 0", ENABLE_PROMPT)
+    running_config = read_show_output(session, "show running-config", running_config_timeout)
+    if not ENABLE_PROMPT.search(running_config):
+        logger.error("Timed out reading the running configuration.")
+        return None
+    
+    delta = incremental_config(lines, running_config)
+    logger.info("Sending " + str(len(delta)) + " of " + str(len(lines)) + " configuration lines.")
+    for line in delta:
+        logger.debug("Configuration line to send is " + line)
         
-    logger.info("About to start on these serial ports and devices:\n")
-    for dev_ser_port in device_serial_ports:
-        logger.info("Port = " + str(dev_ser_port.serial_port) + " device type = " + 
-                    str(dev_ser_port.device_type) + "\n")
+    return delta
+
+def send_config_by_line(session, lines):
+    """
+    Send the configuration one line at a time, waiting for the prompt after
+    each line, which is slow, but stops at the first line with an error.
+    """
+    for line in lines:
+        
+        session.write(line + "\n")
+    
+        while True:
+            session.write("\r")
+            time.sleep(get_profile(session.device_type).command_latency)
+            response = strip_cr_nl(session.read(session.inWaiting()))
+            logger.debug("The response is " + response + " whilst adding configuration.")
+            if "Invalid" in response:
+                logger.error("The response contained \"Invalid\" for the line \"" + line 
+                             + "\", which is not OK, so skipping this device.")
+                return 1
+            if (response.endswith("#")):
+                logger.debug("Back to # prompt, carrying on.")
+                break
+            if (response.endswith(">")):
+                logger.error("We have a > prompt, which is not OK, so skipping this device.")
+                return 1
+            
+    return 0
+
+def send_config_bulk(session, lines):
+    """
+    Send the configuration in blocks of config_block_size lines, and then check
+    the output for all of them for errors in one go, which is much faster than 
+    sending one line at a time. Each error is reported with the line that 
+    caused it.
+    """
+    timeout = None
+    if (process_images):
+        timeout = device_setting(session, "install_timeout", install_timeout)
+        
+    retcode, errors, response = send_config_lines(session, lines, config_block_size, timeout)
+    logger.debug("The response is " + response + " whilst adding configuration.")
     
-    summary = []
+    for line, error in errors:
+        logger.error("The line \"" + line + "\" gave the error \"" + error + "\".")
+    if errors:
+        logger.error("The response contained errors, which is not OK, so skipping this device.")
+        return 1
     
-    device_counter = 1
-    first_net_tuple = "10"
-    second_net_tuple = 42
-    lan_dhcp_upper = "2"
-    process_images = False
+    if (retcode > 0):
+        logger.error("We did not get back to a # prompt, which is not OK, so skipping this device.")
+        return 1
+        
+    return 0
     
+def assign_networks(device_serial_ports):
+    """
+    Number the networks of each of the DeviceSerialPort instances that there is
+    a template for, from 42, in the order of their ports, so that a device gets
+    the same networks each time, whichever order the devices are found in.
+    Devices with no template get no number, so they do not leave gaps. The 
+    result is the numbers by DeviceSerialPort.
+    """
+    found = []
     for dev_ser_port in device_serial_ports:
-        skip_device = False
-        
-        logger.info("Configuring a " + dev_ser_port.device_type + " at " + dev_ser_port.serial_port.port + ".")
-
-        config = []        
+        logger.info("Port = " + str(dev_ser_port.serial_port) + " device type = " + 
+                    str(dev_ser_port.device_type) + "\n")
         try:
-            with open("configs/" + dev_ser_port.device_type + ".cfgtmpl") as config_file:
-                for line in config_file:
-                    config.append(line)
-        except Exception as e:
+            get_template(dev_ser_port.device_type)
+        except (IOError, OSError, ValueError) as e:
             logger.error("%s" % e)
-            continue      
-                    
-        enable(dev_ser_port.serial_port, enable_password)
-            
-        #TODO Refactor to device info class 
-        num_ports = {'IR829GW-LTE-GA-EK9' : 4, 'IR809G-LTE-GA-K9' : 2}[dev_ser_port.device_type]
+            continue
+        found.append(dev_ser_port)
+    
+    second_net_tuples = {}
+    for second_net_tuple, dev_ser_port in enumerate(sorted(found, key=port_name), 42):
+        second_net_tuples[dev_ser_port] = second_net_tuple
+    return second_net_tuples
 
-        lan_dhcp_upper = str(1+num_ports)
+def port_name(dev_ser_port):
+    return dev_ser_port.serial_port.port
     
-        for line in config:
-            
-            if line.startswith("!"):
-                continue
-                        
-            original_line = line
-            
-            line = line.replace("<NT1>", first_net_tuple)
-            line = line.replace("<NT2>", str(second_net_tuple))
-            line = line.replace("<LDU>", lan_dhcp_upper)
-            
-            if (process_images):
-                if ("#Process images:" in line):
-                    line = line.replace("#Process images:", "")
-        
-            if (line != original_line):
-                logger.debug("Processed config line is " + line)
-             
-            if (line.startswith("hostname")):
-                line = strip_cr_nl(line) + "-SN" + first_net_tuple + "." + str(second_net_tuple) + ".1.0EN"  
-            
-            dev_ser_port.serial_port.write(line)
-        
-            while True:
-                dev_ser_port.serial_port.write("\r")
-                time.sleep(1)
-                response = strip_cr_nl(dev_ser_port.serial_port.read(dev_ser_port.serial_port.inWaiting()))
-                logger.debug("The response is " + response + " whilst adding configuration.")
-                if "Invalid" in response:
-                    logger.error("The response contained \"Invalid\", which is not OK, so returning.")
-                    return 1
-                if (response.endswith("#")):
-                    logger.debug("Back to # prompt, carrying on.")
-                    break
-                if (response.endswith(">")):
-                    logger.error("We have a > prompt, which is not OK, so skipping this device.")
-                    skip_device = True
-                    break
-            
-            if(skip_device):
-                break
-          
-        if not skip_device:
-            dev_ser_port.serial_port.write("write memory\r")
-            time.sleep(1)
-            second_net_tuple += 1
-            device_counter += 1
-            summary.append("Configured a " + dev_ser_port.device_type + " at " + dev_ser_port.serial_port.port + ".")
+def configure_devices(device_serial_ports):
+    """
+    Configure each of the DeviceSerialPort instances, which can also be a 
+    generator, returning the summary lines. All of the devices are found before
+    any of them is configured, so that their networks can be numbered as
+    described for assign_networks().
+    """
+    second_net_tuples = assign_networks(device_serial_ports)
+    
+    results = run_on_devices(sorted(second_net_tuples, key=port_name), 
+                             lambda dev_ser_port: configure_device(dev_ser_port, 
+                                                                   second_net_tuples[dev_ser_port]),
+                             max_workers, device_log_dir)
+    return [result for result in results if result]
+    
+def main(argv=None):
+    
+    summary = configure_devices(iter_console_ports(usb_port_base))
 
     logger.info("The summary is:\n")
     for result in summary:
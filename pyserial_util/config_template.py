@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a template engine for the .cfgtmpl configuration templates in the
+configs directory.
+
+A template is parsed once into a compiled form, and is then cached for each
+device type, so that rendering the configuration for each device is a single
+pass over the compiled lines with a dict of variables. In the templates:
+
+ - Lines starting with "!" are comments, and are dropped.
+ - Placeholders such as <NT1> are replaced with the variable of that name,
+   i.e. variables["NT1"].
+ - Lines starting with "#Process images:" are only made live, by removing that 
+   prefix, when images are being processed, and are dropped otherwise, as IOS
+   does not take "#" lines as comments.
+ - The hostname has "-SN<NT1>.<NT2>.1.0EN" added to it, from which the scripts
+   can later tell the network the device is on.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import os
+import re
+import threading
+
+from pyserial_util.device_profiles import get_profile
+
+PLACEHOLDER = re.compile(r"<([A-Za-z0-9_]+)>")
+PROCESS_IMAGES = "#Process images:"
+HOSTNAME_SUFFIX = "-SN<NT1>.<NT2>.1.0EN"
+
+template_dir = "configs"
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+class ConfigTemplate:
+    placeholders = frozenset()
+    
+    def __init__(self, text):
+        """
+        Compile the text of a template. Each line that is kept becomes a tuple
+        of whether it is an image line and a format string for it, with the 
+        placeholders turned into format fields.
+        """
+        self.lines = []
+        placeholders = set()
+        for line in text.splitlines():
+            line = line.rstrip()
+            if not line or line.startswith("!"):
+                continue
+            
+            image_line = line.startswith(PROCESS_IMAGES)
+            if line.startswith("hostname"):
+                line += HOSTNAME_SUFFIX
+                
+            placeholders.update(PLACEHOLDER.findall(line))
+            line = line.replace("{", "{{").replace("}", "}}")
+            self.lines.append((image_line, PLACEHOLDER.sub(r"{\1}", line)))
+            
+        self.placeholders = frozenset(placeholders)
+        
+    def missing_variables(self, variables):
+        """
+        The names of the placeholders that have no value in variables, sorted.
+        """
+        return sorted(self.placeholders - set(variables))
+    
+    def render(self, variables, process_images=False):
+        """
+        The configuration as a list of lines, with the placeholders replaced
+        from variables. A ValueError is raised if any are missing.
+        """
+        missing = self.missing_variables(variables)
+        if missing:
+            raise ValueError("No values for the placeholders " + ", ".join(missing))
+        
+        config = []
+        for image_line, line in self.lines:
+            if image_line and not process_images:
+                continue
+            line = line.format(**variables)
+            if image_line:
+                line = line[len(PROCESS_IMAGES):]
+            config.append(line)
+            
+        return config
+
+def get_template(device_type):
+    """
+    The compiled ConfigTemplate for the device type, from the .cfgtmpl file 
+    for it in template_dir, as named in its profile in device_profiles.py. 
+    Each file is only read and compiled the first time it is needed.
+    """
+    with _templates_lock:
+        template = _templates.get(device_type)
+        if template is None:
+            with open(os.path.join(template_dir, get_profile(device_type).template_file)) as template_file:
+                template = ConfigTemplate(template_file.read())
+            _templates[device_type] = template
+        return template
@@ -0,0 +1,212 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a bridge from TCP to local console ports, which does what a terminal
+server does for its lines, so that consoles can be used from another machine,
+and so that the network console support in cli_utils.py can be tried without a
+terminal server, for example with the pseudo-terminals of ios_simulator.py.
+
+Each ConsoleBridge listens on a TCP port of its own, and passes everything
+between the one connection it takes at a time and the console port, either as
+it is, for pySerial socket:// URLs, or with the Telnet and RFC 2217 options,
+for rfc2217:// URLs, with which the client can also set the baud rate of the
+console port.
+
+Running this module bridges each port under bridge_dev_dir named
+usb_port_base plus a number to a TCP port from bridge_base_port on, and writes
+their URLs to inventory_file, which can then be used as console_inventory_file
+in cli_utils.py, until it is interrupted.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import logging
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+import serial
+import serial.rfc2217
+
+from logging.config import fileConfig
+
+logger = logging.getLogger()
+
+#The ports that main() bridges, the first TCP port to bridge them to, the
+#address to listen on, whether to use RFC 2217, and where to list the URLs.
+usb_port_base = "cu.SLAB_USBtoUART"
+bridge_dev_dir = "/dev/"
+bridge_base_port = 7000
+bridge_host = "127.0.0.1"
+bridge_rfc2217 = True
+inventory_file = "console_inventory.txt"
+
+
+class ConsoleBridge:
+    port_path = ""
+    host = ""
+    tcp_port = 0
+    rfc2217 = False
+
+    def __init__(self, port_path, tcp_port, host="127.0.0.1", rfc2217=False):
+        """
+        Bridge the console at port_path to tcp_port on host, with RFC 2217 if
+        rfc2217 is True.
+        """
+        self.port_path = port_path
+        self.tcp_port = tcp_port
+        self.host = host
+        self.rfc2217 = rfc2217
+        self._serial_port = None
+        self._listener = None
+        self._running = False
+        self._thread = None
+
+    def url(self):
+        """
+        The pySerial URL for the console through the bridge.
+        """
+        return ("rfc2217://" if self.rfc2217 else "socket://") + self.host + ":" + str(self.tcp_port)
+
+    def start(self):
+        self._serial_port = serial.Serial(self.port_path, baudrate=9600, timeout=0)
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((self.host, self.tcp_port))
+        self._listener.listen(1)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name="bridge-" + os.path.basename(self.port_path))
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Bridging " + self.port_path + " to " + self.url() + ".")
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._listener.close()
+        self._serial_port.close()
+
+    def _serve(self):
+        while self._running:
+            if not select.select([self._listener], [], [], 0.5)[0]:
+                continue
+            connection, address = self._listener.accept()
+            logger.info("Connection to " + self.port_path + " from " + str(address) + ".")
+            try:
+                self._relay(connection)
+            except (IOError, OSError) as e:
+                logger.error("Bridging " + self.port_path + " failed - %s" % e)
+            finally:
+                connection.close()
+            logger.info("Connection to " + self.port_path + " from " + str(address) + " closed.")
+
+    def _relay(self, connection):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        port_manager = None
+        if self.rfc2217:
+            port_manager = serial.rfc2217.PortManager(_ModemLinesOptional(self._serial_port), _Sender(connection))
+        #Anything the console sent while no one was connected is not wanted
+        self._serial_port.flushInput()
+
+        while self._running:
+            ready = select.select([connection, self._serial_port.fileno()], [], [], 0.5)[0]
+            if connection in ready:
+                data = connection.recv(4096)
+                if not data:
+                    return
+                if port_manager:
+                    data = b"".join(port_manager.filter(data))
+                if data:
+                    self._serial_port.write(data)
+            if self._serial_port.fileno() in ready:
+                data = self._serial_port.read(self._serial_port.inWaiting() or 1)
+                if port_manager:
+                    data = b"".join(port_manager.escape(data))
+                if data:
+                    connection.sendall(data)
+
+class _ModemLinesOptional:
+    """
+    The console port as the PortManager sees it, on which setting and reading 
+    the modem control lines is allowed to fail, as it does on pseudo-terminals.
+    """
+    MODEM_LINES = ("dtr", "rts", "break_condition", "cts", "dsr", "ri", "cd")
+
+    def __init__(self, serial_port):
+        self.__dict__["serial_port"] = serial_port
+
+    def __getattr__(self, name):
+        try:
+            return getattr(self.serial_port, name)
+        except (IOError, OSError):
+            if name not in self.MODEM_LINES:
+                raise
+            return False
+
+    def __setattr__(self, name, value):
+        try:
+            setattr(self.serial_port, name, value)
+        except (IOError, OSError):
+            if name not in self.MODEM_LINES:
+                raise
+
+class _Sender:
+    #The PortManager sends its Telnet replies with write()
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def write(self, data):
+        self.connection.sendall(data)
+
+def write_inventory(path, urls):
+    with open(path, "w") as f:
+        f.write("#Consoles bridged by console_bridge.py\n")
+        for url in urls:
+            f.write(url + "\n")
+
+def main(argv=None):
+
+    fileConfig('logging_config.ini')
+    bridges = []
+    for index, filename in enumerate(sorted(name for name in os.listdir(bridge_dev_dir) if usb_port_base in name)):
+        bridge = ConsoleBridge(os.path.join(bridge_dev_dir, filename), bridge_base_port + index, bridge_host,
+                               bridge_rfc2217)
+        bridge.start()
+        bridges.append(bridge)
+
+    write_inventory(inventory_file, [bridge.url() for bridge in bridges])
+    logger.info("Set console_inventory_file in cli_utils.py to " + os.path.abspath(inventory_file)
+                + " to use the bridged consoles.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for bridge in bridges:
+            bridge.stop()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
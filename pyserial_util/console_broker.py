@@ -0,0 +1,370 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a broker that keeps the console ports open, with the devices on them
+identified, so that the scripts can start work on the devices straight away,
+rather than finding and identifying them again each time, and so that more
+than one script can run at the same time on different devices.
+
+The broker finds the devices once, as cli_utils.py does, and reads each
+console in the background. It then answers requests on a Unix socket, at
+broker_socket, each a line of JSON with an "op", answered with a line of JSON:
+
+ - {"op": "list"} gives the devices, with the port, device type and serial
+   number of each, and whether it is in use.
+ - {"op": "acquire", "port": port} gives the device on port to the connection,
+   until it is released, or the connection is closed. A device can only be
+   used by one connection at a time.
+ - {"op": "release", "port": port} gives the device on port back, or all of
+   those of the connection, if there is no "port".
+ - {"op": "write", "data": data} sends data to the device of the connection.
+ - {"op": "read", "wait": seconds} gives everything the device has sent, after
+   waiting up to seconds for something, if there is nothing yet.
+ - {"op": "run", "port": port, "commands": [...]} runs each of the commands
+   on the device on port, and gives the output of each, up to the prompt,
+   first entering enable mode if an "enable_password" is given. The device is
+   given back afterwards, unless the connection had acquired it already.
+
+Errors are answered with {"error": reason}.
+
+The scripts use the broker when console_broker_socket is set in cli_utils.py,
+through BrokerSerialPort, which can be used in place of a serial port, so that
+all of the functions in cli_utils.py work with it as they do with a local port.
+
+Running this module starts the broker, until it is interrupted.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+from logging.config import fileConfig
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from pyserial_util.transcript import to_bytes, to_text
+
+logger = logging.getLogger()
+
+#The ports the broker finds devices on, and where its socket is.
+usb_port_base = "cu.SLAB_USBtoUART"
+broker_socket = os.path.join(os.path.expanduser("~"), ".pyserial_util", "console_broker.sock")
+
+#How long, in seconds, the broker waits for each command of a "run" request.
+run_timeout = 60
+
+
+class BrokerSerialPort:
+    """
+    A BrokerSerialPort can be used in place of a serial port, for the device
+    on port, through the broker at socket_path. The device is acquired when it
+    is made, and released when it is closed.
+    """
+    port = ""
+    socket_path = ""
+    baudrate = 9600
+
+    def __init__(self, socket_path, port):
+        self.socket_path = socket_path
+        self.port = port
+        self._buffer = ""
+        self._connection = connect(socket_path)
+        self._file = self._connection.makefile("r")
+        reply = self._request({"op": "acquire", "port": port})
+        if "error" in reply:
+            self.close()
+            raise IOError("Could not acquire " + port + " from the broker - " + reply["error"])
+        self.baudrate = reply.get("baudrate", self.baudrate)
+
+    def _request(self, request):
+        self._connection.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        line = self._file.readline()
+        if not line:
+            raise IOError("The broker at " + self.socket_path + " closed the connection.")
+        return json.loads(line)
+
+    def _fetch(self, wait=0):
+        reply = self._request({"op": "read", "wait": wait})
+        if "error" in reply:
+            raise IOError(reply["error"])
+        self._buffer += to_text(to_bytes(reply["data"]))
+
+    def write(self, data):
+        reply = self._request({"op": "write", "data": json_text(data)})
+        if "error" in reply:
+            raise IOError(reply["error"])
+        return len(data)
+
+    def inWaiting(self):
+        if not self._buffer:
+            self._fetch()
+        return len(self._buffer)
+
+    def read(self, size=1):
+        if not self._buffer:
+            self._fetch()
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def wait(self, timeout):
+        """
+        Wait for up to timeout seconds for there to be something to read. The
+        result is whether there is.
+        """
+        if not self._buffer:
+            self._fetch(timeout)
+        return len(self._buffer) > 0
+
+    def isOpen(self):
+        return self._connection is not None
+
+    def close(self):
+        if self._connection is not None:
+            self._file.close()
+            self._connection.close()
+            self._connection = None
+
+def json_text(data):
+    """
+    Data read from or written to a port as text that JSON can carry, with each
+    byte as the character of the same code, so that any bytes get through.
+    """
+    return to_bytes(data).decode("latin-1")
+
+def connect(socket_path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    return connection
+
+def request(socket_path, message):
+    """
+    Send one request to the broker at socket_path, on a connection of its own,
+    returning the reply.
+    """
+    connection = connect(socket_path)
+    try:
+        connection.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        reply = connection.makefile("r").readline()
+    finally:
+        connection.close()
+    if not reply:
+        raise IOError("The broker at " + socket_path + " closed the connection.")
+    return json.loads(reply)
+
+def list_devices(socket_path):
+    return request(socket_path, {"op": "list"})["devices"]
+
+def run_commands(socket_path, port, commands, enable_password=None, timeout=None):
+    """
+    Run the commands on the device on port through the broker at socket_path,
+    in enable mode if enable_password is given, returning the output of each,
+    or raising IOError if they could not be run.
+    """
+    reply = request(socket_path, {"op": "run", "port": port, "commands": commands,
+                                  "enable_password": enable_password, "timeout": timeout})
+    if "error" in reply:
+        raise IOError(reply["error"])
+    return reply["outputs"]
+
+class ConsoleBroker:
+    socket_path = ""
+
+    def __init__(self, socket_path, device_serial_ports):
+        """
+        Broker the DeviceSerialPort instances on a Unix socket at socket_path.
+        """
+        self.socket_path = socket_path
+        self.devices = dict((dev_ser_port.serial_port.port, dev_ser_port) for dev_ser_port in device_serial_ports)
+        self.owners = {}
+        self.lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                broker._handle(self.rfile, self.wfile, self)
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="console-broker")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Brokering " + str(sorted(self.devices)) + " on " + self.socket_path + ".")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        for dev_ser_port in self.devices.values():
+            dev_ser_port.serial_port.close()
+
+    def acquire(self, port, owner):
+        with self.lock:
+            if port not in self.devices:
+                return "there is no device on " + port
+            if self.owners.get(port, owner) is not owner:
+                return port + " is in use"
+            self.owners[port] = owner
+            return None
+
+    def release(self, owner, port=None):
+        """
+        Give back the device on port, or all of those of owner if port is None.
+        """
+        with self.lock:
+            for owned_port in [owned_port for owned_port, port_owner in self.owners.items() if port_owner is owner]:
+                if port is None or owned_port == port:
+                    del self.owners[owned_port]
+
+    def _handle(self, rfile, wfile, owner):
+        try:
+            for line in rfile:
+                try:
+                    reply = self._reply(json.loads(line.decode("utf-8")), owner)
+                except (ValueError, KeyError) as e:
+                    reply = {"error": "bad request - %s" % e}
+                except (IOError, OSError, TypeError, UnicodeError) as e:
+                    reply = {"error": "%s" % e}
+                try:
+                    line = json.dumps(reply)
+                except (TypeError, ValueError) as e:
+                    line = json.dumps({"error": "the reply could not be sent - %s" % e})
+                wfile.write((line + "\n").encode("utf-8"))
+                wfile.flush()
+        finally:
+            self.release(owner)
+
+    def _owned_serial_port(self, owner):
+        with self.lock:
+            for port, port_owner in self.owners.items():
+                if port_owner is owner:
+                    return self.devices[port].serial_port
+        return None
+
+    def _reply(self, request, owner):
+        from pyserial_util.cli_utils import read_show_output, exec_mode, enable, get_mode, MODE_USER, MODE_ENABLE
+
+        op = request["op"]
+        if (op == "list"):
+            with self.lock:
+                return {"devices": [{"port": port, "device_type": dev_ser_port.device_type,
+                                     "serial_number": dev_ser_port.serial_number, "in_use": port in self.owners}
+                                    for port, dev_ser_port in sorted(self.devices.items())]}
+        if (op == "acquire"):
+            error = self.acquire(request["port"], owner)
+            if error:
+                return {"error": error}
+            return {"ok": True, "baudrate": getattr(self.devices[request["port"]].serial_port, "baudrate", 9600)}
+        if (op == "release"):
+            self.release(owner, request.get("port"))
+            return {"ok": True}
+        if (op == "run"):
+            with self.lock:
+                held = self.owners.get(request["port"]) is owner
+            error = self.acquire(request["port"], owner)
+            if error:
+                return {"error": error}
+            serial_port = self.devices[request["port"]].serial_port
+            try:
+                if request.get("enable_password") is not None and enable(serial_port, request["enable_password"]):
+                    return {"error": "the device on " + request["port"] + " could not be put in enable mode"}
+                if get_mode(serial_port) not in (MODE_USER, MODE_ENABLE) and not exec_mode(serial_port):
+                    return {"error": "the device on " + request["port"] + " is not at a \">\" or \"#\" prompt"}
+                return {"outputs": [read_show_output(serial_port, command, request.get("timeout") or run_timeout)
+                                    for command in request["commands"]]}
+            finally:
+                if not held:
+                    self.release(owner, request["port"])
+
+        serial_port = self._owned_serial_port(owner)
+        if serial_port is None:
+            return {"error": "no device has been acquired"}
+        if (op == "write"):
+            data = to_text(to_bytes(request["data"]))
+            serial_port.write(data)
+            return {"written": len(data)}
+        if (op == "read"):
+            if (not serial_port.inWaiting() and request.get("wait")):
+                serial_port.wait(request["wait"])
+            return {"data": json_text(serial_port.read(serial_port.inWaiting()))}
+        return {"error": "unknown op " + op}
+
+def broker_console_ports(socket_path, selection=None):
+    """
+    Yield a DeviceSerialPort, with a BrokerSerialPort, for each of the devices
+    of the broker at socket_path that is not in use already, and that is on
+    one of the ports, or has one of the serial numbers, in selection, unless
+    selection is None. Only the devices that are yielded are acquired, so that
+    other scripts can use the rest.
+    """
+    from pyserial_util.cli_utils import DeviceSerialPort
+
+    for device in list_devices(socket_path):
+        if selection is not None and device["port"] not in selection and device["serial_number"] not in selection:
+            continue
+        if device["in_use"]:
+            logger.info("The device on " + device["port"] + " is in use, so skipping it.")
+            continue
+        try:
+            serial_port = BrokerSerialPort(socket_path, device["port"])
+        except (IOError, OSError) as e:
+            logger.info("%s" % e)
+            continue
+        yield DeviceSerialPort(serial_port, device["device_type"], device["serial_number"])
+
+def main(argv=None):
+
+    from pyserial_util import cli_utils
+
+    fileConfig('logging_config.ini')
+    #The broker is the one that uses the ports, so it cannot go through itself
+    cli_utils.console_broker_socket = None
+    cli_utils.background_readers = True
+    broker = ConsoleBroker(broker_socket, cli_utils.iter_console_ports(usb_port_base))
+    broker.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.stop()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
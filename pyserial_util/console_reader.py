@@ -0,0 +1,287 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a reader that drains a console in the background, so that nothing the
+device sends is lost between the reads of the scripts, such as syslog and boot
+messages, and so that more than one thing can follow the same output.
+
+A ConsoleReader wraps a serial port and can be used in place of it. A thread
+of its own reads everything that arrives into a RingBuffer, which is of a
+fixed size, so that the oldest output is overwritten if it is not read in
+time, rather than the buffer growing without limit. What is in the buffer can
+be followed in two ways:
+
+ - As a serial port, with inWaiting() and read(), through the ConsoleReader
+   itself, as the functions in cli_utils.py do, or through a ConsoleCursor from
+   cursor(), each of which has a position of its own in the buffer.
+ - As lines, with the time each one arrived, by the functions subscribed with
+   subscribe(), which are called from the reader thread with a ConsoleLine for
+   each line. A prompt, or anything else not followed by a new line, is given
+   as an incomplete line once nothing more has arrived for line_idle_timeout
+   seconds.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import logging
+import os
+import threading
+import time
+
+from pyserial_util.transcript import to_bytes, to_text
+
+logger = logging.getLogger()
+
+#How many bytes of output to keep for each console, how often, in seconds, to
+#look for more, and how long to wait for the rest of a line before giving the
+#subscribers what there is of it.
+ring_buffer_size = 256 * 1024
+read_interval = 0.01
+line_idle_timeout = 0.2
+
+
+class RingBuffer:
+    """
+    A fixed-size buffer of bytes, in which each byte has a position, counted
+    from the first byte ever written, so that readers can keep their place in
+    it. Once the buffer is full, each write overwrites the oldest bytes.
+    """
+    size = 0
+    end = 0
+
+    def __init__(self, size):
+        self.size = size
+        self.end = 0
+        self._data = bytearray(size)
+
+    def start(self):
+        """
+        The position of the oldest byte still in the buffer.
+        """
+        return max(0, self.end - self.size)
+
+    def write(self, data):
+        if (len(data) > self.size):
+            self.end += len(data) - self.size
+            data = data[-self.size:]
+        offset = self.end % self.size
+        first = min(len(data), self.size - offset)
+        self._data[offset:offset + first] = data[:first]
+        self._data[:len(data) - first] = data[first:]
+        self.end += len(data)
+
+    def read(self, position, size):
+        """
+        Up to size bytes from position, or from the oldest byte still in the
+        buffer if position has been overwritten. The result is a tuple of the
+        bytes and the position after them.
+        """
+        position = max(position, self.start())
+        size = min(size, self.end - position)
+        offset = position % self.size
+        first = min(size, self.size - offset)
+        view = memoryview(self._data)
+        data = bytes(view[offset:offset + first]) + bytes(view[:size - first])
+        return data, position + size
+
+class ConsoleLine:
+    timestamp = 0.0
+    text = ""
+    complete = True
+
+    def __init__(self, timestamp, text, complete=True):
+        self.timestamp = timestamp
+        self.text = text
+        self.complete = complete
+
+    def __str__(self):
+        return (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.timestamp))
+                + ".%03d " % (int(self.timestamp * 1000) % 1000) + self.text)
+
+class ConsoleCursor:
+    """
+    A place in the output of a ConsoleReader, which can be used in place of
+    the serial port to read everything from that place on.
+    """
+    reader = None
+    port = ""
+    position = 0
+    dropped = 0
+
+    def __init__(self, reader, position):
+        self.reader = reader
+        self.port = reader.port
+        self.position = position
+        self.dropped = 0
+
+    def inWaiting(self):
+        with self.reader._condition:
+            return self.reader.buffer.end - max(self.position, self.reader.buffer.start())
+
+    def read(self, size=1):
+        with self.reader._condition:
+            start = self.reader.buffer.start()
+            if (self.position < start):
+                self.dropped += start - self.position
+                logger.warning("Lost " + str(start - self.position) + " bytes of the output of " + self.port
+                               + ", as they were not read before the buffer filled up.")
+            data, self.position = self.reader.buffer.read(self.position, size)
+        return to_text(data)
+
+    def wait(self, timeout):
+        """
+        Wait for up to timeout seconds for there to be something to read. The
+        result is whether there is.
+        """
+        deadline = time.time() + timeout
+        with self.reader._condition:
+            while (self.position >= self.reader.buffer.end and self.reader.running):
+                remaining = deadline - time.time()
+                if (remaining <= 0):
+                    break
+                self.reader._condition.wait(remaining)
+            return self.position < self.reader.buffer.end
+
+    def write(self, data):
+        return self.reader.write(data)
+
+class ConsoleReader:
+    """
+    A ConsoleReader wraps a serial port, and can be used in place of it,
+    reading everything from it in the background.
+    """
+    serial_port = None
+    port = ""
+    running = False
+
+    def __init__(self, serial_port, buffer_size=None):
+        self.serial_port = serial_port
+        self.port = serial_port.port
+        self.buffer = RingBuffer(buffer_size or ring_buffer_size)
+        self._condition = threading.Condition()
+        self._cursor = ConsoleCursor(self, 0)
+        self._subscribers = []
+        self._line = ""
+        self._line_given = False
+        self._last_data_time = 0.0
+        self.running = True
+        self._thread = threading.Thread(target=self._read_console, name="reader-" + os.path.basename(self.port))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_console(self):
+        while self.running:
+            try:
+                waiting = self.serial_port.inWaiting()
+                data = self.serial_port.read(waiting) if waiting else ""
+            except (IOError, OSError) as e:
+                logger.error("Reading from " + self.port + " failed - %s" % e)
+                break
+            now = time.time()
+            if data:
+                with self._condition:
+                    self.buffer.write(to_bytes(data))
+                    self._condition.notify_all()
+                self._last_data_time = now
+                self._split_lines(to_text(data), now)
+            else:
+                if (self._line and not self._line_given and now - self._last_data_time >= line_idle_timeout):
+                    self._line_given = True
+                    self._give(ConsoleLine(self._last_data_time, self._line, False))
+                time.sleep(read_interval)
+
+        with self._condition:
+            self.running = False
+            self._condition.notify_all()
+
+    def _split_lines(self, text, now):
+        lines = (self._line + text).split("\n")
+        if self._line_given:
+            #The start of the line has been given already, so only the rest is
+            lines[0] = lines[0][len(self._line):]
+        self._line = lines.pop()
+        self._line_given = False
+        for line in lines:
+            self._give(ConsoleLine(now, line.replace("\r", "")))
+
+    def _give(self, line):
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber(line)
+            except Exception as e:
+                logger.error("A subscriber to " + self.port + " failed - %s" % e)
+
+    def subscribe(self, subscriber):
+        """
+        Call subscriber with each ConsoleLine from now on, from the reader
+        thread, so it should be quick.
+        """
+        self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+
+    def cursor(self):
+        """
+        A new ConsoleCursor, from which everything from now on can be read.
+        """
+        with self._condition:
+            return ConsoleCursor(self, self.buffer.end)
+
+    def write(self, data):
+        return self.serial_port.write(data)
+
+    def inWaiting(self):
+        return self._cursor.inWaiting()
+
+    def read(self, size=1):
+        return self._cursor.read(size)
+
+    def wait(self, timeout):
+        return self._cursor.wait(timeout)
+
+    def isOpen(self):
+        return self.running and self.serial_port.isOpen()
+
+    def close(self):
+        self.running = False
+        if (self._thread is not threading.current_thread()):
+            self._thread.join()
+        self.serial_port.close()
+
+    def __getattr__(self, name):
+        #Anything else, such as the baud rate, is that of the serial port
+        return getattr(self.serial_port, name)
+
+class ConsoleLineLog:
+    """
+    A subscriber that appends each line, with the time it arrived, to the file
+    at path.
+    """
+    path = ""
+
+    def __init__(self, path):
+        self.path = path
+        log_dir = os.path.dirname(path)
+        if log_dir and not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+
+    def __call__(self, line):
+        with open(self.path, "a") as f:
+            f.write(str(line) + ("\n" if line.complete else " ...\n"))
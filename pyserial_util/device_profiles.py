@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is the registry of what the scripts know about each type of device, so
+that it is kept in one place rather than spread through them, and so that
+another type of device can be supported by registering a profile for it.
+
+Each DeviceProfile has:
+
+ - The device type, as the scripts name it, and a compiled regular expression
+   that finds it in the output of "show hardware".
+ - The prompts, for rommon and IOS, for which the patterns in cli_utils.py are
+   the default.
+ - How long, in seconds, the device usually takes to answer a command, and how
+   long to wait for it to answer one, to copy, verify and install a file, to
+   reload and to boot, where None is the default in cli_utils.py, which has to
+   cover the slowest of the devices.
+ - The number of LAN ports, the configuration template, in the template_dir of
+   config_template.py, and the highest speed its console can be set to.
+
+identify_device_type() finds the type of a device from the output of "show
+hardware" in one pass of a single regular expression made from those of all
+of the profiles, and get_profile() gives the profile for a device type, or
+unknown_profile, with the defaults, for a type that is not registered.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import logging
+import re
+
+logger = logging.getLogger()
+
+UNKNOWN_DEVICE_TYPE = "unknown"
+
+#The prompts of the IR800 series. Their rommon has two stages, rommon-1 and
+#rommon-2, and the IOS prompt is the host name, which starts with a letter, at
+#the start of a line, so that the "#" marks as an image loads are not taken for
+#one, nor is the rommon prompt.
+IR800_ROMMON_PROMPT = re.compile(r"rommon-[12]\s*>\s*$")
+IR800_PROMPT = re.compile(r"(?:^|[\r\n])(?!rommon)[A-Za-z][\w.-]*(?:\([\w-]+\))?[>#]\s*$")
+
+
+class DeviceProfile:
+    device_type = ""
+    identification = None
+    rommon_prompt = None
+    prompt = None
+    command_latency = 1.0
+    prompt_timeout = None
+    copy_timeout = None
+    verify_timeout = None
+    install_timeout = None
+    reload_timeout = None
+    boot_timeout = None
+    lan_ports = 0
+    template_file = ""
+    max_console_speed = 9600
+
+    def __init__(self, device_type, identification, rommon_prompt=None, prompt=None, command_latency=1.0,
+                 prompt_timeout=None, copy_timeout=None, verify_timeout=None, install_timeout=None,
+                 reload_timeout=None, boot_timeout=None, lan_ports=0, template_file=None, max_console_speed=9600):
+        self.device_type = device_type
+        self.identification = identification
+        self.rommon_prompt = rommon_prompt
+        self.prompt = prompt
+        self.command_latency = command_latency
+        self.prompt_timeout = prompt_timeout
+        self.copy_timeout = copy_timeout
+        self.verify_timeout = verify_timeout
+        self.install_timeout = install_timeout
+        self.reload_timeout = reload_timeout
+        self.boot_timeout = boot_timeout
+        self.lan_ports = lan_ports
+        self.template_file = template_file or device_type + ".cfgtmpl"
+        self.max_console_speed = max_console_speed
+
+    def setting(self, name, default):
+        """
+        The prompt or timeout called name, such as "boot_timeout", for this
+        type of device, or default if it has none of its own.
+        """
+        value = getattr(self, name)
+        return default if value is None else value
+
+#The registered profiles by device type, and the regular expression made from
+#the identification expressions of all of them, with a named group for each.
+profiles = {}
+_group_device_types = {}
+_identification = None
+
+unknown_profile = DeviceProfile(UNKNOWN_DEVICE_TYPE, None)
+
+
+def register_profile(profile):
+    """
+    Add profile to the registry, replacing any profile for the same device
+    type.
+    """
+    global _identification
+
+    profiles[profile.device_type] = profile
+    _group_device_types.clear()
+    alternatives = []
+    for device_type in sorted(profiles):
+        group = "profile" + str(len(alternatives))
+        _group_device_types[group] = device_type
+        alternatives.append("(?P<" + group + ">" + profiles[device_type].identification.pattern + ")")
+    _identification = re.compile("|".join(alternatives))
+    return profile
+
+def get_profile(device_type):
+    return profiles.get(device_type, unknown_profile)
+
+def identify_device_type(response):
+    """
+    The type of the device from the output of "show hardware", from the first
+    place in it that the identification of any of the profiles matches, or
+    UNKNOWN_DEVICE_TYPE if none of them do.
+    """
+    match = _identification.search(response) if _identification else None
+    if not match:
+        return UNKNOWN_DEVICE_TYPE
+    return _group_device_types[match.lastgroup]
+
+def max_console_speeds():
+    """
+    The highest console speed of each type of device, by device type.
+    """
+    return dict((device_type, profile.max_console_speed) for device_type, profile in profiles.items())
+
+#The IR829 takes longer than the IR809 to reload and boot, as it has the
+#internal AP to reload as well.
+register_profile(DeviceProfile("IR809G-LTE-GA-K9", re.compile(r"IR809G-LTE-GA-K9"),
+                               rommon_prompt=IR800_ROMMON_PROMPT, prompt=IR800_PROMPT,
+                               command_latency=0.5, reload_timeout=300, boot_timeout=420,
+                               lan_ports=2, max_console_speed=115200))
+register_profile(DeviceProfile("IR829GW-LTE-GA-EK9", re.compile(r"IR829GW-LTE-GA-EK9"),
+                               rommon_prompt=IR800_ROMMON_PROMPT, prompt=IR800_PROMPT,
+                               command_latency=0.5, reload_timeout=420, boot_timeout=600,
+                               lan_ports=4, max_console_speed=115200))
@@ -0,0 +1,183 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is an HTTP file server that the scripts can run themselves, so that the
+devices can copy bundles and images with "copy http://... flash:", which moves
+large files at TCP speed, rather than with TFTP, which is slow over lossy links
+as each block has to be acknowledged before the next is sent.
+
+It is read only, and only serves GET and HEAD requests:
+
+ - Each file is memory-mapped once, and that one mapping is shared by all of
+   the requests for the file.
+ - Each connection is handled in a thread of its own, and connections are kept
+   alive between requests, as HTTP/1.1 allows.
+ - Single "Range: bytes=..." requests are supported, so that a transfer can be
+   picked up from where it stopped.
+ - The bytes, time taken and bytes/sec of each request are logged.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+
+from pyserial_util.mapped_files import MappedFiles
+
+logger = logging.getLogger()
+
+BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+chunk_size = 256 * 1024
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _ImageRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self._send_file(head_only=True)
+
+    def do_GET(self):
+        self._send_file(head_only=False)
+
+    def _send_file(self, head_only):
+        files = self.server.mapped_files
+        path = files.resolve(unquote(self.path.split("?", 1)[0]))
+        if path is None:
+            self.send_error(403, "Outside of the server root")
+            return
+
+        try:
+            entry = files.acquire(path)
+        except (IOError, OSError):
+            self.send_error(404, "File not found")
+            return
+
+        try:
+            data = entry[0]
+            size = len(data)
+            start, end = 0, size - 1
+            status = 200
+
+            byte_range = self.headers.get("Range")
+            if byte_range:
+                match = BYTE_RANGE.match(byte_range.strip())
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1):
+                        start = int(match.group(1))
+                        if match.group(2):
+                            end = min(int(match.group(2)), size - 1)
+                    else:
+                        start = max(size - int(match.group(2)), 0)
+                    if (start >= size or start > end):
+                        self.send_response(416)
+                        self.send_header("Content-Range", "bytes */" + str(size))
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    status = 206
+
+            length = end - start + 1
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            if (status == 206):
+                self.send_header("Content-Range", "bytes " + str(start) + "-" + str(end) + "/" + str(size))
+            self.end_headers()
+
+            if head_only:
+                return
+
+            start_time = time.time()
+            position = start
+            while (position <= end):
+                self.wfile.write(data[position:min(position + chunk_size, end + 1)])
+                position += chunk_size
+            seconds = time.time() - start_time
+            rate = length / seconds if seconds > 0 else 0.0
+            logger.info("HTTP sent " + str(length) + " bytes of " + self.path + " to " + self.client_address[0]
+                        + " in " + "%.3f" % seconds + " secs (" + "%.0f" % rate + " bytes/sec).")
+        except (socket.error, IOError) as e:
+            logger.error("HTTP transfer of " + self.path + " to " + self.client_address[0] + " failed - %s" % e)
+            self.close_connection = True
+        finally:
+            files.release(path, entry)
+
+    def log_message(self, format, *args):
+        logger.debug("HTTP " + self.client_address[0] + " - " + (format % args))
+
+class ImageHTTPServer:
+    root = ""
+    host = ""
+    port = 80
+
+    def __init__(self, root, host="", port=80):
+        """
+        Serve the files under the root directory on the given host address and
+        TCP port, where an empty host is all addresses.
+        """
+        self.root = root
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Bind the server socket and start serving in a background thread, or
+        raise IOError if the root is not a directory.
+        """
+        if not os.path.isdir(self.root):
+            raise IOError("Not serving \"" + self.root + "\", as it is not a directory.")
+        self._server = _ThreadingHTTPServer((self.host, self.port), _ImageRequestHandler)
+        self._server.mapped_files = MappedFiles(self.root)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="http-server")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("HTTP server serving " + self._server.mapped_files.root + " on port " + str(self.port) + ".")
+
+    def stop(self):
+        """
+        Stop serving, and unmap the files once no requests are using them.
+        """
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server.mapped_files.close()
+            self._server = None
+        if self._thread:
+            self._thread.join()
+            self._thread = None
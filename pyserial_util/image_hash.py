@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a cache, kept on disk between runs, of the MD5 hashes of the local
+copies of the bundles and images, so that each of those large files is only
+read and hashed once, rather than once per device and run.
+
+An entry is keyed by the absolute path of the file, and is only used while the
+size and modification time of the file are the same as when it was hashed.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import hashlib
+import logging
+import os
+import threading
+
+from pyserial_util.atomic_file import load_json, save_json
+
+logger = logging.getLogger()
+
+chunk_size = 1024 * 1024
+
+
+class ImageHashCache:
+    cache_file = ""
+    
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.entries = load_json(cache_file, "image hash cache") or {}
+            
+    def get_md5(self, path):
+        """
+        The MD5 hash of the file at path, as a lower case hex string, from the
+        cache if the file has not changed since it was hashed.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        
+        #Only one file is hashed at a time, so that devices asking for the same
+        #file at the same time wait for the one hash rather than all reading it
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                return entry["md5"]
+            
+            logger.info("Calculating the MD5 hash of " + path + ".")
+            md5 = hashlib.md5()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    md5.update(chunk)
+                    
+            self.entries[path] = {"size" : stat.st_size, "mtime" : stat.st_mtime, "md5" : md5.hexdigest()}
+            self._save()
+            return md5.hexdigest()
+        
+    def _save(self):
+        save_json(self.cache_file, self.entries, "image hash cache")
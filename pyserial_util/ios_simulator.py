@@ -0,0 +1,1050 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a simulator of the consoles of IR800 series routers, so that the scripts
+here can be run, tested and timed without any real devices.
+
+Each simulated device is a SimulatedDevice, which follows the console input
+and answers with the prompts and dialogs that the scripts expect, including:
+
+ - rommon, and booting IOS from it.
+ - The initial configuration dialog, when there is no startup configuration.
+ - enable, configure terminal, and the configuration lines sent by the scripts.
+ - show hardware, show running-config, show startup-config and show iox, with
+   --More-- paging and the "| include", "| exclude" and "| begin" filters.
+ - Lines starting with "!", which are echoed and otherwise ignored.
+ - copy from TFTP and HTTP to flash, which really fetches the file from the
+   server, with the "!" progress marks, the "[confirm]" when overwriting, and
+   Ctrl-Shift-6 to stop it.
+ - dir, verify /md5, write memory, clear start, bundle install and guest-os.
+ - "speed" under "line con 0", after which the console is only readable at
+   the new speed.
+ - reload, with the "[yes/no]" and "[confirm]" questions, after which the
+   device boots the "boot system" image, or stops at rommon without one.
+
+How long the devices take to respond to each kind of command is set by the
+latencies, as in default_latencies, and all of the latencies are multiplied by
+latency_scale, so that the scripts can be run against devices that are as
+slow as the real ones, or much faster.
+
+The devices can be connected to in two ways:
+
+ - IOSSimulator makes a pseudo-terminal for each device, with a link to it in
+   a directory of its own named usb_port_base plus a number, as with the USB
+   consoles under /dev/. Setting console_dev_dir in cli_utils.py to that
+   directory has the scripts find and use the simulated devices as they would
+   the real ones.
+ - SimulatedSerialPort is an object that can be used in place of a pySerial
+   port, in the same process, without a pseudo-terminal.
+
+Running this module starts an IOSSimulator with simulated_devices devices,
+until it is interrupted.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import errno
+import hashlib
+import logging
+import os
+import re
+import select
+import sys
+import tempfile
+import threading
+import termios
+import time
+import tty
+
+from logging.config import fileConfig
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from pyserial_util import tftp_server
+
+logger = logging.getLogger()
+
+#The ports, devices and images that main() simulates.
+usb_port_base = "cu.SLAB_USBtoUART"
+simulator_dev_dir = os.path.join(tempfile.gettempdir(), "ios_simulator")
+simulated_devices = 4
+simulated_device_types = ["IR809G-LTE-GA-K9", "IR829GW-LTE-GA-EK9"]
+simulated_boot_image = "ir800-universalk9_npe-mz.SPA.156-2.T"
+
+#How long, in seconds, the simulated devices take to do each kind of thing,
+#all multiplied by latency_scale.
+default_latencies = {
+    "command": 0.01,
+    "show": 0.05,
+    "write_memory": 1.0,
+    "erase": 0.5,
+    "verify": 2.0,
+    "install": 5.0,
+    "reload": 10.0,
+    "boot": 30.0,
+}
+latency_scale = 1.0
+
+#How fast the simulated consoles send output, in bits/sec, with 10 bits for
+#each character as on a real serial line, or None for as fast as possible. Set
+#simulate_console_speed to True to send it at the console speed of each device
+#instead, as set with "speed" under "line con 0".
+console_bits_per_second = None
+simulate_console_speed = False
+
+#The most bytes/sec that the simulated copies go at, or None for as fast as the
+#server, how many bytes each "!" mark is, and the TFTP port the copies use.
+copy_bytes_per_second = None
+bytes_per_mark = 16384
+tftp_port = 69
+
+MARK = "!"
+ESCAPE = "\x1e"
+CTRL_Z = "\x1a"
+BACKSPACES = "\x08\x7f"
+COMMENTS = ("!",)
+
+#The modes a simulated device can be in.
+STATE_DOWN = "down"
+STATE_ROMMON = "rommon"
+STATE_DIALOG = "dialog"
+STATE_USER = "user"
+STATE_ENABLE = "enable"
+STATE_CONFIG = "config"
+
+ROMMON_PROMPT = "rommon-2> "
+INITIAL_DIALOG = ("\r\n         --- System Configuration Dialog ---\r\n\r\n"
+                  "Would you like to enter the initial configuration dialog? [yes/no]: ")
+CONSOLE_SPEEDS = [1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200]
+DEFAULT_CONSOLE_SPEED = 9600
+INVALID_INPUT = "^\r\n% Invalid input detected at '^' marker.\r\n\r\n"
+
+#The configuration commands that start a section, and the mode they go into.
+SECTION_MODES = [
+    ("interface", "config-if"),
+    ("line", "config-line"),
+    ("router", "config-router"),
+    ("ip dhcp pool", "dhcp-config"),
+    ("ip access-list", "config-acl"),
+    ("class-map", "config-cmap"),
+    ("policy-map", "config-pmap"),
+    ("crypto", "config-crypto"),
+]
+
+NO_SHUTDOWN = re.compile(r"^no shut(d(o(w(n)?)?)?)?$")
+FLASH_FILE = re.compile(r"^flash:/?(.*)$")
+COPY_URL = re.compile(r"^(tftp|http)://([^/:]+)(?::(\d+))?/(.+)$")
+
+
+def is_command(words, *keywords):
+    """
+    Whether the words typed are the keywords, allowing each word to be cut
+    short as IOS does, such as "conf t" for "configure terminal".
+    """
+    if len(words) < len(keywords):
+        return False
+    for word, keyword in zip(words, keywords):
+        if not keyword.startswith(word.lower()):
+            return False
+    return True
+
+def flash_file_name(argument):
+    """
+    The file name from "flash:/name" or "flash:name", or None if the argument
+    is not in flash.
+    """
+    if (argument == "flash"):
+        return ""
+    match = FLASH_FILE.match(argument)
+    if match:
+        return match.group(1)
+    return None
+
+class SimulatedDevice:
+    device_type = ""
+    serial_number = ""
+    hostname = "Router"
+    enable_password = None
+    state = STATE_DOWN
+    console_speed = DEFAULT_CONSOLE_SPEED
+
+    def __init__(self, device_type, serial_number, enable_password=None, latencies=None,
+                 start_in_rommon=False, startup_config=None, flash=None):
+        """
+        A device of the given type and serial number. It starts at rommon if
+        start_in_rommon, or else running IOS, at the initial configuration
+        dialog if there is no startup_config, which is a list of lines. flash
+        maps the names of the files already in flash to (size, md5) tuples.
+        The latencies are any to use rather than those in default_latencies.
+        """
+        self.device_type = device_type
+        self.serial_number = serial_number
+        self.enable_password = enable_password
+        self.latencies = dict(default_latencies)
+        if latencies:
+            self.latencies.update(latencies)
+        self.start_in_rommon = start_in_rommon
+        self.startup_config = list(startup_config) if startup_config is not None else None
+        self.flash = dict(flash or {})
+
+        self.hostname = "Router"
+        self.state = STATE_DOWN
+        self.running_config = []
+        self.section = None
+        self.terminal_length = 24
+        self.console_speed = DEFAULT_CONSOLE_SPEED
+        self.guest_os_image = None
+        self.guest_os_running = False
+        self.boot_count = 0
+
+        self._input = ""
+        self._last_char = ""
+        self._escape = False
+        self._condition = threading.Condition()
+        self._output = None
+        self._running = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def attach(self, output):
+        """
+        Start the device, sending everything it writes to its console to the
+        output function.
+        """
+        self._output = output
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="sim-" + self.serial_number)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def input(self, data):
+        """
+        Characters typed on the console of the device.
+        """
+        with self._condition:
+            if ESCAPE in data:
+                self._escape = True
+            self._input += data
+            self._condition.notify_all()
+
+    def _run(self):
+        try:
+            if self.start_in_rommon:
+                self._enter_rommon()
+            else:
+                self._load_startup_config()
+                if self.state == STATE_DIALOG:
+                    self._emit(INITIAL_DIALOG)
+
+            while self._running:
+                line = self._read_line(echo=True)
+                if line is None:
+                    break
+                if self._handle(line) is not False:
+                    self._emit(self._prompt())
+        except Exception as e:
+            logger.error("Simulated device " + self.serial_number + " failed - %s" % e)
+
+    def _handle(self, line):
+        """
+        Act on a line typed at the console, returning False if the prompt is
+        not to follow.
+        """
+        if (self.state == STATE_ROMMON):
+            return self._rommon_command(line.strip())
+        if (self.state == STATE_DIALOG):
+            return self._dialog_answer(line.strip())
+        if line.strip().startswith(COMMENTS):
+            return
+        if (self.state == STATE_CONFIG):
+            return self._config_command(line)
+        return self._exec_command(line.strip())
+
+    def _prompt(self):
+        if (self.state == STATE_ROMMON):
+            return ROMMON_PROMPT
+        if (self.state == STATE_USER):
+            return self.hostname + ">"
+        if (self.state == STATE_CONFIG):
+            if self.section:
+                return self.hostname + "(" + self.section[2] + ")#"
+            return self.hostname + "(config)#"
+        return self.hostname + "#"
+
+    def _emit(self, text):
+        bits_per_second = self.console_speed if simulate_console_speed else console_bits_per_second
+        if bits_per_second:
+            time.sleep(len(text) * 10.0 / bits_per_second)
+        if self._output:
+            self._output(text)
+
+    def _wait(self, latency):
+        self._stopped.wait(self.latencies.get(latency, 0) * latency_scale)
+
+    def _discard_input(self):
+        with self._condition:
+            self._input = ""
+            self._escape = False
+
+    def _read_char(self):
+        with self._condition:
+            while self._running and not self._input:
+                self._condition.wait(0.5)
+            if not self._running:
+                return None
+            char = self._input[0]
+            self._input = self._input[1:]
+            return char
+
+    def _read_line(self, echo=True):
+        """
+        Read a line from the console, echoing it if echo, up to a carriage
+        return or a newline, with a newline straight after a carriage return
+        being part of the same line end. The result is None when the device
+        is stopped, and CTRL_Z for Ctrl-Z.
+        """
+        line = ""
+        while True:
+            char = self._read_char()
+            if char is None:
+                return None
+            last_char = self._last_char
+            self._last_char = char
+            if (char == "\n" and last_char == "\r"):
+                continue
+            if char in "\r\n":
+                self._emit("\r\n")
+                return line
+            if (char == CTRL_Z):
+                self._emit("^Z\r\n")
+                return CTRL_Z
+            if (char == ESCAPE):
+                continue
+            if char in BACKSPACES:
+                if line:
+                    line = line[:-1]
+                    if echo:
+                        self._emit("\x08 \x08")
+                continue
+            line += char
+            if echo:
+                self._emit(char)
+
+    def _ask(self, question, echo=True):
+        self._emit(question)
+        answer = self._read_line(echo)
+        if answer is None:
+            return ""
+        return answer.strip()
+
+    def _invalid_input(self):
+        self._emit(" " * len(self._prompt()) + INVALID_INPUT)
+
+    #Booting
+
+    def _enter_rommon(self):
+        self.state = STATE_ROMMON
+        self.guest_os_running = False
+        self._emit("\r\nSystem Bootstrap, Version 15.6(2r)T, RELEASE SOFTWARE (fc1)\r\n"
+                   "Copyright (c) 2016 by cisco Systems, Inc.\r\n\r\n")
+
+    def _boot(self, image):
+        self.state = STATE_DOWN
+        self._emit("Loading flash:/" + image + " ...\r\n")
+        self._wait("boot")
+        self.boot_count += 1
+        self._emit("\r\nCisco IOS Software, ir800 Software (ir800-UNIVERSALK9-M), Version 15.6(2)T, "
+                   "RELEASE SOFTWARE (fc1)\r\n"
+                   "cisco " + self.device_type + " (revision 1.0) with 370688K/22528K bytes of memory.\r\n"
+                   "Processor board ID " + self.serial_number + "\r\n")
+        self._discard_input()
+        self._load_startup_config()
+        if (self.state == STATE_DIALOG):
+            self._emit(INITIAL_DIALOG)
+        else:
+            self._emit("\r\nPress RETURN to get started!\r\n\r\n")
+        return False
+
+    def _load_startup_config(self):
+        self.hostname = "Router"
+        self.running_config = []
+        self.section = None
+        self.terminal_length = 24
+        self.console_speed = DEFAULT_CONSOLE_SPEED
+        if self.startup_config is None:
+            self.state = STATE_DIALOG
+            return
+        self.state = STATE_CONFIG
+        for line in self.startup_config:
+            self._config_command(line, quiet=True)
+        self.section = None
+        self.state = STATE_USER
+
+    def _rommon_command(self, line):
+        words = line.split()
+        if not words:
+            return
+        if (words[0] == "boot"):
+            image = flash_file_name(words[1]) if len(words) > 1 else self._boot_image()
+            if image and image in self.flash:
+                return self._boot(image)
+            self._emit("boot: cannot determine first file name on device \"flash:/" + (image or "") + "\"\r\n")
+            return
+        if (words[0] == "reset"):
+            self._wait("reload")
+            return self._reload_to_image()
+        self._emit("monitor: command \"" + words[0] + "\" not found\r\n")
+
+    def _dialog_answer(self, answer):
+        if answer.lower() in ("no", "n"):
+            self.state = STATE_USER
+            self._emit("\r\nPress RETURN to get started!\r\n\r\n")
+        else:
+            self._emit("% Please answer 'yes' or 'no'.\r\n"
+                       "Would you like to enter the initial configuration dialog? [yes/no]: ")
+        return False
+
+    #Exec mode
+
+    def _exec_command(self, line):
+        command, bar, pipe = line.partition("|")
+        words = command.split()
+        if not words:
+            return
+
+        self._wait("command")
+        enabled = (self.state == STATE_ENABLE)
+
+        if is_command(words, "enable"):
+            return self._enable()
+        if is_command(words, "disable"):
+            self.state = STATE_USER
+            return
+        if (is_command(words, "exit") or is_command(words, "logout")):
+            self.state = STATE_USER
+            self._emit("\r\n\r\n" + self.hostname + " con0 is now available\r\n\r\n\r\n\r\n"
+                       "Press RETURN to get started.\r\n\r\n")
+            return False
+        if is_command(words, "terminal", "length") and len(words) > 2 and words[2].isdigit():
+            self.terminal_length = int(words[2])
+            return
+        if is_command(words, "show"):
+            return self._show(words[1:], pipe, enabled)
+        if not enabled:
+            self._invalid_input()
+            return
+
+        if is_command(words, "configure", "terminal") or (len(words) == 1 and is_command(words, "configure")):
+            self.state = STATE_CONFIG
+            self.section = None
+            self._emit("Enter configuration commands, one per line.  End with CNTL/Z.\r\n")
+            return
+        if is_command(words, "dir"):
+            return self._dir(words[1] if len(words) > 1 else "flash:")
+        if is_command(words, "verify", "/md5") and len(words) > 2:
+            return self._verify_md5(words[2])
+        if is_command(words, "copy", "running-config", "startup-config"):
+            self._ask("Destination filename [startup-config]? ")
+            return self._write_memory()
+        if is_command(words, "copy") and len(words) > 2:
+            return self._copy(words[1], words[2])
+        if is_command(words, "write", "erase") or is_command(words, "erase") or is_command(words, "clear", "start"):
+            return self._erase()
+        if is_command(words, "write"):
+            return self._write_memory()
+        if is_command(words, "reload"):
+            return self._reload()
+        if is_command(words, "bundle", "install") and len(words) > 2:
+            return self._bundle_install(words[2])
+        if is_command(words, "guest-os"):
+            return self._guest_os(words[1:])
+        self._invalid_input()
+
+    def _enable(self):
+        if (self.state == STATE_ENABLE or not self.enable_password):
+            self.state = STATE_ENABLE
+            return
+        for attempt in range(3):
+            if (self._ask("Password: ", echo=False) == self.enable_password):
+                self.state = STATE_ENABLE
+                return
+        self._emit("% Bad passwords\r\n\r\n")
+
+    def _show(self, words, pipe, enabled):
+        self._wait("show")
+        if (is_command(words, "hardware") or is_command(words, "version")):
+            text = self._version()
+        elif enabled and is_command(words, "running-config"):
+            config = self._render_config()
+            text = ("Building configuration...\r\n\r\nCurrent configuration : " + str(len("\n".join(config)))
+                    + " bytes\r\n!\r\n" + "\r\n".join(config) + "\r\nend\r\n")
+        elif enabled and is_command(words, "startup-config"):
+            if self.startup_config is None:
+                text = "startup-config is not present\r\n"
+            else:
+                text = ("Using " + str(len("\n".join(self.startup_config))) + " out of 4194304 bytes\r\n!\r\n"
+                        + "\r\n".join(self.startup_config) + "\r\nend\r\n")
+        elif enabled and is_command(words, "iox"):
+            text = ("\r\nIOx Infrastructure Summary:\r\n---------------------------\r\n"
+                    "IOx service (CAF)    : " + ("Running" if self.guest_os_running else "Not Running") + "\r\n"
+                    "IOx service (HA)     : Not Running\r\n"
+                    "IOx service (IOxman) : " + ("Running" if self.guest_os_running else "Not Running") + "\r\n"
+                    "Libvirtd             : Running\r\n")
+        else:
+            self._invalid_input()
+            return
+
+        lines = text.split("\r\n")
+        pipe_words = pipe.split(None, 1)
+        if (len(pipe_words) == 2):
+            pattern = re.compile(pipe_words[1])
+            if is_command(pipe_words, "include"):
+                lines = [line for line in lines if pattern.search(line)]
+            elif is_command(pipe_words, "exclude"):
+                lines = [line for line in lines if not pattern.search(line)]
+            elif is_command(pipe_words, "begin"):
+                for index, line in enumerate(lines):
+                    if pattern.search(line):
+                        lines = lines[index:]
+                        break
+                else:
+                    lines = []
+        return self._page(lines)
+
+    def _page(self, lines):
+        """
+        Show lines of output, a screen at a time with --More-- in between
+        unless the terminal length is 0.
+        """
+        page_size = self.terminal_length - 1 if self.terminal_length else len(lines)
+        index = 0
+        while index < len(lines):
+            page = lines[index:index + max(page_size, 1)]
+            index += len(page)
+            self._emit("\r\n".join(page) + "\r\n")
+            if (index < len(lines)):
+                self._emit(" --More-- ")
+                char = self._read_char()
+                self._emit("\x08" * 10 + " " * 10 + "\x08" * 10)
+                if char is None or char in "qQ":
+                    break
+                if char in "\r\n":
+                    page_size = 1
+                else:
+                    page_size = self.terminal_length - 1
+
+    def _version(self):
+        image = self._boot_image() or ""
+        return ("Cisco IOS Software, ir800 Software (ir800-UNIVERSALK9-M), Version 15.6(2)T, RELEASE SOFTWARE (fc1)\r\n"
+                "Technical Support: http://www.cisco.com/techsupport\r\n"
+                "Copyright (c) 1986-2016 by Cisco Systems, Inc.\r\n"
+                "\r\n"
+                "ROM: System Bootstrap, Version 15.6(2r)T, RELEASE SOFTWARE (fc1)\r\n"
+                "\r\n"
+                + self.hostname + " uptime is 1 minute\r\n"
+                "System image file is \"flash:/" + image + "\"\r\n"
+                "\r\n"
+                "cisco " + self.device_type + " (revision 1.0) with 370688K/22528K bytes of memory.\r\n"
+                "Processor board ID " + self.serial_number + "\r\n"
+                "\r\n"
+                "Device       PID                   VID   SN\r\n"
+                "*0           " + self.device_type + "    V01   " + self.serial_number + "\r\n"
+                "\r\n"
+                "Configuration register is 0x2102\r\n")
+
+    def _dir(self, argument):
+        filename = flash_file_name(argument)
+        if filename is None:
+            self._invalid_input()
+            return
+        if filename and filename not in self.flash:
+            self._emit("%Error opening flash:/" + filename + " (No such file or directory)\r\n\r\n")
+            return
+        names = [filename] if filename else sorted(self.flash)
+        self._emit("Directory of flash:/\r\n\r\n")
+        for index, name in enumerate(names):
+            self._emit("%6d  -rw- %12d  Mar 1 2016 00:00:00 +00:00  %s\r\n" % (index + 1, self.flash[name][0], name))
+        self._emit("\r\n1621966848 bytes total (1000000000 bytes free)\r\n")
+
+    def _verify_md5(self, argument):
+        filename = flash_file_name(argument)
+        if filename not in self.flash:
+            self._emit("%Error opening flash:/" + str(filename) + " (No such file or directory)\r\n")
+            return
+        self._emit(".....")
+        self._wait("verify")
+        self._emit("Done!\r\nverify /md5 (flash:/" + filename + ") = " + self.flash[filename][1] + "\r\n\r\n")
+
+    def _copy(self, source, destination):
+        if (flash_file_name(destination) is None):
+            self._invalid_input()
+            return
+
+        if source in ("tftp", "tftp:"):
+            host = self._ask("Address or name of remote host []? ")
+            path = self._ask("Source filename []? ")
+            url = "tftp://" + host + "/" + path
+        else:
+            url = source
+        match = COPY_URL.match(url)
+        if not match:
+            self._emit("%Error parsing filename (Invalid argument)\r\n")
+            return
+        scheme, host, port, path = match.groups()
+
+        default_name = flash_file_name(destination) or os.path.basename(path)
+        filename = self._ask("Destination filename [" + default_name + "]? ") or default_name
+        if filename in self.flash:
+            answer = self._ask("%Warning:There is a file already existing with this name \r\n"
+                               "Do you want to over write? [confirm]")
+            if answer.lower() not in ("", "y", "yes"):
+                self._emit("%Copy aborted\r\n")
+                return
+
+        self._emit("Accessing " + url + "...\r\n")
+        if (scheme == "tftp"):
+            self._emit("Loading " + path + " from " + host + " (via GigabitEthernet0): ")
+        else:
+            self._emit("Loading " + url + " ")
+
+        with self._condition:
+            self._escape = False
+        progress = {"bytes": 0, "marks": 0}
+        start_time = time.time()
+
+        def on_data(size):
+            if self._escape or not self._running:
+                raise IOError("Interrupted")
+            progress["bytes"] += size
+            marks = progress["bytes"] // bytes_per_mark
+            if (marks > progress["marks"]):
+                self._emit(MARK * (marks - progress["marks"]))
+                progress["marks"] = marks
+            if copy_bytes_per_second:
+                ahead = progress["bytes"] / float(copy_bytes_per_second) - (time.time() - start_time)
+                if (ahead > 0):
+                    time.sleep(ahead)
+
+        try:
+            if (scheme == "tftp"):
+                data = tftp_server.fetch(host, path, int(port or tftp_port), on_data=on_data)
+            else:
+                data = b""
+                response = urlopen(url, timeout=30)
+                try:
+                    chunks = []
+                    while True:
+                        chunk = response.read(65536)
+                        if not chunk:
+                            break
+                        chunks.append(chunk)
+                        on_data(len(chunk))
+                    data = b"".join(chunks)
+                finally:
+                    response.close()
+        except (IOError, OSError) as e:
+            reason = "Interrupted" if "Interrupted" in str(e) else "Timed out"
+            self._emit("\r\n%Error opening " + url + " (" + reason + ")\r\n")
+            return
+
+        if (len(data) > progress["marks"] * bytes_per_mark):
+            self._emit(MARK)
+        seconds = max(time.time() - start_time, 0.001)
+        self.flash[filename] = (len(data), hashlib.md5(data).hexdigest())
+        self._emit("\r\n[OK - " + str(len(data)) + " bytes]\r\n\r\n" + str(len(data)) + " bytes copied in "
+                   + "%.3f" % seconds + " secs (" + str(int(len(data) / seconds)) + " bytes/sec)\r\n")
+
+    def _write_memory(self):
+        self._emit("Building configuration...\r\n")
+        self._wait("write_memory")
+        self.startup_config = self._render_config()
+        self._emit("[OK]\r\n")
+
+    def _erase(self):
+        answer = self._ask("Erasing the nvram filesystem will remove all configuration files! Continue? [confirm]")
+        if answer.lower() not in ("", "y", "yes"):
+            return
+        self._wait("erase")
+        self.startup_config = None
+        self._emit("[OK]\r\nErase of nvram: complete\r\n")
+
+    def _reload(self):
+        if self.device_type.startswith("IR829"):
+            if self._ask_yes_no("Do you want to reload the internal AP ? [yes/no]: "):
+                self._ask_yes_no("Do you want to save the configuration of the AP? [yes/no]: ")
+        if (self._render_config() != self.startup_config):
+            if self._ask_yes_no("System configuration has been modified. Save? [yes/no]: "):
+                self._write_memory()
+        answer = self._ask("Proceed with reload? [confirm]")
+        if answer.lower() not in ("", "y", "yes"):
+            return
+
+        self.state = STATE_DOWN
+        self._emit("\r\n*Mar  1 00:10:00.000: %SYS-5-RELOAD: Reload requested by console. "
+                   "Reload Reason: Reload Command.\r\n")
+        self._wait("reload")
+        self._discard_input()
+        return self._reload_to_image()
+
+    def _reload_to_image(self):
+        image = self._boot_image()
+        if image and image in self.flash:
+            return self._boot(image)
+        self._enter_rommon()
+
+    def _ask_yes_no(self, question):
+        while True:
+            answer = self._ask(question).lower()
+            if answer in ("yes", "y"):
+                return True
+            if answer in ("no", "n"):
+                return False
+            self._emit("% Please answer 'yes' or 'no'.\r\n")
+
+    def _bundle_install(self, argument):
+        filename = flash_file_name(argument)
+        if filename not in self.flash:
+            self._emit("%Error opening flash:/" + str(filename) + " (No such file or directory)\r\n")
+            return
+        self._emit("Installing bundle flash:/" + filename + "\r\n")
+        self._wait("install")
+        self._emit("Bundle installed.\r\n")
+
+    def _guest_os(self, words):
+        if (len(words) >= 2 and is_command(words[1:], "stop")):
+            self.guest_os_running = False
+            self._emit("% Guest OS " + words[0] + " stopped\r\n")
+        elif (len(words) >= 2 and is_command(words[1:], "start")):
+            self.guest_os_running = bool(self.guest_os_image)
+        elif (len(words) >= 3 and is_command(words[1:], "image", "uninstall")):
+            self.guest_os_image = None
+            self.guest_os_running = False
+        elif (len(words) >= 4 and is_command(words[1:], "image", "install")):
+            filename = flash_file_name(words[3])
+            if filename not in self.flash:
+                self._emit("%Error opening flash:/" + str(filename) + " (No such file or directory)\r\n")
+            elif ("ioxvm" not in filename):
+                self._emit("% Inappropriate image type\r\n")
+            else:
+                self._emit("Verifying flash:/" + filename + " ")
+                self._wait("install")
+                self.guest_os_image = filename
+                self.guest_os_running = True
+                self._emit("\r\nGuest OS image installed.\r\n")
+        else:
+            self._invalid_input()
+
+    #Configuration mode
+
+    def _config_command(self, line, quiet=False):
+        """
+        Act on a line of configuration. A line that is not indented ends the
+        section that the lines before it were in, unless it is "exit", as
+        the lines of a configuration file are indented in their sections.
+        When quiet, as when loading the startup configuration, nothing is
+        shown.
+        """
+        if (line == CTRL_Z):
+            self.state = STATE_ENABLE
+            self.section = None
+            return
+        indented = line[:1].isspace()
+        line = " ".join(line.split())
+        if not line or line.startswith(COMMENTS):
+            return
+        words = line.split()
+
+        if not quiet:
+            self._wait("command")
+        if (line == "end"):
+            self.state = STATE_ENABLE
+            self.section = None
+            return
+        if (line == "exit"):
+            if self.section:
+                self.section = None
+            else:
+                self.state = STATE_ENABLE
+            return
+        if (words[0] == "do"):
+            if quiet:
+                return
+            return self._exec_command(" ".join(words[1:]))
+
+        #"speed" is only a line command, so it is in the section however it is indented
+        if self.section and (indented or words[0] == "speed"):
+            if (words[0] == "speed" and self.section[0].startswith("line con")):
+                return self._set_console_speed(self.section[1], words, quiet)
+            self._set_line(self.section[1], line)
+            return
+        self.section = None
+
+        for keyword, mode in SECTION_MODES:
+            if is_command(words, *keyword.split()) and len(words) > len(keyword.split()):
+                for entry in self.running_config:
+                    if (entry[0] == line):
+                        break
+                else:
+                    entry = [line, []]
+                    self.running_config.append(entry)
+                self.section = (entry[0], entry[1], mode)
+                return
+
+        if (words[0] == "hostname" and len(words) > 1):
+            self.hostname = words[1]
+            return
+        if (words[0] == "enable" and len(words) > 2 and words[1] in ("secret", "password")):
+            self.enable_password = words[-1]
+        if (words[0] == "no" and len(words) > 1):
+            remainder = " ".join(words[1:])
+            self.running_config = [entry for entry in self.running_config
+                                   if not (entry[0] == remainder or entry[0].startswith(remainder + " "))]
+            return
+        if (line not in [entry[0] for entry in self.running_config]):
+            self.running_config.append([line, []])
+
+    def _set_console_speed(self, lines, words, quiet):
+        if (len(words) != 2 or not words[1].isdigit() or int(words[1]) not in CONSOLE_SPEEDS):
+            if not quiet:
+                self._invalid_input()
+            return
+        lines[:] = [existing for existing in lines if not existing.startswith("speed ")]
+        if (int(words[1]) != DEFAULT_CONSOLE_SPEED):
+            lines.append(" ".join(words))
+        #The prompt after this line is already at the new speed
+        self.console_speed = int(words[1])
+
+    def _set_line(self, lines, line):
+        if NO_SHUTDOWN.match(line):
+            lines[:] = [existing for existing in lines if existing != "shutdown"]
+            return
+        words = line.split()
+        if (words[0] == "no" and " ".join(words[1:]) in lines):
+            lines.remove(" ".join(words[1:]))
+            return
+        if (line not in lines):
+            lines.append(line)
+
+    def _render_config(self):
+        config = ["version 15.6", "hostname " + self.hostname]
+        for line, sub_lines in self.running_config:
+            config.append(line)
+            config.extend([" " + sub_line for sub_line in sub_lines])
+        return config
+
+    def _boot_image(self):
+        config = self.startup_config or []
+        for line in config:
+            words = line.split()
+            if (words[:2] == ["boot", "system"] and len(words) > 2):
+                return flash_file_name(words[2])
+        return None
+
+class SimulatedSerialPort:
+    """
+    An object that can be used in place of a pySerial port to talk to a
+    SimulatedDevice in the same process.
+    """
+    port = ""
+    baudrate = 9600
+
+    def __init__(self, device, port):
+        self.device = device
+        self.port = port
+        self._buffer = ""
+        self._lock = threading.Lock()
+        device.attach(self._receive)
+
+    def _receive(self, text):
+        if (self.baudrate != self.device.console_speed):
+            text = garble(text)
+        with self._lock:
+            self._buffer += text
+
+    def write(self, data):
+        #A console at the wrong speed only sees framing errors
+        if (self.baudrate == self.device.console_speed):
+            self.device.input(data)
+        return len(data)
+
+    def inWaiting(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def read(self, size=1):
+        with self._lock:
+            data = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            return data
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        pass
+
+class IOSSimulator:
+    devices = None
+    dev_dir = ""
+    usb_port_base = ""
+
+    def __init__(self, devices, dev_dir, usb_port_base):
+        """
+        Simulate the consoles of the SimulatedDevice devices on pseudo-terminals
+        linked to from dev_dir, named usb_port_base plus a number.
+        """
+        self.devices = devices
+        self.dev_dir = dev_dir
+        self.usb_port_base = usb_port_base
+        self.port_paths = []
+        self._consoles = []
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """
+        Make the pseudo-terminals and their links, and start the devices.
+        """
+        if not os.path.isdir(self.dev_dir):
+            os.makedirs(self.dev_dir)
+
+        self._running = True
+        for index, device in enumerate(self.devices):
+            master, slave = os.openpty()
+            tty.setraw(slave)
+            set_speed(slave, device.console_speed)
+            set_non_blocking(master)
+            path = os.path.join(self.dev_dir, self.usb_port_base + str(index))
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(os.ttyname(slave), path)
+            self._consoles.append((device, master, slave, path))
+            self.port_paths.append(path)
+            device.attach(lambda text, device=device, master=master, slave=slave:
+                          self._write(master, text if speeds_match(device, slave) else garble(text)))
+
+        self._thread = threading.Thread(target=self._read_consoles, name="ios-simulator")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Simulating " + str(len(self.devices)) + " devices on " + str(self.port_paths) + ".")
+
+    def stop(self):
+        """
+        Stop the devices, and remove the pseudo-terminals and their links.
+        """
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        for device, master, slave, path in self._consoles:
+            device.stop()
+            os.close(master)
+            os.close(slave)
+            if os.path.lexists(path):
+                os.unlink(path)
+        self._consoles = []
+        self.port_paths = []
+
+    def _write(self, master, text):
+        #Output that nothing is reading is lost, as on a real console
+        data = text.encode("latin-1")
+        while data and self._running:
+            try:
+                written = os.write(master, data)
+                data = data[written:]
+            except OSError as e:
+                if (e.errno != errno.EAGAIN):
+                    return
+                ready = select.select([], [master], [], 1)[1]
+                if not ready:
+                    return
+
+    def _read_consoles(self):
+        devices = dict((master, (device, slave)) for device, master, slave, path in self._consoles)
+        while self._running:
+            ready = select.select(list(devices), [], [], 0.5)[0]
+            for master in ready:
+                try:
+                    data = os.read(master, 4096)
+                except OSError:
+                    continue
+                device, slave = devices[master]
+                if data and speeds_match(device, slave):
+                    device.input(data.decode("latin-1"))
+
+def garble(text):
+    """
+    What text looks like when it is read at the wrong speed, which is never
+    what was sent.
+    """
+    return "".join(chr(0x80 | (ord(char) & 0x7f)) for char in text)
+
+def speeds_match(device, slave):
+    """
+    Whether the pseudo-terminal slave, as opened by the scripts, is at the
+    console speed of the device.
+    """
+    return termios.tcgetattr(slave)[5] == getattr(termios, "B" + str(device.console_speed), None)
+
+def set_speed(fd, speed):
+    attributes = termios.tcgetattr(fd)
+    attributes[4] = attributes[5] = getattr(termios, "B" + str(speed))
+    termios.tcsetattr(fd, termios.TCSANOW, attributes)
+
+def set_non_blocking(fd):
+    import fcntl
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+def simulated_serial_number(index):
+    return "FGL%08d" % (index + 1)
+
+def main(argv=None):
+
+    fileConfig('logging_config.ini')
+    empty_md5 = hashlib.md5(b"").hexdigest()
+    devices = [SimulatedDevice(simulated_device_types[index % len(simulated_device_types)],
+                               simulated_serial_number(index),
+                               flash={simulated_boot_image: (0, empty_md5)})
+               for index in range(simulated_devices)]
+    simulator = IOSSimulator(devices, simulator_dev_dir, usb_port_base)
+    simulator.start()
+
+    logger.info("Set console_dev_dir in cli_utils.py to " + simulator.dev_dir + " to use the simulated devices.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a table, kept on disk between runs, of how long each type of device
+takes to answer each class of command, so that the scripts can wait for as
+long as the devices actually take, rather than for as long as the slowest
+device might.
+
+The class of a command is its first word, such as "dir" or "copy", or the
+first two for "show" commands, such as "show hardware", and "return" for an
+empty line. For each device type and class, the table keeps a histogram of
+the latencies, from the command being sent to the pattern expected after it
+being read, with buckets from LATENCY_BUCKETS, and the slowest latency seen.
+
+deadline() gives the time to wait for a command, as the 99th percentile of
+its latencies times a safety factor, once there are enough of them to go by,
+and otherwise the default it is given. The percentile is the upper bound of
+its bucket, or the slowest latency if that is less, so that it errs on the
+long side.
+
+Running this module prints the table, for latency_file in cli_utils.py or the
+file given on the command line.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import logging
+import sys
+import threading
+import time
+
+from pyserial_util.atomic_file import load_json, save_json
+
+logger = logging.getLogger()
+
+#The upper bounds, in seconds, of the buckets of the histograms, after which
+#there is one more bucket for anything slower.
+LATENCY_BUCKETS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+
+class LatencyTable:
+    latency_file = ""
+    save_interval = 30
+
+    def __init__(self, latency_file, save_interval=30):
+        self.latency_file = latency_file
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self._last_save = time.time()
+        self._changed = False
+        self.entries = load_json(latency_file, "latency table") or {}
+
+    def record(self, device_type, command_class, seconds):
+        with self.lock:
+            entry = self.entries.setdefault(device_type, {}).setdefault(command_class,
+                                                                         {"buckets" : [0] * (len(LATENCY_BUCKETS) + 1),
+                                                                          "count" : 0, "max" : 0.0})
+            index = len(LATENCY_BUCKETS)
+            for bucket, bound in enumerate(LATENCY_BUCKETS):
+                if (seconds <= bound):
+                    index = bucket
+                    break
+            entry["buckets"][index] += 1
+            entry["count"] += 1
+            entry["max"] = max(entry["max"], seconds)
+            self._changed = True
+            if (time.time() - self._last_save >= self.save_interval):
+                self._save()
+
+    def percentile(self, device_type, command_class, percent):
+        """
+        The percent percentile of the latencies of command_class on device_type,
+        or None if there are none.
+        """
+        with self.lock:
+            entry = self.entries.get(device_type, {}).get(command_class)
+            if not entry or not entry["count"]:
+                return None
+            wanted = entry["count"] * percent / 100.0
+            seen = 0
+            for bucket, count in enumerate(entry["buckets"]):
+                seen += count
+                if (seen >= wanted and bucket < len(LATENCY_BUCKETS)):
+                    return min(LATENCY_BUCKETS[bucket], entry["max"])
+            return entry["max"]
+
+    def count(self, device_type, command_class):
+        with self.lock:
+            return self.entries.get(device_type, {}).get(command_class, {}).get("count", 0)
+
+    def deadline(self, device_type, command_class, default, safety_factor=3, min_samples=20, min_deadline=0.5):
+        """
+        How long to wait for command_class on device_type, as described above,
+        which is never more than default, so that a device that is slower than
+        ever before is waited for as long as it would have been without the
+        table.
+        """
+        if (self.count(device_type, command_class) < min_samples):
+            return default
+        deadline = max(min_deadline, self.percentile(device_type, command_class, 99) * safety_factor)
+        return min(deadline, default)
+
+    def rows(self):
+        """
+        The table, as a list of tuples of the device type, the command class,
+        the number of latencies and the median, 99th percentile and slowest of
+        them, for inspection.
+        """
+        with self.lock:
+            keys = sorted((device_type, command_class) for device_type, classes in self.entries.items()
+                          for command_class in classes)
+        return [(device_type, command_class, self.count(device_type, command_class),
+                 self.percentile(device_type, command_class, 50), self.percentile(device_type, command_class, 99),
+                 self.entries[device_type][command_class]["max"]) for device_type, command_class in keys]
+
+    def save(self):
+        with self.lock:
+            if self._changed:
+                self._save()
+
+    def _save(self):
+        if save_json(self.latency_file, self.entries, "latency table"):
+            self._changed = False
+        self._last_save = time.time()
+
+def command_class(line):
+    """
+    The class of the command line, as described above.
+    """
+    words = line.strip().lower().split()
+    if not words:
+        return "return"
+    if (words[0] == "show" and len(words) > 1):
+        return " ".join(words[:2])
+    return words[0]
+
+def format_rows(rows):
+    lines = ["%-20s %-20s %8s %10s %10s %10s" % ("device_type", "command_class", "count", "p50", "p99", "max")]
+    for device_type, command_class, count, p50, p99, slowest in rows:
+        lines.append("%-20s %-20s %8d %10.3f %10.3f %10.3f" % (device_type, command_class, count, p50, p99, slowest))
+    return "\n".join(lines)
+
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv:
+        latency_file = argv[0]
+    else:
+        from pyserial_util.cli_utils import latency_file
+    print(format_rows(LatencyTable(latency_file).rows()))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
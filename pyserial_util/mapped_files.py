@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a cache of memory-mapped files for the file servers that send bundles
+and images to the devices, so that each file is mapped once and that mapping
+is shared by all of the transfers of the file, however many devices are 
+pulling it at the same time.
+
+A file that has changed since it was mapped is mapped again, and the old
+mapping is closed once the transfers using it have finished.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import mmap
+import os
+import threading
+
+
+class MappedFiles:
+    root = ""
+    
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._files = {}
+        self._lock = threading.Lock()
+        self._closing = False
+        
+    def resolve(self, filename):
+        """
+        The path of filename under the root, or None if it is outside of it.
+        """
+        path = os.path.abspath(os.path.join(self.root, filename.lstrip("/")))
+        if path != self.root and path.startswith(self.root + os.sep):
+            return path
+        return None
+        
+    def acquire(self, path):
+        """
+        The entry for the file at path, which is a list of the contents, the
+        number of transfers using it, and the size and time the file was
+        modified. The contents are an mmap, or b"" for an empty file, which 
+        cannot be mapped. Each acquire() must be matched by a release().
+        """
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._files.get(path)
+            if entry and entry[2] != (stat.st_size, stat.st_mtime):
+                if (entry[1] == 0):
+                    self._unmap(entry)
+                entry = None
+            if not entry:
+                with open(path, "rb") as f:
+                    if stat.st_size:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    else:
+                        data = b""
+                entry = [data, 0, (stat.st_size, stat.st_mtime)]
+                self._files[path] = entry
+            entry[1] += 1
+            return entry
+
+    def release(self, path, entry):
+        """
+        Finish with an entry from acquire(), unmapping the file if it is no
+        longer used and has either changed or the cache is being closed.
+        """
+        with self._lock:
+            entry[1] -= 1
+            if (entry[1] == 0):
+                if self._files.get(path) is not entry:
+                    self._unmap(entry)
+                elif self._closing:
+                    self._unmap(entry)
+                    del self._files[path]
+                    
+    def close(self):
+        """
+        Unmap the files that are not in use now, and the others as soon as
+        they are released.
+        """
+        with self._lock:
+            self._closing = True
+            for path, entry in list(self._files.items()):
+                if (entry[1] == 0):
+                    self._unmap(entry)
+                    del self._files[path]
+                    
+    def __len__(self):
+        return len(self._files)
+
+    def _unmap(self, entry):
+        if isinstance(entry[0], mmap.mmap):
+            entry[0].close()
@@ -0,0 +1,321 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a set of timing spans for the steps that the scripts carry out on the
+devices, so that the slow commands and the slow devices can be found over many
+runs, rather than from the DEBUG log lines of one run.
+
+Each function decorated with @step records a Span each time it is called, with:
+
+ - The port and type of the device, from the serial port, CLISession or
+   DeviceSerialPort it is called with, or from the span it was called within.
+ - The name of the step, which is the name of the function, and the step it
+   was called within, if any.
+ - When it started and how long it took, in seconds.
+ - The bytes read from and written to the console during the step.
+ - The outcome, which is "error" for a non-zero return code or a result of
+   None, which is what the steps that return something else give on failure,
+   "false" for a result of False, "timeout" for an expect that timed out,
+   "exception" for an exception, and otherwise "ok".
+
+The steps go down as far as single commands, such as send_expect(), but the
+reads and writes that make them up, such as expect(), are not steps of their
+own, as there are far too many of them. Their bytes are counted against the
+steps they are done within.
+
+The spans are passed to the exporters, of which there are two here:
+
+ - JSONLinesExporter, which appends each span to a file as a line of JSON,
+   keeping the file open until the exporters are closed.
+ - PrometheusTextfileExporter, which keeps a histogram of the durations and
+   counters of the bytes for each step, device and outcome, and writes them to
+   a file for the textfile collector of the Prometheus node exporter.
+
+The exporters are set up from jsonl_file and prometheus_file the first time a
+span finishes, and others can be added with add_exporter().
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import atexit
+import functools
+import json
+import logging
+import threading
+import time
+
+from pyserial_util.atomic_file import write_atomically
+
+logger = logging.getLogger()
+
+#Where to write the spans as JSON lines, and the Prometheus metrics, or None to
+#not write them. The Prometheus file is written at most every
+#prometheus_write_interval seconds, and when the scripts finish.
+jsonl_file = None
+prometheus_file = None
+prometheus_write_interval = 5
+
+#The upper bounds, in seconds, of the buckets of the Prometheus histogram.
+DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800]
+
+OUTCOME_OK = "ok"
+OUTCOME_ERROR = "error"
+OUTCOME_FALSE = "false"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_EXCEPTION = "exception"
+
+_exporters = None
+_exporters_lock = threading.Lock()
+_local = threading.local()
+
+
+class Span:
+    port = ""
+    device_type = ""
+    step = ""
+    parent = ""
+    start = 0.0
+    duration = 0.0
+    bytes_read = 0
+    bytes_written = 0
+    outcome = ""
+
+    def __init__(self, step, port="", device_type="", parent=""):
+        self.step = step
+        self.port = port
+        self.device_type = device_type
+        self.parent = parent
+        self.start = time.time()
+        self.duration = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.outcome = ""
+
+    def to_dict(self):
+        return {"port": self.port, "device_type": self.device_type, "step": self.step, "parent": self.parent,
+                "start": self.start, "duration": self.duration, "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written, "outcome": self.outcome}
+
+class JSONLinesExporter:
+    path = ""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), sort_keys=True)
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, "a")
+                self._file.write(line + "\n")
+                #So that the spans can be followed as the scripts run
+                self._file.flush()
+            except (IOError, OSError) as e:
+                logger.error("Could not write the span to " + self.path + " - %s" % e)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+class PrometheusTextfileExporter:
+    path = ""
+
+    def __init__(self, path, write_interval=5):
+        self.path = path
+        self.write_interval = write_interval
+        self.durations = {}
+        self.bytes_read = {}
+        self.bytes_written = {}
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        labels = (("step", span.step), ("device_type", span.device_type), ("port", span.port),
+                  ("outcome", span.outcome))
+        with self._lock:
+            buckets, total, count = self.durations.get(labels, ([0] * len(DURATION_BUCKETS), 0.0, 0))
+            buckets = [bucket + (1 if span.duration <= bound else 0)
+                       for bucket, bound in zip(buckets, DURATION_BUCKETS)]
+            self.durations[labels] = (buckets, total + span.duration, count + 1)
+            self.bytes_read[labels] = self.bytes_read.get(labels, 0) + span.bytes_read
+            self.bytes_written[labels] = self.bytes_written.get(labels, 0) + span.bytes_written
+            if (time.time() - self._last_write >= self.write_interval):
+                self._write()
+
+    def close(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        lines = ["# HELP pyserial_util_step_duration_seconds How long each step took.",
+                 "# TYPE pyserial_util_step_duration_seconds histogram"]
+        for labels, (buckets, total, count) in sorted(self.durations.items()):
+            for bucket, bound in zip(buckets, DURATION_BUCKETS):
+                lines.append("pyserial_util_step_duration_seconds_bucket"
+                             + format_labels(labels + (("le", repr(float(bound))),)) + " " + str(bucket))
+            lines.append("pyserial_util_step_duration_seconds_bucket" + format_labels(labels + (("le", "+Inf"),))
+                         + " " + str(count))
+            lines.append("pyserial_util_step_duration_seconds_sum" + format_labels(labels) + " " + repr(total))
+            lines.append("pyserial_util_step_duration_seconds_count" + format_labels(labels) + " " + str(count))
+        for name, help_text, values in (("pyserial_util_step_bytes_read_total",
+                                         "The bytes read from the console in each step.", self.bytes_read),
+                                        ("pyserial_util_step_bytes_written_total",
+                                         "The bytes written to the console in each step.", self.bytes_written)):
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " counter")
+            for labels, value in sorted(values.items()):
+                lines.append(name + format_labels(labels) + " " + str(value))
+
+        try:
+            write_atomically(self.path, "\n".join(lines) + "\n")
+            self._last_write = time.time()
+        except (IOError, OSError) as e:
+            logger.error("Could not write the metrics to " + self.path + " - %s" % e)
+
+def format_labels(labels):
+    escaped = [name + "=\"" + str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") + "\""
+               for name, value in labels]
+    return "{" + ",".join(escaped) + "}"
+
+def get_exporters():
+    """
+    The exporters, setting them up from jsonl_file and prometheus_file the
+    first time.
+    """
+    global _exporters
+    with _exporters_lock:
+        if _exporters is None:
+            _exporters = []
+            if jsonl_file:
+                _exporters.append(JSONLinesExporter(jsonl_file))
+            if prometheus_file:
+                _exporters.append(PrometheusTextfileExporter(prometheus_file, prometheus_write_interval))
+        return _exporters
+
+def add_exporter(exporter):
+    get_exporters().append(exporter)
+
+def close_exporters():
+    global _exporters
+    with _exporters_lock:
+        exporters, _exporters = _exporters, None
+    for exporter in exporters or []:
+        exporter.close()
+
+atexit.register(close_exporters)
+
+def _open_spans():
+    spans = getattr(_local, "spans", None)
+    if spans is None:
+        spans = _local.spans = []
+    return spans
+
+def describe(target):
+    """
+    The port and device type of a serial port, CLISession or DeviceSerialPort,
+    or of a port path, as far as they can be told.
+    """
+    if target is None:
+        return "", ""
+    if isinstance(target, str):
+        return target, ""
+    device_type = getattr(target, "device_type", "") or ""
+    port = getattr(target, "port", None)
+    if not isinstance(port, str):
+        serial_port = getattr(target, "serial_port", None)
+        port = getattr(serial_port, "port", "") if serial_port is not None else ""
+    return port or "", device_type
+
+def current_span():
+    """
+    The innermost span open in this thread, or None if there is none.
+    """
+    spans = _open_spans()
+    return spans[-1] if spans else None
+
+def start_span(step, target=None):
+    port, device_type = describe(target)
+    spans = _open_spans()
+    parent = ""
+    if spans:
+        parent = spans[-1].step
+        port = port or spans[-1].port
+        device_type = device_type or spans[-1].device_type
+    span = Span(step, port, device_type, parent)
+    spans.append(span)
+    return span
+
+def finish_span(span, outcome):
+    span.duration = time.time() - span.start
+    span.outcome = outcome
+    spans = _open_spans()
+    if span in spans:
+        spans.remove(span)
+    for exporter in get_exporters():
+        exporter.export(span)
+
+def record_read(count):
+    """
+    Count bytes read from the console against all of the spans open in this
+    thread.
+    """
+    for span in _open_spans():
+        span.bytes_read += count
+
+def record_written(count):
+    for span in _open_spans():
+        span.bytes_written += count
+
+def outcome_of(result):
+    """
+    The outcome of a step from what it returned.
+    """
+    if result is None:
+        return OUTCOME_ERROR
+    if isinstance(result, bool):
+        return OUTCOME_OK if result else OUTCOME_FALSE
+    if isinstance(result, int):
+        return OUTCOME_OK if result == 0 else OUTCOME_ERROR
+    if isinstance(result, tuple) and len(result) == 3 and isinstance(result[0], int):
+        #The (retcode, errors, output) of send_config_lines
+        if isinstance(result[1], list):
+            return OUTCOME_OK if (result[0] == 0 and not result[1]) else OUTCOME_ERROR
+        #The (index, match, response) of an expect
+        return OUTCOME_TIMEOUT if result[0] == -1 else OUTCOME_OK
+    return OUTCOME_OK
+
+def step(function):
+    """
+    A decorator that records a Span for each call of function, about the
+    device its first argument is for.
+    """
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        span = start_span(function.__name__, args[0] if args else None)
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            finish_span(span, OUTCOME_EXCEPTION)
+            raise
+        finish_span(span, outcome_of(result))
+        return result
+    return timed
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a cache, kept on disk between runs, of which device is connected to
+which console port, so that the devices do not have to be identified again
+with "show hardware" every time one of the scripts is run.
+
+The cache is keyed by the identity of the USB to serial adapter, rather than
+the name of the port under /dev/, as the names can change when adapters are
+plugged in and out. Each entry records the device type, the device serial 
+number and the prompt that was last seen. An entry is only trusted for ttl
+seconds, and only if the prompt the device shows now is for the same host
+name as the cached prompt.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import logging
+import os
+import re
+import threading
+import time
+
+from pyserial_util.atomic_file import load_json, save_json
+
+logger = logging.getLogger()
+
+by_id_dir = "/dev/serial/by-id"
+
+PROMPT_MODE = re.compile(r"(\(config[^)]*\))?[>#]\s*$")
+
+
+class PortCache:
+    cache_file = ""
+    ttl = 0
+    
+    def __init__(self, cache_file, ttl):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = load_json(cache_file, "port cache") or {}
+            
+    def get(self, identity):
+        """
+        The result is the entry for the port identity, as a dict with the keys
+        device_type, serial_number, prompt and timestamp, or None if there is
+        no entry or it is older than the ttl.
+        """
+        with self.lock:
+            entry = self.entries.get(identity)
+            if entry and time.time() - entry["timestamp"] > self.ttl:
+                logger.debug("The port cache entry for " + identity + " has expired.")
+                del self.entries[identity]
+                self._save()
+                entry = None
+            return entry
+    
+    def lookup(self, identity, prompt):
+        """
+        The result is the entry for the port identity, as for get(), if the
+        prompt is for the same host as the cached prompt. If not, the device on
+        the port has changed, so the entry is removed and the result is None.
+        """
+        entry = self.get(identity)
+        if entry and host_of_prompt(entry["prompt"]) != host_of_prompt(prompt):
+            logger.info("The prompt " + prompt + " does not match the cached prompt " + entry["prompt"] 
+                        + " for " + identity + ", so the device will be identified again.")
+            self.invalidate(identity)
+            entry = None
+        return entry
+        
+    def put(self, identity, device_type, serial_number, prompt):
+        with self.lock:
+            self.entries[identity] = {"device_type" : device_type,
+                                      "serial_number" : serial_number,
+                                      "prompt" : prompt,
+                                      "timestamp" : time.time()}
+            self._save()
+            
+    def invalidate(self, identity):
+        with self.lock:
+            if self.entries.pop(identity, None):
+                self._save()
+            
+    def _save(self):
+        save_json(self.cache_file, self.entries, "port cache")
+
+def host_of_prompt(prompt):
+    """
+    The prompt with the mode part, such as ">", "#" or "(config)#", removed.
+    """
+    return PROMPT_MODE.sub("", prompt.strip())
+
+def get_port_identity(port_path):
+    """
+    The stable identity of the USB to serial adapter behind port_path. That is 
+    the /dev/serial/by-id/ link to the port where there is one, as on Linux, or 
+    else the hardware id from pySerial, which has the USB vendor, product and 
+    serial number and the location on the USB bus. If neither is available, or
+    port_path is a URL, such as for a terminal server, the result is port_path 
+    itself.
+    """
+    if ("://" in port_path):
+        return port_path
+    
+    real_path = os.path.realpath(port_path)
+    
+    if os.path.isdir(by_id_dir):
+        for name in sorted(os.listdir(by_id_dir)):
+            if os.path.realpath(os.path.join(by_id_dir, name)) == real_path:
+                return os.path.join(by_id_dir, name)
+    
+    try:
+        from serial.tools import list_ports
+        for port_info in list_ports.comports():
+            if os.path.realpath(port_info.device) == real_path and port_info.vid is not None:
+                return port_info.hwid
+    except ImportError:
+        pass
+    
+    return port_path
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a journal, kept on disk between runs, of the steps that have been done
+on each device, so that a run that fails part of the way through can be run
+again and carry on from the first step that was not done, rather than copying
+and installing everything again.
+
+The journal is keyed by the serial number of each device, as that stays the
+same whichever port the device is on. Each entry records the steps done, with
+the version of what each step was done with, such as the name and MD5 hash of
+an image, and when it was done. A step is only taken as done if it was done
+with the same version, so that a new bundle or image is installed whatever the
+journal says.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import logging
+import threading
+import time
+
+from pyserial_util.atomic_file import load_json, save_json
+
+logger = logging.getLogger()
+
+
+class StepJournal:
+    journal_file = ""
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.entries = load_json(journal_file, "step journal") or {}
+
+    def done(self, serial_number, step, version):
+        """
+        Whether the step has been done on the device with serial_number, with
+        the same version.
+        """
+        with self.lock:
+            entry = self.entries.get(serial_number, {}).get(step)
+            return entry is not None and entry["version"] == version
+
+    def record(self, serial_number, step, version):
+        with self.lock:
+            self.entries.setdefault(serial_number, {})[step] = {"version" : version,
+                                                                "timestamp" : time.time()}
+            self._save()
+
+    def forget(self, serial_number):
+        """
+        Remove all of the steps for the device with serial_number, as when all
+        of them have been done, so that the next run starts again.
+        """
+        with self.lock:
+            if self.entries.pop(serial_number, None):
+                self._save()
+
+    def _save(self):
+        save_json(self.journal_file, self.entries, "step journal")
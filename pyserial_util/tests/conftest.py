@@ -0,0 +1,63 @@
+"""
+The settings and simulated devices that the tests of the scripts share.
+"""
+import hashlib
+import os
+
+import pytest
+
+#The scripts read logging_config.ini and the configs directory from the current
+#directory, so the tests are run from where the scripts are
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyserial_util import bundle_install, cli_utils, ios_simulator, metrics
+from pyserial_util.ios_simulator import SimulatedDevice
+from pyserial_util.tftp_server import TFTPServer
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    for filename in (bundle_install.bundle_name, bundle_install.gos_vm_name):
+        (image_dir / filename).write_bytes(os.urandom(64 * 1024))
+    
+    monkeypatch.setattr(ios_simulator, "latency_scale", 0.001)
+    monkeypatch.setattr(cli_utils, "port_cache_file", None)
+    monkeypatch.setattr(cli_utils, "latency_file", None)
+    monkeypatch.setattr(cli_utils, "image_hash_file", str(tmp_path / "image_hashes.json"))
+    monkeypatch.setattr(metrics, "jsonl_file", None)
+    monkeypatch.setattr(metrics, "prometheus_file", None)
+    monkeypatch.setattr(bundle_install, "journal_file", None)
+    monkeypatch.setattr(bundle_install, "image_dir", str(image_dir))
+    monkeypatch.setattr(bundle_install, "embedded_tftp_server", True)
+    monkeypatch.setattr(bundle_install, "file_server_address", "127.0.0.1")
+    return image_dir
+
+@pytest.fixture
+def tftp_server(settings, monkeypatch):
+    server = TFTPServer(str(settings), "127.0.0.1", port=0, timeout=1)
+    server.start()
+    monkeypatch.setattr(ios_simulator, "tftp_port", server.port)
+    yield server
+    server.stop()
+
+@pytest.fixture
+def make_device():
+    """
+    A function that makes a simulated IR809 with the given host name and the
+    serial number for index, running IOS from the boot image.
+    """
+    devices = []
+    
+    def make_device(hostname, index=0):
+        device = SimulatedDevice("IR809G-LTE-GA-K9", ios_simulator.simulated_serial_number(index),
+                                 startup_config=["hostname " + hostname, 
+                                                 "enable password " + bundle_install.enable_password],
+                                 flash={ios_simulator.simulated_boot_image: (0, hashlib.md5(b"").hexdigest())})
+        devices.append(device)
+        return device
+    
+    yield make_device
+    for device in devices:
+        device.stop()
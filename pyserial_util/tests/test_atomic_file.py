@@ -0,0 +1,48 @@
+"""
+Tests of writing the state files of the scripts with atomic_file.py.
+"""
+import json
+import os
+import threading
+
+from pyserial_util.atomic_file import load_json, save_json, write_atomically
+
+
+def test_saved_and_loaded(tmp_path):
+    path = str(tmp_path / "state" / "cache.json")
+    assert load_json(path, "cache") is None
+    assert save_json(path, {"a": 1}, "cache")
+    assert load_json(path, "cache") == {"a": 1}
+    assert os.listdir(str(tmp_path / "state")) == ["cache.json"]
+    assert os.stat(path).st_mode & 0o777 == 0o644
+
+def test_writers_at_once_each_write_a_whole_file(tmp_path):
+    path = str(tmp_path / "cache.json")
+    errors = []
+
+    def write(writer):
+        try:
+            for index in range(50):
+                write_atomically(path, json.dumps({"writer": writer, "index": index, "padding": "x" * 10000}))
+        except (IOError, OSError) as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert load_json(path, "cache")["index"] == 49
+    assert os.listdir(str(tmp_path)) == ["cache.json"]
+
+def test_failed_write_leaves_the_file_as_it_was(tmp_path):
+    path = str(tmp_path / "cache.json")
+    save_json(path, {"a": 1}, "cache")
+    assert not save_json(str(tmp_path / "cache.json" / "not_a_dir.json"), {}, "cache")
+    try:
+        write_atomically(path, object())
+    except TypeError:
+        pass
+    assert load_json(path, "cache") == {"a": 1}
+    assert os.listdir(str(tmp_path)) == ["cache.json"]
@@ -0,0 +1,48 @@
+"""
+Tests of the step journal of bundle_install.py against a simulated device.
+"""
+import pytest
+
+from pyserial_util import bundle_install
+from pyserial_util.bundle_install import artifact_version, get_journal, install_device
+from pyserial_util.cli_utils import DeviceSerialPort
+from pyserial_util.ios_simulator import SimulatedSerialPort
+
+
+@pytest.fixture
+def journal(tftp_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(bundle_install, "journal_file", str(tmp_path / "install_journal.json"))
+    return get_journal()
+
+def record_all_steps(journal, serial_number):
+    for step_name, version in (("copy-bundle", artifact_version(bundle_install.bundle_name)),
+                               ("copy-gos", artifact_version(bundle_install.gos_vm_name)),
+                               ("remove-gos", artifact_version(bundle_install.gos_vm_name)),
+                               ("install-bundle", artifact_version(bundle_install.bundle_name)),
+                               ("set-boot", bundle_install.image_name),
+                               ("install-gos", artifact_version(bundle_install.gos_vm_name))):
+        journal.record(serial_number, step_name, version)
+
+def test_steps_in_the_journal_are_skipped(journal, make_device):
+    device = make_device("IR809-DevTest-SN10.42.1.0EN")
+    record_all_steps(journal, device.serial_number)
+    dev_ser_port = DeviceSerialPort(SimulatedSerialPort(device, "sim0"), device.device_type, device.serial_number)
+    
+    assert install_device(dev_ser_port)
+    assert bundle_install.bundle_name not in device.flash
+    assert device.guest_os_image is None
+
+def test_swapped_device_is_not_taken_for_the_cached_one(journal, make_device):
+    #The port cache still has the serial number of the device that was on the
+    #port, which had all of the steps done, and the new one has the same host name
+    device = make_device("IR809-DevTest-SN10.42.1.0EN", 1)
+    cached_serial_number = "FGL00000001"
+    assert device.serial_number != cached_serial_number
+    record_all_steps(journal, cached_serial_number)
+    dev_ser_port = DeviceSerialPort(SimulatedSerialPort(device, "sim0"), device.device_type, cached_serial_number)
+    
+    assert install_device(dev_ser_port)
+    assert dev_ser_port.serial_number == device.serial_number
+    assert bundle_install.bundle_name in device.flash
+    assert device.guest_os_image == bundle_install.gos_vm_name
+    assert journal.done(cached_serial_number, "copy-bundle", artifact_version(bundle_install.bundle_name))
@@ -0,0 +1,61 @@
+"""
+Tests of working out the lines of a configuration that a device does not have
+yet, with config_diff.py.
+"""
+from pyserial_util.config_diff import config_delta, incremental_config, parse_running_config
+
+RUNNING_CONFIG = "\r\n".join([
+    "show running-config",
+    "Building configuration...",
+    "",
+    "Current configuration : 1024 bytes",
+    "!",
+    "hostname Router",
+    "!",
+    "no ip domain lookup",
+    "!",
+    "interface GigabitEthernet0",
+    " ip address 10.42.1.1 255.255.255.0",
+    " shutdown",
+    "!",
+    "interface Vlan1",
+    " ip address 10.42.2.1 255.255.255.0",
+    "!",
+    "end",
+    "",
+    "Router#"])
+
+
+def test_parse_running_config():
+    lines = parse_running_config(RUNNING_CONFIG)
+    assert "show running-config" not in lines
+    assert lines[2:5] == ["!", "hostname Router", "!"]
+    assert lines[-2:] == [" ip address 10.42.2.1 255.255.255.0", "!"]
+
+def test_only_the_missing_lines_of_a_section_are_sent():
+    running = parse_running_config(RUNNING_CONFIG)
+    config = ["interface Vlan1",
+              " ip  address 10.42.2.1 255.255.255.0",
+              " description LAN",
+              " exit",
+              "interface Vlan2",
+              " ip address 10.42.3.1 255.255.255.0"]
+    assert config_delta(config, running) == ["interface Vlan1", " description LAN", " exit",
+                                             "interface Vlan2", " ip address 10.42.3.1 255.255.255.0", " exit"]
+
+def test_no_lines():
+    running = parse_running_config(RUNNING_CONFIG)
+    #"no ip domain lookup" is shown, and "no shutdown" is not, as it is the default
+    config = ["no ip domain lookup",
+              "no service pad",
+              "interface Vlan1",
+              " no shutdown",
+              "interface GigabitEthernet0",
+              " no shut"]
+    assert config_delta(config, running) == ["no service pad", "interface GigabitEthernet0", " no shut", " exit"]
+
+def test_incremental_config():
+    lines = ["enable", "configure terminal", "hostname Router", "no ip domain lookup", "end", "write memory"]
+    assert incremental_config(lines, RUNNING_CONFIG) == ["enable", "write memory"]
+    lines = ["conf t", "hostname IR-SN10.42.1.0EN", "end"]
+    assert incremental_config(lines, RUNNING_CONFIG) == ["configure terminal", "hostname IR-SN10.42.1.0EN", "end"]
@@ -0,0 +1,44 @@
+"""
+Tests of rendering configurations from templates with config_template.py.
+"""
+import pytest
+
+from pyserial_util.config_template import ConfigTemplate, get_template
+
+TEMPLATE = "\n".join([
+    "! A comment",
+    "configure terminal",
+    "hostname IR",
+    "#Process images:guest-os 1 image install flash:/<GOS_IMAGE> verify",
+    "interface Vlan1",
+    " ip address 10.<NT1>.<NT2>.1 255.255.255.0",
+    " description {LAN}",
+    "",
+    "end"])
+
+
+def test_render():
+    template = ConfigTemplate(TEMPLATE)
+    assert template.placeholders == frozenset(["NT1", "NT2", "GOS_IMAGE"])
+    variables = {"NT1": 42, "NT2": 1, "GOS_IMAGE": "gos.img"}
+    assert template.render(variables) == ["configure terminal",
+                                          "hostname IR-SN42.1.1.0EN",
+                                          "interface Vlan1",
+                                          " ip address 10.42.1.1 255.255.255.0",
+                                          " description {LAN}",
+                                          "end"]
+    assert template.render(variables, process_images=True)[2] == "guest-os 1 image install flash:/gos.img verify"
+
+def test_undefined_variable():
+    template = ConfigTemplate(TEMPLATE)
+    assert template.missing_variables({"NT1": 42}) == ["GOS_IMAGE", "NT2"]
+    with pytest.raises(ValueError) as e:
+        template.render({"NT1": 42})
+    assert str(e.value) == "No values for the placeholders GOS_IMAGE, NT2"
+
+@pytest.mark.parametrize("device_type", ["IR809G-LTE-GA-K9", "IR829GW-LTE-GA-EK9"])
+def test_templates_of_the_device_types(device_type):
+    template = get_template(device_type)
+    assert get_template(device_type) is template
+    config = template.render(dict((name, 42) for name in template.placeholders))
+    assert not [line for line in config if line.startswith("#") or "<" in line]
@@ -0,0 +1,31 @@
+"""
+Tests of the device profiles in device_profiles.py.
+"""
+import pytest
+
+from pyserial_util.device_profiles import UNKNOWN_DEVICE_TYPE, get_profile, identify_device_type, unknown_profile
+
+
+def test_identify_device_type():
+    response = ("Device#      PID                   S/N\r\n"
+                "-------------------------------------------\r\n"
+                "*0          IR829GW-LTE-GA-EK9    FGL00000002\r\n")
+    assert identify_device_type(response) == "IR829GW-LTE-GA-EK9"
+    assert identify_device_type("*0          C819G-4G-GA-K9    FGL00000002") == UNKNOWN_DEVICE_TYPE
+    assert get_profile("C819G-4G-GA-K9") is unknown_profile
+
+@pytest.mark.parametrize("device_type", ["IR809G-LTE-GA-K9", "IR829GW-LTE-GA-EK9"])
+@pytest.mark.parametrize("output, rommon, prompt", [
+    ("\r\nrommon-2> ", True, False),
+    ("System Bootstrap\r\nrommon-1>", True, False),
+    ("\r\nRouter>", False, True),
+    ("show clock\r\n*10:00:00.000 UTC Mon Oct 18 2026\r\nIR-SN10.42.1.0EN#", False, True),
+    ("\r\nRouter(config-if)# ", False, True),
+    ("Loading flash:/ir800-universalk9-mz.SPA.156-3.M.bin ######", False, False),
+    ("\r\n################################\r\n", False, False),
+    ("Press RETURN to get started!\r\n", False, False),
+])
+def test_prompts(device_type, output, rommon, prompt):
+    profile = get_profile(device_type)
+    assert bool(profile.rommon_prompt.search(output)) == rommon
+    assert bool(profile.prompt.search(output)) == prompt
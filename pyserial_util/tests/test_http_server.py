@@ -0,0 +1,62 @@
+"""
+Tests of serving images with the HTTP server in http_server.py, over the
+loopback interface.
+"""
+import os
+
+import pytest
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+from pyserial_util.http_server import ImageHTTPServer
+
+
+@pytest.fixture
+def image(tmp_path):
+    data = os.urandom(100 * 1024)
+    (tmp_path / "image.bin").write_bytes(data)
+    (tmp_path / "empty.bin").write_bytes(b"")
+    return data
+
+@pytest.fixture
+def http_server(tmp_path, image):
+    server = ImageHTTPServer(str(tmp_path), "127.0.0.1", port=0)
+    server.start()
+    yield server
+    server.stop()
+
+def get(http_server, path, byte_range=None):
+    connection = HTTPConnection("127.0.0.1", http_server.port, timeout=10)
+    try:
+        connection.request("GET", path, headers={"Range": byte_range} if byte_range else {})
+        response = connection.getresponse()
+        return response.status, response.getheader("Content-Range"), response.read()
+    finally:
+        connection.close()
+
+def test_whole_file(http_server, image):
+    assert get(http_server, "/image.bin") == (200, None, image)
+
+def test_first_bytes(http_server, image):
+    assert get(http_server, "/image.bin", "bytes=0-99") == (206, "bytes 0-99/102400", image[:100])
+    assert get(http_server, "/image.bin", "bytes=102300-") == (206, "bytes 102300-102399/102400", image[-100:])
+
+def test_last_bytes(http_server, image):
+    assert get(http_server, "/image.bin", "bytes=-100") == (206, "bytes 102300-102399/102400", image[-100:])
+    #More than there is is the whole file
+    assert get(http_server, "/image.bin", "bytes=-200000") == (206, "bytes 0-102399/102400", image)
+
+def test_range_past_the_end(http_server):
+    assert get(http_server, "/image.bin", "bytes=102400-") == (416, "bytes */102400", b"")
+    assert get(http_server, "/image.bin", "bytes=200-100") == (416, "bytes */102400", b"")
+
+def test_empty_file(http_server):
+    assert get(http_server, "/empty.bin") == (200, None, b"")
+    assert get(http_server, "/empty.bin", "bytes=0-") == (416, "bytes */0", b"")
+
+def test_missing_and_outside_of_the_root(http_server):
+    assert get(http_server, "/missing.bin")[0] == 404
+    assert get(http_server, "/../image.bin")[0] == 403
@@ -0,0 +1,56 @@
+"""
+A smoke test of provisioning one simulated device from ios_simulator.py, by
+configuring it with config_load.py and then installing the bundle and images
+on it with bundle_install.py, as the scripts are usually run.
+"""
+import os
+
+import pytest
+
+from pyserial_util import bundle_install, cli_utils, config_load
+from pyserial_util.cli_utils import CLISession, DeviceSerialPort, MODE_ENABLE, MODE_USER, iter_console_ports, wait_for_boot
+from pyserial_util.ios_simulator import IOSSimulator, SimulatedSerialPort
+
+
+@pytest.fixture
+def device(make_device):
+    return make_device("Router")
+
+def test_configure_and_install_one_device(tftp_server, device):
+    dev_ser_port = DeviceSerialPort(SimulatedSerialPort(device, "sim0"), device.device_type, device.serial_number)
+    
+    summary = config_load.configure_device(dev_ser_port, 42)
+    assert summary == "Configured a IR809G-LTE-GA-K9 at sim0."
+    assert device.hostname.endswith("-SN10.42.1.0EN")
+    
+    boot_count = device.boot_count
+    summary = bundle_install.install_device(dev_ser_port)
+    assert summary == "Installed bundles and images for a IR809G-LTE-GA-K9 at sim0.\n"
+    for filename in (bundle_install.bundle_name, bundle_install.gos_vm_name):
+        assert device.flash[filename][0] == os.path.getsize(os.path.join(tftp_server.root, filename))
+    assert "boot system flash:/" + bundle_install.image_name in device.startup_config
+    assert device.guest_os_image == bundle_install.gos_vm_name
+    
+    #The install ends with a reload, after which the device boots the new image
+    assert wait_for_boot(CLISession(dev_ser_port), 60) in (MODE_USER, MODE_ENABLE)
+    assert device.boot_count == boot_count + 1
+
+def test_configure_devices_on_pseudo_terminals(settings, make_device, tmp_path, monkeypatch):
+    devices = [make_device("Router", index) for index in range(2)]
+    simulator = IOSSimulator(devices, str(tmp_path / "dev"), bundle_install.usb_port_base)
+    simulator.start()
+    monkeypatch.setattr(cli_utils, "console_dev_dir", simulator.dev_dir)
+    dev_ser_ports = []
+    try:
+        #The ports are opened with pySerial, as real consoles are
+        dev_ser_ports = sorted(iter_console_ports(bundle_install.usb_port_base), key=lambda port: port.serial_number)
+        assert [(port.device_type, port.serial_number) for port in dev_ser_ports] == \
+            [(device.device_type, device.serial_number) for device in devices]
+        
+        summary = config_load.configure_device(dev_ser_ports[0], 42)
+        assert summary == "Configured a IR809G-LTE-GA-K9 at " + dev_ser_ports[0].serial_port.port + "."
+        assert devices[0].hostname.endswith("-SN10.42.1.0EN")
+    finally:
+        for dev_ser_port in dev_ser_ports:
+            dev_ser_port.serial_port.close()
+        simulator.stop()
@@ -0,0 +1,114 @@
+"""
+Tests of the latency table in latency_table.py, and of how send_expect() in
+cli_utils.py uses it.
+"""
+import time
+
+import pytest
+
+from pyserial_util import cli_utils
+from pyserial_util.latency_table import LATENCY_BUCKETS, LatencyTable, command_class
+
+
+@pytest.fixture
+def latency_table(tmp_path):
+    return LatencyTable(str(tmp_path / "latencies.json"))
+
+def test_command_class():
+    assert command_class("show version | include Version") == "show version"
+    assert command_class("  Copy tftp flash") == "copy"
+    assert command_class("show") == "show"
+    assert command_class("") == "return"
+
+def test_percentile_is_the_upper_bound_of_the_bucket(latency_table):
+    assert latency_table.percentile("IR809", "dir", 99) is None
+    for seconds in [0.03] * 98 + [0.3, 0.4]:
+        latency_table.record("IR809", "dir", seconds)
+    assert latency_table.count("IR809", "dir") == 100
+    assert latency_table.percentile("IR809", "dir", 50) == 0.05
+    assert latency_table.percentile("IR809", "dir", 99) == 0.4
+    assert latency_table.percentile("IR809", "dir", 100) == 0.4
+
+def test_percentile_of_slower_than_all_buckets(latency_table):
+    latency_table.record("IR809", "reload", LATENCY_BUCKETS[-1] * 2)
+    assert latency_table.percentile("IR809", "reload", 99) == LATENCY_BUCKETS[-1] * 2
+
+def test_deadline(latency_table):
+    for index in range(19):
+        latency_table.record("IR809", "dir", 0.3)
+    #Not enough samples yet
+    assert latency_table.deadline("IR809", "dir", 10, min_samples=20) == 10
+    latency_table.record("IR809", "dir", 0.3)
+    #Three times the slowest, as that is below the upper bound of its bucket
+    assert latency_table.deadline("IR809", "dir", 10, safety_factor=3, min_samples=20) == pytest.approx(0.9)
+    #Never less than min_deadline, and never more than the default
+    assert latency_table.deadline("IR809", "dir", 10, safety_factor=1, min_samples=20, min_deadline=0.5) == 0.5
+    assert latency_table.deadline("IR809", "dir", 0.2, safety_factor=3, min_samples=20) == 0.2
+    #Nor for other device types or classes
+    assert latency_table.deadline("IR829", "dir", 10, min_samples=20) == 10
+    assert latency_table.deadline("IR809", "copy", 10, min_samples=20) == 10
+
+def test_saved_and_loaded(tmp_path, latency_table):
+    latency_table.record("IR809", "dir", 0.15)
+    latency_table.save()
+    loaded = LatencyTable(latency_table.latency_file)
+    assert loaded.rows() == latency_table.rows() == [("IR809", "dir", 1, 0.15, 0.15, 0.15)]
+
+def test_unreadable_file_is_an_empty_table(tmp_path):
+    path = tmp_path / "latencies.json"
+    path.write_text("{not json")
+    assert LatencyTable(str(path)).rows() == []
+
+class SlowPort:
+    """
+    A serial port with a device that answers each line with a prompt after
+    delay seconds.
+    """
+    port = "slow"
+    device_type = "IR809G-LTE-GA-K9"
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.answer_time = None
+        self.output = ""
+
+    def write(self, data):
+        if data.endswith("\r"):
+            self.answer_time = time.time() + self.delay
+        return len(data)
+
+    def inWaiting(self):
+        if (self.answer_time is not None and time.time() >= self.answer_time):
+            self.output += "\r\nRouter#"
+            self.answer_time = None
+        return len(self.output)
+
+    def read(self, size=1):
+        data = self.output[:size]
+        self.output = self.output[size:]
+        return data
+
+def test_slow_answer_after_learned_deadline_is_waited_for_and_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_utils, "latency_file", str(tmp_path / "latencies.json"))
+    monkeypatch.setattr(cli_utils, "prompt_timeout", 5)
+    latency_table = cli_utils.get_latency_table()
+    for index in range(cli_utils.latency_min_samples):
+        latency_table.record(SlowPort.device_type, "show clock", 0.01)
+    serial_port = SlowPort(1.0)
+    learned = cli_utils.learned_timeout(serial_port, "show clock", 5)
+    assert learned < 1.0
+
+    index, match, response = cli_utils.send_expect(serial_port, "show clock", cli_utils.ENABLE_PROMPT)
+    assert index == 0
+    assert response.endswith("Router#")
+    assert latency_table.count(SlowPort.device_type, "show clock") == cli_utils.latency_min_samples + 1
+    assert latency_table.percentile(SlowPort.device_type, "show clock", 100) >= 1.0
+
+def test_timeout_is_kept_at_the_default(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_utils, "latency_file", str(tmp_path / "latencies.json"))
+    monkeypatch.setattr(cli_utils, "prompt_timeout", 1)
+    serial_port = SlowPort(60)
+    index, match, response = cli_utils.send_expect(serial_port, "show clock", cli_utils.ENABLE_PROMPT)
+    assert index == -1
+    #Without enough samples the deadline is the default, so nothing is kept
+    assert cli_utils.get_latency_table().count(SlowPort.device_type, "show clock") == 0
@@ -0,0 +1,50 @@
+"""
+Tests of the timing spans in metrics.py.
+"""
+import json
+
+import pytest
+
+from pyserial_util import metrics
+from pyserial_util.metrics import (JSONLinesExporter, OUTCOME_ERROR, OUTCOME_EXCEPTION, OUTCOME_FALSE, OUTCOME_OK,
+                                   OUTCOME_TIMEOUT, outcome_of, step)
+
+
+@pytest.mark.parametrize("result, outcome", [
+    (0, OUTCOME_OK),
+    (1, OUTCOME_ERROR),
+    (True, OUTCOME_OK),
+    (False, OUTCOME_FALSE),
+    (None, OUTCOME_ERROR),
+    ((0, [], "output"), OUTCOME_OK),
+    ((0, ["% Invalid input"], "output"), OUTCOME_ERROR),
+    ((0, None, "Router#"), OUTCOME_OK),
+    ((-1, None, "Router"), OUTCOME_TIMEOUT),
+    (["output"], OUTCOME_OK),
+    ("Installed", OUTCOME_OK),
+])
+def test_outcome_of(result, outcome):
+    assert outcome_of(result) == outcome
+
+def test_spans_of_steps_are_exported(tmp_path, monkeypatch):
+    path = str(tmp_path / "spans.jsonl")
+    exporter = JSONLinesExporter(path)
+    monkeypatch.setattr(metrics, "_exporters", [exporter])
+
+    @step
+    def gather(port):
+        return None
+
+    @step
+    def install(port):
+        gather(port)
+        raise RuntimeError("unplugged")
+
+    with pytest.raises(RuntimeError):
+        install("/dev/ttyUSB0")
+    exporter.close()
+    with open(path) as f:
+        spans = [json.loads(line) for line in f]
+    assert [(span["step"], span["parent"], span["port"], span["outcome"]) for span in spans] == [
+        ("gather", "install", "/dev/ttyUSB0", OUTCOME_ERROR),
+        ("install", "", "/dev/ttyUSB0", OUTCOME_EXCEPTION)]
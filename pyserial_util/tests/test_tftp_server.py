@@ -0,0 +1,79 @@
+"""
+Tests of the TFTP server in tftp_server.py, with fetch() as the client, over
+the loopback interface.
+"""
+import os
+import time
+
+import pytest
+
+from pyserial_util.tftp_server import TFTPServer, fetch, max_block_size, max_window_size
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    (tmp_path / "images").mkdir()
+    (tmp_path / "secret").write_bytes(b"not to be served")
+    return tmp_path / "images"
+
+@pytest.fixture
+def server(image_dir):
+    tftp_server = TFTPServer(str(image_dir), "127.0.0.1", port=0, timeout=1)
+    tftp_server.start()
+    yield tftp_server
+    tftp_server.stop()
+
+def test_fetch_with_default_options(server, image_dir):
+    data = os.urandom(5000)
+    (image_dir / "small.bin").write_bytes(data)
+    assert fetch("127.0.0.1", "small.bin", server.port, timeout=1) == data
+    #The transfer is only complete for the server once it has the last ACK
+    deadline = time.time() + 5
+    while not server.completed_transfers and time.time() < deadline:
+        time.sleep(0.01)
+    assert [stats.bytes_sent for stats in server.completed_transfers] == [len(data)]
+
+def test_fetch_with_block_and_window_size(server, image_dir):
+    data = os.urandom(100000)
+    (image_dir / "image.bin").write_bytes(data)
+    assert fetch("127.0.0.1", "image.bin", server.port, block_size=1428, window_size=8, timeout=1) == data
+
+def test_fetch_exact_multiple_of_block_size(server, image_dir):
+    #The end is marked by an empty last block
+    data = os.urandom(1024 * 4)
+    (image_dir / "even.bin").write_bytes(data)
+    assert fetch("127.0.0.1", "even.bin", server.port, block_size=1024, window_size=4, timeout=1) == data
+
+def test_negotiate_limits_and_acknowledges_options(server):
+    block_size, window_size, timeout, acknowledged = server._negotiate(
+        {"blksize": "100000", "windowsize": "100000", "tsize": "0", "timeout": "3", "unknown": "1"}, 1234)
+    assert (block_size, window_size, timeout) == (max_block_size, max_window_size, 3)
+    assert acknowledged == {"blksize": str(max_block_size), "windowsize": str(max_window_size), 
+                            "tsize": "1234", "timeout": "3"}
+
+def test_negotiate_ignores_bad_options(server):
+    block_size, window_size, timeout, acknowledged = server._negotiate(
+        {"blksize": "4", "windowsize": "0", "timeout": "300", "tsize": "x"}, 1234)
+    assert (block_size, window_size, timeout, acknowledged) == (512, 1, 1, {})
+
+def test_block_numbers_wrap(server, image_dir):
+    #More than 65535 blocks, so the block numbers on the wire go past 0xFFFF
+    data = os.urandom(8 * 65536 + 100)
+    (image_dir / "large.bin").write_bytes(data)
+    assert fetch("127.0.0.1", "large.bin", server.port, block_size=8, window_size=64, timeout=1) == data
+
+@pytest.mark.parametrize("filename", ["../secret", "sub/../../secret", "./../secret"])
+def test_paths_outside_of_root_are_refused(server, filename):
+    with pytest.raises(IOError) as error:
+        fetch("127.0.0.1", filename, server.port, timeout=1)
+    assert "Outside of the server root" in str(error.value)
+
+def test_missing_file(server):
+    with pytest.raises(IOError) as error:
+        fetch("127.0.0.1", "missing.bin", server.port, timeout=1)
+    assert "File not found" in str(error.value)
+
+def test_root_must_be_a_directory(tmp_path):
+    for root in ("", str(tmp_path / "missing")):
+        with pytest.raises(IOError):
+            TFTPServer(root, "127.0.0.1", port=0).start()
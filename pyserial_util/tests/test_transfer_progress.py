@@ -0,0 +1,73 @@
+"""
+Tests of following the progress of copies to flash with transfer_progress.py.
+"""
+import time
+
+import pytest
+
+from pyserial_util import transfer_progress
+from pyserial_util.transfer_progress import TransferProgress
+
+
+@pytest.fixture(autouse=True)
+def no_learned_bytes_per_mark(monkeypatch):
+    monkeypatch.setattr(transfer_progress, "_bytes_per_mark", {})
+
+def test_marks_are_counted_across_pieces_of_output():
+    events = []
+    progress = TransferProgress(events.append)
+    assert progress.feed("Accessing tftp://10.1.1.1/image.bin...\r\nLoading image.bin ") == []
+    assert len(progress.feed("!!!")) == 1
+    assert len(progress.feed("!\r\n!")) == 1
+    assert progress.marks == 5
+    assert [event.marks for event in events] == [3, 5]
+    assert events[-1].bytes == 5 * transfer_progress.default_bytes_per_mark
+    assert not events[-1].complete
+
+def test_final_lines_split_across_pieces_of_output():
+    progress = TransferProgress()
+    progress.feed("!!!!\r\n[OK - 1638")
+    assert progress.ok_bytes is None
+    progress.feed("4 bytes]\r\n\r\n16384 bytes copied in 2.")
+    assert progress.ok_bytes == 16384
+    assert not progress.complete
+    events = progress.feed("500 secs (6553 bytes/sec)\r\nRouter#")
+    assert progress.complete
+    assert [(event.marks, event.bytes, event.bytes_per_second, event.elapsed, event.complete) for event in events] \
+        == [(4, 16384, 6553.0, 2.5, True)]
+    assert progress.bytes_per_second() == 6553.0
+    #The end is only reported once
+    assert progress.feed("") == []
+
+def test_single_byte_file():
+    progress = TransferProgress()
+    progress.feed("[OK - 1 byte]\r\n")
+    assert progress.ok_bytes == 1
+
+def test_bytes_per_mark_kept_by_key():
+    progress = TransferProgress(key=("IR809G-LTE-GA-K9", "tftp"))
+    progress.feed("!!!!\r\n[OK - 2048 bytes]\r\n2048 bytes copied in 1.0 secs (2048 bytes/sec)")
+    assert progress.bytes_per_mark == 512
+    
+    assert TransferProgress(key=("IR809G-LTE-GA-K9", "tftp")).bytes_per_mark == 512
+    #Not for other keys, nor for copies going on at the same time without one
+    assert TransferProgress(key=("IR809G-LTE-GA-K9", "http")).bytes_per_mark == 4096
+    assert TransferProgress().bytes_per_mark == 4096
+    assert TransferProgress.bytes_per_mark == 4096
+
+def test_stalled(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    progress = TransferProgress()
+    now[0] += 5
+    assert not progress.stalled(10)
+    now[0] += 6
+    assert progress.stalled(10)
+    progress.feed("!")
+    assert not progress.stalled(10)
+    now[0] += 11
+    assert progress.stalled(10)
+    progress.feed("1 bytes copied in 22.0 secs (0 bytes/sec)")
+    now[0] += 100
+    #A copy that has finished is never stalled
+    assert not progress.stalled(10)
@@ -0,0 +1,412 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a TFTP server that the scripts can run themselves, so that there is no
+need for a separate TFTP server to copy bundles and images to the devices.
+
+It is read only, and is built for many devices pulling the same large files
+at the same time:
+
+ - Each file is memory-mapped once, and that one mapping is shared by all of
+   the transfers of the file.
+ - Each transfer runs in a thread of its own, on its own UDP port, as RFC 1350
+   requires.
+ - The blksize (RFC 2348), windowsize (RFC 7440), tsize and timeout (RFC 2349)
+   options are negotiated with RFC 2347 option acknowledgements, so clients
+   that support them can use large blocks and send many blocks per ACK.
+ - The bytes, time taken and bytes/sec of each transfer are logged, and kept
+   in completed_transfers.
+
+The fetch() function is a simple client, which is useful for trying the server
+out over the loopback interface.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+from pyserial_util.mapped_files import MappedFiles
+
+logger = logging.getLogger()
+
+OP_RRQ = 1
+OP_WRQ = 2
+OP_DATA = 3
+OP_ACK = 4
+OP_ERROR = 5
+OP_OACK = 6
+
+ERROR_NOT_DEFINED = 0
+ERROR_FILE_NOT_FOUND = 1
+ERROR_ACCESS_VIOLATION = 2
+ERROR_ILLEGAL_OPERATION = 4
+ERROR_UNKNOWN_TID = 5
+ERROR_OPTION = 8
+
+default_block_size = 512
+max_block_size = 65464
+max_window_size = 65535
+
+
+class TransferStats:
+    filename = ""
+    client = None
+    bytes_sent = 0
+    seconds = 0.0
+
+    def __init__(self, filename, client, bytes_sent, seconds):
+        self.filename = filename
+        self.client = client
+        self.bytes_sent = bytes_sent
+        self.seconds = seconds
+
+    def bytes_per_second(self):
+        if self.seconds > 0:
+            return self.bytes_sent / self.seconds
+        return 0.0
+
+class TFTPServer:
+    root = ""
+    host = ""
+    port = 69
+    timeout = 5
+    retries = 5
+
+    def __init__(self, root, host="", port=69, timeout=5, retries=5):
+        """
+        Serve the files under the root directory on the given host address and
+        UDP port, where an empty host is all addresses. Each block, or window
+        of blocks, is sent up to retries times, waiting timeout seconds for an
+        ACK each time, unless the client asks for a different timeout.
+        """
+        #Not the current directory for an empty root
+        self.root = os.path.abspath(root) if root else ""
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.completed_transfers = []
+        self._files = MappedFiles(self.root)
+        self._lock = threading.Lock()
+        self._socket = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        """
+        Bind the server socket and start serving in a background thread, or
+        raise IOError if the root is not a directory.
+        """
+        if not os.path.isdir(self.root):
+            raise IOError("Not serving \"" + self.root + "\", as it is not a directory.")
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.settimeout(0.5)
+        self.port = self._socket.getsockname()[1]
+        self._stopping.clear()
+        self._files = MappedFiles(self.root)
+        self._thread = threading.Thread(target=self._serve, name="tftp-server")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("TFTP server serving " + self.root + " on port " + str(self.port) + ".")
+
+    def stop(self):
+        """
+        Stop accepting new transfers, and unmap the files once no transfers
+        are using them.
+        """
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+        self._files.close()
+
+    def _serve(self):
+        while not self._stopping.is_set():
+            try:
+                packet, client = self._socket.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except (socket.error, OSError) as e:
+                if not self._stopping.is_set():
+                    logger.error("TFTP server receive failed - %s" % e)
+                continue
+
+            if len(packet) < 2:
+                continue
+            opcode = struct.unpack("!H", packet[:2])[0]
+            if (opcode == OP_RRQ):
+                thread = threading.Thread(target=self._transfer, args=(packet, client),
+                                          name="tftp-" + client[0] + ":" + str(client[1]))
+                thread.daemon = True
+                thread.start()
+            elif (opcode == OP_WRQ):
+                self._send_error(self._socket, client, ERROR_ACCESS_VIOLATION, "This server is read only")
+            else:
+                self._send_error(self._socket, client, ERROR_ILLEGAL_OPERATION, "Expected a read request")
+
+    def _transfer(self, packet, client):
+        transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        transfer_socket.bind((self.host, 0))
+        path = None
+        entry = None
+        try:
+            fields = packet[2:].split(b"\0")
+            if len(fields) < 2:
+                self._send_error(transfer_socket, client, ERROR_ILLEGAL_OPERATION, "Malformed read request")
+                return
+            filename = fields[0].decode("ascii", "replace")
+            mode = fields[1].decode("ascii", "replace").lower()
+            options = {}
+            for index in range(2, len(fields) - 1, 2):
+                options[fields[index].decode("ascii", "replace").lower()] = fields[index + 1].decode("ascii", "replace")
+
+            if mode not in ("octet", "netascii"):
+                self._send_error(transfer_socket, client, ERROR_ILLEGAL_OPERATION, "Unsupported mode " + mode)
+                return
+
+            path = self._files.resolve(filename)
+            if path is None:
+                self._send_error(transfer_socket, client, ERROR_ACCESS_VIOLATION, "Outside of the server root")
+                return
+
+            try:
+                entry = self._files.acquire(path)
+                data = entry[0]
+            except (IOError, OSError) as e:
+                self._send_error(transfer_socket, client, ERROR_FILE_NOT_FOUND, "File not found")
+                logger.error("TFTP request from " + client[0] + " for " + filename + " failed - %s" % e)
+                return
+
+            block_size, window_size, timeout, acknowledged = self._negotiate(options, len(data))
+            transfer_socket.settimeout(timeout)
+
+            logger.info("TFTP sending " + filename + " to " + client[0] + " with block size " + str(block_size)
+                        + " and window size " + str(window_size) + ".")
+            start_time = time.time()
+            if acknowledged:
+                oack = struct.pack("!H", OP_OACK)
+                for name in sorted(acknowledged):
+                    oack += name.encode("ascii") + b"\0" + acknowledged[name].encode("ascii") + b"\0"
+                if self._send_window(transfer_socket, client, [oack], 0) is None:
+                    return
+
+            if self._send_data(transfer_socket, client, data, block_size, window_size):
+                seconds = time.time() - start_time
+                stats = TransferStats(filename, client, len(data), seconds)
+                with self._lock:
+                    self.completed_transfers.append(stats)
+                logger.info("TFTP sent " + str(len(data)) + " bytes of " + filename + " to " + client[0] + " in "
+                            + "%.3f" % seconds + " secs (" + "%.0f" % stats.bytes_per_second() + " bytes/sec).")
+        except (socket.error, OSError) as e:
+            logger.error("TFTP transfer to " + client[0] + " failed - %s" % e)
+        finally:
+            transfer_socket.close()
+            if entry:
+                self._files.release(path, entry)
+
+    def _negotiate(self, options, size):
+        """
+        The block size, window size and timeout to use, and a dict of the
+        options to acknowledge, which is empty if none were asked for.
+        """
+        block_size = default_block_size
+        window_size = 1
+        timeout = self.timeout
+        acknowledged = {}
+        for name, value in options.items():
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+            if (name == "blksize" and value >= 8):
+                block_size = min(value, max_block_size)
+                acknowledged[name] = str(block_size)
+            elif (name == "windowsize" and value >= 1):
+                window_size = min(value, max_window_size)
+                acknowledged[name] = str(window_size)
+            elif (name == "tsize"):
+                acknowledged[name] = str(size)
+            elif (name == "timeout" and 1 <= value <= 255):
+                timeout = value
+                acknowledged[name] = str(value)
+
+        return block_size, window_size, timeout, acknowledged
+
+    def _send_data(self, transfer_socket, client, data, block_size, window_size):
+        """
+        Send the data in windows of window_size blocks, going on from the block
+        after the one each ACK is for. The last block is always shorter than
+        block_size, even if that means it is empty.
+        """
+        last_block = len(data) // block_size + 1
+        next_block = 1
+        while (next_block <= last_block):
+            window_end = min(next_block + window_size - 1, last_block)
+            packets = []
+            for block in range(next_block, window_end + 1):
+                start = (block - 1) * block_size
+                packets.append(struct.pack("!HH", OP_DATA, block & 0xFFFF) + data[start:start + block_size])
+            acked = self._send_window(transfer_socket, client, packets, next_block - 1, window_end)
+            if acked is None:
+                return False
+            next_block = acked + 1
+
+        return True
+
+    def _send_window(self, transfer_socket, client, packets, base, window_end=None):
+        """
+        Send the packets, and wait for an ACK for a block from base to
+        window_end, resending them on a timeout. Block numbers on the wire wrap
+        around at 65535, so they are mapped back to the window. The result is
+        the block that was ACKed, or None if the transfer failed.
+        """
+        if window_end is None:
+            window_end = base
+        attempts = 0
+        resend = True
+        resent_for_duplicate = False
+        while (attempts < self.retries):
+            if resend:
+                for packet in packets:
+                    transfer_socket.sendto(packet, client)
+                deadline = time.time() + transfer_socket.gettimeout()
+                resend = False
+            try:
+                reply, address = transfer_socket.recvfrom(65536)
+            except socket.timeout:
+                reply, address = None, None
+            if (reply is None or time.time() >= deadline):
+                attempts += 1
+                resend = True
+                continue
+            if address != client:
+                self._send_error(transfer_socket, address, ERROR_UNKNOWN_TID, "Unknown transfer ID")
+                continue
+            if len(reply) < 4:
+                continue
+            opcode, block = struct.unpack("!HH", reply[:4])
+            if (opcode == OP_ERROR):
+                logger.error("TFTP client " + client[0] + " sent error " + str(block) + " - "
+                             + reply[4:].rstrip(b"\0").decode("ascii", "replace"))
+                return None
+            if (opcode == OP_ACK):
+                offset = (block - base) & 0xFFFF
+                if (offset == 0 and window_end > base):
+                    #An ACK for the block before the window means the client lost
+                    #the first block of it, so the window is resent straight away, 
+                    #but only once, as later ones are likely to be duplicates
+                    if not resent_for_duplicate:
+                        resent_for_duplicate = True
+                        resend = True
+                    continue
+                if (offset <= window_end - base):
+                    return base + offset
+
+        logger.error("TFTP client " + client[0] + " stopped responding.")
+        return None
+
+    def _send_error(self, sock, client, code, message):
+        try:
+            sock.sendto(struct.pack("!HH", OP_ERROR, code) + message.encode("ascii") + b"\0", client)
+        except (socket.error, OSError) as e:
+            logger.debug("Could not send a TFTP error to " + client[0] + " - %s" % e)
+
+def fetch(host, filename, port=69, block_size=default_block_size, window_size=1, timeout=5, retries=5, 
+          on_data=None):
+    """
+    Read filename from the TFTP server at host and port, asking for the given
+    block and window sizes, and return the contents. The last ACK is resent 
+    after each timeout, up to retries times in a row. An IOError is raised if
+    the transfer fails. If on_data is given, it is called with the number of 
+    bytes in each block as it arrives, and can stop the transfer by raising an
+    IOError.
+    """
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    client_socket.settimeout(timeout)
+    try:
+        request = struct.pack("!H", OP_RRQ) + filename.encode("ascii") + b"\0octet\0"
+        if (block_size != default_block_size):
+            request += b"blksize\0" + str(block_size).encode("ascii") + b"\0"
+        if (window_size != 1):
+            request += b"windowsize\0" + str(window_size).encode("ascii") + b"\0"
+        client_socket.sendto(request, (host, port))
+
+        block_size = default_block_size
+        window_size = 1
+        chunks = []
+        server = None
+        last_good = 0
+        in_window = 0
+        timeouts = 0
+        while True:
+            try:
+                packet, server = client_socket.recvfrom(65536)
+            except socket.timeout:
+                timeouts += 1
+                if (server is None or timeouts > retries):
+                    raise IOError("Timed out fetching " + filename)
+                client_socket.sendto(struct.pack("!HH", OP_ACK, last_good & 0xFFFF), server)
+                in_window = 0
+                continue
+            timeouts = 0
+            opcode = struct.unpack("!H", packet[:2])[0]
+            if (opcode == OP_ERROR):
+                raise IOError("TFTP error fetching " + filename + " - "
+                              + packet[4:].rstrip(b"\0").decode("ascii", "replace"))
+            if (opcode == OP_OACK):
+                fields = packet[2:].split(b"\0")
+                for index in range(0, len(fields) - 1, 2):
+                    if (fields[index] == b"blksize"):
+                        block_size = int(fields[index + 1])
+                    elif (fields[index] == b"windowsize"):
+                        window_size = int(fields[index + 1])
+                client_socket.sendto(struct.pack("!HH", OP_ACK, 0), server)
+                continue
+            if (opcode != OP_DATA):
+                continue
+
+            block = struct.unpack("!H", packet[2:4])[0]
+            if (block != (last_good + 1) & 0xFFFF):
+                #Out of order, so ACK the last block that was in order
+                client_socket.sendto(struct.pack("!HH", OP_ACK, last_good & 0xFFFF), server)
+                in_window = 0
+                continue
+
+            chunks.append(packet[4:])
+            if on_data:
+                on_data(len(packet) - 4)
+            last_good += 1
+            in_window += 1
+            done = len(packet) - 4 < block_size
+            if done or in_window >= window_size:
+                client_socket.sendto(struct.pack("!HH", OP_ACK, last_good & 0xFFFF), server)
+                in_window = 0
+            if done:
+                return b"".join(chunks)
+    finally:
+        client_socket.close()
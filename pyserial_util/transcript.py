@@ -0,0 +1,269 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a recorder of everything written to and read from a device console,
+with when it happened, and a replay of such a transcript that can be used in
+place of the serial port, so that a failure seen with a real device can be
+reproduced and debugged without the device, and many sessions can be replayed
+quickly in regression runs.
+
+A transcript is a binary file, which starts with MAGIC, followed by records
+of:
+
+ - A header, packed as RECORD, of the time in seconds since the recording
+   started, from a monotonic clock, the kind of record and the length of the
+   data.
+ - The data, which is the bytes read for READ records, the bytes written for
+   WRITE records, or JSON for NOTE records, such as the port, device type and
+   serial number.
+
+When a transcript is replayed, what was read is made available to be read
+again at the same times, relative to the writes before it, divided by speed,
+so that speed = 1 is the original speed and speed = 10 is ten times as fast.
+Speed None makes it available as soon as it can be. What was read after a
+write is only made available once the scripts have made that write again, so
+the replay follows the scripts, however long they take. Writes that are not
+the same as those recorded are counted as divergences and logged.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger()
+
+MAGIC = b"PSTRANS1"
+RECORD = struct.Struct("!dBI")
+READ = ord("R")
+WRITE = ord("W")
+NOTE = ord("N")
+
+#time.monotonic() is not there in Python 2
+monotonic = getattr(time, "monotonic", time.time)
+
+
+def to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode("latin-1")
+
+def to_text(data):
+    """
+    Bytes as the str that the scripts read and write.
+    """
+    if isinstance(data, str):
+        return data
+    return data.decode("latin-1")
+
+def transcript_path(transcript_dir, port_path):
+    """
+    A new transcript file in transcript_dir for the port at port_path.
+    """
+    return os.path.join(transcript_dir, os.path.basename(port_path) + "-"
+                        + time.strftime("%Y%m%d-%H%M%S") + ".transcript")
+
+def load_transcript(path):
+    """
+    The records in the transcript at path, as a list of (kind, seconds, data)
+    tuples, with the data of the NOTE records as dicts. An IOError is raised if
+    the file is not a transcript.
+    """
+    with open(path, "rb") as f:
+        contents = f.read()
+    if not contents.startswith(MAGIC):
+        raise IOError(path + " is not a console transcript")
+
+    records = []
+    position = len(MAGIC)
+    while (position + RECORD.size <= len(contents)):
+        seconds, kind, length = RECORD.unpack_from(contents, position)
+        position += RECORD.size
+        data = contents[position:position + length]
+        position += length
+        if (len(data) < length):
+            #The recording was cut short, as when the scripts were killed
+            break
+        if (kind == NOTE):
+            data = json.loads(data.decode("utf-8"))
+        records.append((kind, seconds, data))
+
+    return records
+
+class TranscriptRecorder:
+    """
+    A TranscriptRecorder wraps a serial port, and can be used in place of it,
+    recording everything written to and read from it to a transcript file.
+    """
+    serial_port = None
+    port = ""
+    path = ""
+
+    def __init__(self, serial_port, path):
+        self.serial_port = serial_port
+        self.port = serial_port.port
+        self.path = path
+        self._lock = threading.Lock()
+        self._start = monotonic()
+        transcript_dir = os.path.dirname(path)
+        if transcript_dir and not os.path.isdir(transcript_dir):
+            os.makedirs(transcript_dir)
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self.note({"port": self.port, "started": time.time()})
+
+    def _record(self, kind, data):
+        with self._lock:
+            if self._file:
+                self._file.write(RECORD.pack(monotonic() - self._start, kind, len(data)) + data)
+                self._file.flush()
+
+    def note(self, values):
+        """
+        Add the values, a dict, to the transcript, such as the device type once
+        it is known.
+        """
+        self._record(NOTE, json.dumps(values, sort_keys=True).encode("utf-8"))
+
+    def write(self, data):
+        self._record(WRITE, to_bytes(data))
+        return self.serial_port.write(data)
+
+    def read(self, size=1):
+        data = self.serial_port.read(size)
+        if data:
+            self._record(READ, to_bytes(data))
+        return data
+
+    def inWaiting(self):
+        return self.serial_port.inWaiting()
+
+    def isOpen(self):
+        return self.serial_port.isOpen()
+
+    def close(self):
+        self.serial_port.close()
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def __getattr__(self, name):
+        #Anything else, such as the baud rate, is that of the serial port
+        return getattr(self.serial_port, name)
+
+class TranscriptReplay:
+    """
+    A TranscriptReplay can be used in place of a serial port, replaying the
+    transcript at path at the given speed.
+    """
+    port = ""
+    path = ""
+    speed = 1.0
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.records = load_transcript(path)
+        self.notes = {}
+        for kind, seconds, data in self.records:
+            if (kind == NOTE):
+                self.notes.update(data)
+        self.port = self.notes.get("port", path)
+        self.divergences = 0
+        self._index = 0
+        self._buffer = ""
+        self._expected = b""
+        self._sync_time = 0.0
+        self._sync_wall = monotonic()
+        self._lock = threading.Lock()
+
+    def _release(self):
+        #Make what was read available, up to the next write or the present time
+        now = monotonic()
+        while (self._index < len(self.records)):
+            kind, seconds, data = self.records[self._index]
+            if (kind == WRITE):
+                break
+            if (kind == READ):
+                if (self.speed and self._sync_wall + (seconds - self._sync_time) / self.speed > now):
+                    break
+                self._buffer += to_text(data)
+            self._index += 1
+
+    def _next_write(self):
+        #Everything read before the next write was read before it was made
+        while (self._index < len(self.records)):
+            kind, seconds, data = self.records[self._index]
+            self._index += 1
+            if (kind == WRITE):
+                self._sync_time = seconds
+                return data
+            if (kind == READ):
+                self._buffer += to_text(data)
+        return None
+
+    def write(self, data):
+        written = to_bytes(data)
+        with self._lock:
+            while written:
+                if not self._expected:
+                    self._expected = self._next_write()
+                    if self._expected is None:
+                        self._expected = b""
+                        self.divergences += 1
+                        logger.warning("Replaying " + self.path + ", there was no write recorded for "
+                                       + repr(written) + ".")
+                        break
+                size = min(len(written), len(self._expected))
+                if (written[:size] != self._expected[:size]):
+                    self.divergences += 1
+                    logger.warning("Replaying " + self.path + ", " + repr(written[:size]) + " was written, but "
+                                   + repr(self._expected[:size]) + " was recorded.")
+                written = written[size:]
+                self._expected = self._expected[size:]
+            self._sync_wall = monotonic()
+        return len(data)
+
+    def inWaiting(self):
+        with self._lock:
+            self._release()
+            return len(self._buffer)
+
+    def read(self, size=1):
+        with self._lock:
+            self._release()
+            data = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            return data
+
+    def finished(self):
+        """
+        Whether all of the transcript has been replayed.
+        """
+        with self._lock:
+            return self._index >= len(self.records) and not self._buffer
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        pass
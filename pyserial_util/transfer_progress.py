@@ -0,0 +1,151 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+This is a parser for the progress output that IOS prints while it copies a file
+to flash, which turns that output into a stream of progress events, so that
+a transfer can be followed as it happens, and one that has stalled can be
+spotted and stopped.
+
+While a copy runs, IOS prints a "!" every so often as data arrives, and at the
+end prints lines like these:
+
+    [OK - 183640000 bytes]
+
+    183640000 bytes copied in 512.331 secs (358440 bytes/sec)
+
+IOS does not say how many bytes each "!" is, so the bytes and bytes/sec in the
+events during a copy are estimates, from the bytes_per_mark of the copy. When
+a copy finishes, the final event has the exact figures from IOS. As the bytes
+each "!" stands for differ from one protocol and type of device to another,
+what they came to is kept by a key for those, if the copy has one, so that
+the estimates for later copies with the same key are better.
+
+Copyright 2016 Nathan John Sowatskey
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+from __future__ import print_function
+
+import re
+import threading
+import time
+
+MARK = "!"
+BYTES_COPIED = re.compile(r"(\d+) bytes copied in ([\d.]+) secs \((\d+) bytes/sec\)")
+OK_BYTES = re.compile(r"\[OK - (\d+) bytes?\]")
+
+#An estimate to start with, for copies with no key or with a key that has not
+#had a copy finish yet.
+default_bytes_per_mark = 4096
+
+_bytes_per_mark = {}
+_bytes_per_mark_lock = threading.Lock()
+
+
+class ProgressEvent:
+    marks = 0
+    bytes = 0
+    bytes_per_second = 0.0
+    elapsed = 0.0
+    complete = False
+
+    def __init__(self, marks, bytes, bytes_per_second, elapsed, complete=False):
+        self.marks = marks
+        self.bytes = bytes
+        self.bytes_per_second = bytes_per_second
+        self.elapsed = elapsed
+        self.complete = complete
+
+    def __str__(self):
+        return (str(self.marks) + " marks, " + str(self.bytes) + " bytes in " + "%.1f" % self.elapsed
+                + " secs (" + "%.0f" % self.bytes_per_second + " bytes/sec)" + (", complete" if self.complete else ""))
+
+class TransferProgress:
+    bytes_per_mark = default_bytes_per_mark
+
+    def __init__(self, on_progress=None, key=None):
+        """
+        Follow the progress of one copy. If on_progress is given, it is called
+        with each ProgressEvent as it happens. The key, such as the type of
+        the device and the protocol, is what the bytes for each "!" are kept 
+        by between copies, as described above.
+        """
+        self.on_progress = on_progress
+        self.key = key
+        with _bytes_per_mark_lock:
+            self.bytes_per_mark = _bytes_per_mark.get(key, default_bytes_per_mark)
+        self.events = []
+        self.marks = 0
+        self.start_time = time.time()
+        self.last_progress_time = self.start_time
+        self.complete = False
+        #The size of the file, as the device gives it in "[OK - n bytes]" when
+        #the copy has finished, or None until then
+        self.ok_bytes = None
+        self._tail = ""
+
+    def feed(self, output):
+        """
+        Parse the next piece of output from the copy, giving an event if there
+        are new marks or the copy has finished. The result is the new events.
+        """
+        now = time.time()
+        new_events = []
+
+        new_marks = output.count(MARK)
+        if new_marks:
+            self.marks += new_marks
+            self.last_progress_time = now
+            elapsed = now - self.start_time
+            estimated_bytes = self.marks * self.bytes_per_mark
+            rate = estimated_bytes / elapsed if elapsed > 0 else 0.0
+            new_events.append(ProgressEvent(self.marks, estimated_bytes, rate, elapsed))
+
+        #The final lines can be split across pieces of output
+        self._tail = (self._tail + output)[-512:]
+        match = OK_BYTES.search(self._tail)
+        if match:
+            self.ok_bytes = int(match.group(1))
+        match = BYTES_COPIED.search(self._tail)
+        if match and not self.complete:
+            self.complete = True
+            self.last_progress_time = now
+            copied = int(match.group(1))
+            if self.marks:
+                self.bytes_per_mark = max(1, copied // self.marks)
+                if self.key is not None:
+                    with _bytes_per_mark_lock:
+                        _bytes_per_mark[self.key] = self.bytes_per_mark
+            new_events.append(ProgressEvent(self.marks, copied, float(match.group(3)), float(match.group(2)), True))
+
+        for event in new_events:
+            self.events.append(event)
+            if self.on_progress:
+                self.on_progress(event)
+
+        return new_events
+
+    def bytes_per_second(self):
+        """
+        The latest bytes/sec, which is 0 until there has been some progress.
+        """
+        if self.events:
+            return self.events[-1].bytes_per_second
+        return 0.0
+
+    def stalled(self, stall_timeout):
+        """
+        Whether there has been no progress for more than stall_timeout seconds.
+        """
+        return not self.complete and time.time() - self.last_progress_time > stall_timeout